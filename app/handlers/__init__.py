@@ -1,6 +1,6 @@
 from app.utility.webhook import handle_job_event
 from .job_activity import handle_job_activity
-from .create_job import handle_create_job
+from .create_job import handle_create_job, prefetch_create_jobs
 from app.handlers.job import (
     handle_hubspot_job_quote_accepted,
     handle_job_quote_sent,
@@ -14,3 +14,9 @@ webhook_handlers = {
     "QuoteAccepted": handle_hubspot_job_quote_accepted,
     "ReadyToBeQuoted": handle_job_quote_sent,
 }
+
+# Event types whose ready events are handled as a set: the function batch
+# reads what a list of their payloads needs and returns per-event memos.
+batch_prefetchers = {
+    "CreateJob": prefetch_create_jobs,
+}
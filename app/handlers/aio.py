@@ -0,0 +1,249 @@
+"""
+asyncio versions of the webhook handlers. The decisions are shared with the
+blocking handlers; independent calls within a handler run concurrently.
+"""
+import asyncio
+import logging
+from app.utility import aio
+from app.utility.context import record_failure
+from app.utility.ledger import create_job_ledger
+from app.utility.tracing import traced
+from app.handlers.job import (
+    job_status,
+    needs_work_order,
+    quote_accepted_properties,
+    quote_sent_job_uuid,
+    quote_sent_properties,
+)
+from app.handlers.job_activity import consult_visit_properties
+from app.handlers.create_job import (
+    build_contact_data,
+    build_job_data,
+    client_name,
+    contact_client,
+    deal_ready_for_job,
+)
+
+
+@traced
+async def handle_job_quote_sent(data):
+    job_uuid = quote_sent_job_uuid(data)
+    if not job_uuid:
+        logging.error("No job uuid provided (neither in entry nor sm8_job_id).")
+        return
+
+    job = await aio.get_job(job_uuid)
+    if not job:
+        logging.error("Could not fetch Job with uuid: %s", job_uuid)
+        return
+
+    properties = quote_sent_properties(job)
+    if not properties:
+        logging.info("Quote not sent yet for this job.")
+        return
+
+    deal_id = await aio.find_hubspot_deal_by_job_uuid(job_uuid)
+    if deal_id:
+        await aio.update_hubspot_deal(deal_id, properties)
+    else:
+        logging.warning("No HubSpot deal found with sm8_job_uuid = %s", job_uuid)
+
+
+@traced
+async def handle_sm8_job_quote_accepted(job_uuid):
+    job = await aio.get_job(job_uuid)
+    if not job:
+        logging.error("Could not fetch Job with uuid: %s", job_uuid)
+        return
+
+    properties = quote_accepted_properties(job)
+    if not properties:
+        logging.info("Job %s Status is %s, no action taken.", job_uuid, job_status(job))
+        return
+
+    # Status changes are frequent and most don't qualify, so the deal search
+    # only runs once the job is known to be a Work Order.
+    deal_id = await aio.find_hubspot_deal_by_job_uuid(job_uuid)
+    if not deal_id:
+        logging.warning("No HubSpot deal found for job_id: %s", job_uuid)
+        return
+
+    logging.info("Found deal %s, updating stage to Quote Accepted.", deal_id)
+    await aio.update_hubspot_deal(deal_id, properties)
+
+
+async def handle_job_event(data):
+    entry = data.get("entry", [{}])[0]
+    job_uuid = entry.get("uuid")
+    changed_fields = entry.get("changed_fields", [])
+
+    # Kept sequential: both branches may write the deal stage and the quote
+    # sent stage has to win, as it does in the blocking handler.
+    if "status" in changed_fields:
+        await handle_sm8_job_quote_accepted(job_uuid)
+    if "quote_sent" in changed_fields:
+        await handle_job_quote_sent(data)
+
+
+async def handle_hubspot_job_quote_accepted(data):
+    job_id = data.get("sm8_job_id")
+    logging.info("Handling quote accepted for job: %s", job_id)
+
+    if not needs_work_order(data):
+        return
+
+    job = await aio.get_job(job_id)
+    if not job:
+        logging.error("Could not fetch Job with uuid: %s", job_id)
+        return
+
+    if job_status(job) == "work order":
+        logging.info("Job %s is already a Work Order. No action needed.", job_id)
+        return
+
+    await aio.update_job_status_to_work_order(job_id)
+
+
+async def handle_job_activity(data):
+    entry = data.get("entry", [{}])[0]
+    job_activity_uuid = entry.get("uuid")
+    if not job_activity_uuid:
+        logging.error("No uuid in JobActivity entry.")
+        return
+
+    job_activity = await aio.get_job_activity(job_activity_uuid)
+    if not job_activity:
+        logging.error("Could not fetch JobActivity with uuid: %s", job_activity_uuid)
+        return
+
+    if str(job_activity.get("activity_was_scheduled")) != "1":
+        return
+
+    job_uuid = job_activity.get("job_uuid")
+    if not job_uuid:
+        logging.error("No job_uuid in JobActivity.")
+        return
+
+    job, deal_id = await asyncio.gather(
+        aio.get_job(job_uuid), aio.find_hubspot_deal_by_job_uuid(job_uuid)
+    )
+    if not job:
+        logging.error("Could not fetch Job with uuid: %s", job_uuid)
+        return
+
+    properties_to_update = consult_visit_properties(job_activity, job)
+    if not properties_to_update:
+        logging.info("Job status '%s' does not trigger a dealstage update.", job_status(job))
+        return
+
+    if deal_id:
+        await aio.update_hubspot_deal(deal_id, properties_to_update)
+    else:
+        logging.warning("No HubSpot deal found with sm8_job_uuid = %s", job_uuid)
+
+
+async def handle_create_job(event_data):
+    deal_id = event_data.get("deal_record_id")
+    if not deal_id:
+        logging.error("No deal_record_id provided in the event data.")
+        return
+
+    done = await asyncio.to_thread(create_job_ledger.get, deal_id)
+    if done and done["status"] == "done":
+        logging.info("Job already exists for deal %s with sm8_job_id: %s (ledger)", deal_id, done["job_uuid"])
+        return
+
+    entry = await asyncio.to_thread(create_job_ledger.claim, deal_id)
+    if entry is None:
+        record_failure("ledger", f"deal {deal_id} is being created by another run")
+        return
+    try:
+        await create_job_steps(deal_id, event_data, entry)
+    finally:
+        if entry["status"] != "done":
+            await asyncio.to_thread(create_job_ledger.release, entry)
+
+
+async def create_job_steps(deal_id, event_data, entry):
+    async def record(**steps):
+        await asyncio.to_thread(create_job_ledger.record, entry, **steps)
+
+    needs_contact = not (entry["client_uuid"] and entry["contact_linked"] and entry["job_contact_created"])
+    # The deal read and the association/contact read do not depend on each
+    # other, so they run together.
+    deal_details, contact_details = await asyncio.gather(
+        aio.get_job_deal(deal_id) if not entry["job_uuid"] else _none(),
+        aio.get_deal_details_with_associations(deal_id) if needs_contact else _none(),
+    )
+    if not entry["job_uuid"]:
+        if not deal_details:
+            logging.error("Could not read deal %s. Aborting.", deal_id)
+            return
+        deal_properties = deal_details.get("properties", {})
+        if deal_properties.get("sm8_job_id"):
+            await asyncio.to_thread(create_job_ledger.complete, entry, deal_properties["sm8_job_id"])
+        if not deal_ready_for_job(deal_id, deal_properties):
+            return
+
+    contact_props = {}
+    if needs_contact:
+        if not contact_details:
+            logging.error("Could not retrieve details for deal %s. Aborting.", deal_id)
+            return
+        contact_props = contact_details.get("contact", {})
+        if not entry["contact_id"]:
+            await record(**await asyncio.to_thread(contact_client, contact_details, entry["client_uuid"]))
+
+    if not entry["client_uuid"]:
+        client_uuid = await aio.create_servicem8_client(client_name(contact_props))
+        if not client_uuid:
+            return
+        await record(client_uuid=client_uuid)
+
+    async def link_contact():
+        # Linking the contact is not needed to create the job.
+        if not entry["contact_id"] or await aio.update_hubspot_contact_sm8_client_id(
+            entry["contact_id"], entry["client_uuid"]
+        ):
+            await record(contact_linked=1)
+
+    contact_update = None
+    if not entry["contact_linked"]:
+        contact_update = asyncio.ensure_future(link_contact())
+
+    if not entry["job_uuid"]:
+        job_uuid = await aio.create_servicem8_job(build_job_data(event_data))
+        if job_uuid:
+            await record(job_uuid=job_uuid)
+
+    async def create_job_contact():
+        if await aio.create_servicem8_job_contact(entry["job_uuid"], build_contact_data(contact_props)):
+            await record(job_contact_created=1)
+
+    async def patch_deal():
+        if await aio.update_hubspot_deal_sm8_job_id(deal_id, entry["job_uuid"]):
+            await record(deal_patched=1)
+
+    if entry["job_uuid"]:
+        await asyncio.gather(
+            create_job_contact() if not entry["job_contact_created"] else _none(),
+            patch_deal() if not entry["deal_patched"] else _none(),
+        )
+    if contact_update:
+        await contact_update
+
+    if entry["job_uuid"] and entry["contact_linked"] and entry["job_contact_created"] and entry["deal_patched"]:
+        await asyncio.to_thread(create_job_ledger.complete, entry)
+
+
+async def _none():
+    return None
+
+
+async_webhook_handlers = {
+    "JobActivity": handle_job_activity,
+    "Job": handle_job_event,
+    "CreateJob": handle_create_job,
+    "QuoteAccepted": handle_hubspot_job_quote_accepted,
+    "ReadyToBeQuoted": handle_job_quote_sent,
+}
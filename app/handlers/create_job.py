@@ -8,64 +8,46 @@ from app.utility.create_job import (
     update_hubspot_contact_sm8_client_id,
     update_hubspot_deal_sm8_job_id,
 )
+from app.utility.client_index import client_index
+from app.utility.context import memo_key, record_failure
 from app.utility.hubspot import (
+    JOB_DEAL_PROPERTIES,
     get_deal_details_with_associations,
+    get_deals_details_with_associations,
+    get_job_deal,
     get_objects_properties,
 )
+from app.utility.ledger import create_job_ledger
 
 SERVICEM8_API_KEY = os.getenv("SERVICEM8_API_KEY")
 HUBSPOT_API_TOKEN = os.getenv("HUBSPOT_API_TOKEN")
 REQUIRED_DEAL_STAGE_ID = "1800543694"  # Onsite Consult - Send to SM8
 
-def handle_create_job(event_data):
-    """
-    Handles the job creation process, now with a deal stage check.
-    """
-    deal_id = event_data.get("deal_record_id")
-    if not deal_id:
-        logging.error("No deal_record_id provided in the event data.")
-        return
-
-    deal_details = get_objects_properties("deals", [deal_id], ["dealstage,sm8_job_id"])
-    deal_properties = deal_details[0].get("properties", {})
-
+def deal_ready_for_job(deal_id, deal_properties):
     sm8_job_id = deal_properties.get("sm8_job_id")
     if sm8_job_id:
-        logging.info(
-            f"Job already exists for deal {deal_id} with sm8_job_id: {sm8_job_id}"
-        )
-        return
+        logging.info("Job already exists for deal %s with sm8_job_id: %s", deal_id, sm8_job_id)
+        return False
 
     current_stage = deal_properties.get("dealstage")
     if current_stage != REQUIRED_DEAL_STAGE_ID:
         logging.warning(
-            f"Skipping job creation for deal {deal_id}. "
-            f"Stage '{current_stage}' does not match required stage '{REQUIRED_DEAL_STAGE_ID}'."
+            "Skipping job creation for deal %s. Stage '%s' does not match required stage '%s'.",
+            deal_id, current_stage, REQUIRED_DEAL_STAGE_ID,
         )
-        return
+        return False
 
-    logging.info(f"Deal {deal_id} is in the correct stage. Proceeding with job creation.")
+    logging.info("Deal %s is in the correct stage. Proceeding with job creation.", deal_id)
+    return True
 
-    contact_details = get_deal_details_with_associations(deal_id)
-    if not contact_details:
-        logging.error(f"Could not retrieve details for deal {deal_id}. Aborting.")
-        return
 
-    contact_record_id = contact_details.get("id", "")
-    contact_props = contact_details.get("contact", {})
-    client_uuid = contact_props.get("sm8_client_id")
+def client_name(contact):
+    first = contact.get("firstname")
+    last = contact.get("lastname")
+    return f"{first} {last}".strip()
 
-    if not client_uuid:
-        first = contact_details["contact"].get("firstname")
-        last = contact_details["contact"].get("lastname")
-        full_name = f"{first} {last}".strip()
-        client_uuid = create_servicem8_client(full_name)
-        if not client_uuid:
-            return
-
-        if contact_record_id and client_uuid:
-            update_hubspot_contact_sm8_client_id(contact_record_id, client_uuid)
 
+def build_job_data(event_data):
     service_categories = event_data.get("service_category", "")
     service_type = event_data.get("service_type", "")
     enquiry_notes = event_data.get("enquiry_notes", "")
@@ -85,24 +67,162 @@ def handle_create_job(event_data):
         f"Enquiry Notes: {enquiry_notes.strip()}"
     )
 
-    job_data = {
+    return {
         "status": "Quote",
         "job_address": site_address,
         "job_description": job_description,
         "date": str(date.today()),
     }
 
-    job_uuid = create_servicem8_job(job_data)
-    if not job_uuid:
-        return
 
-    contact_data = {
-        "firstname": contact_details["contact"].get("firstname"),
-        "lastname": contact_details["contact"].get("lastname"),
-        "phone": contact_details["contact"].get("phone"),
-        "email": contact_details["contact"].get("email"),
+def build_contact_data(contact):
+    return {
+        "firstname": contact.get("firstname"),
+        "lastname": contact.get("lastname"),
+        "phone": contact.get("phone"),
+        "email": contact.get("email"),
     }
 
-    create_servicem8_job_contact(job_uuid, contact_data)
-    if deal_id:
-        update_hubspot_deal_sm8_job_id(deal_id, job_uuid)
+
+def contact_client(contact_details, client_uuid=None):
+    """
+    Ledger fields for the deal's contact: its id and the ServiceM8 client
+    to use. The client comes from HubSpot's ``sm8_client_id`` or the local
+    client index, so a known customer never gets a second company.
+    """
+    contact_id = contact_details.get("id", "")
+    contact = contact_details.get("contact", {})
+    known_client = contact.get("sm8_client_id")
+    if known_client:
+        client_index.remember(contact_id, known_client)
+    # The contact index only holds links HubSpot has or was sent, so like a
+    # client HubSpot shows, one from it needs no link written back. A name
+    # match does.
+    linked_client = known_client or client_index.lookup(contact_id)
+    # The contact is already looked up; None leaves only the name match.
+    client = client_uuid or linked_client or client_index.find_client(None, client_name(contact))
+    return {
+        "contact_id": contact_id,
+        "client_uuid": client,
+        "contact_linked": int(bool(linked_client) and client == linked_client),
+    }
+
+
+def handle_create_job(event_data):
+    """
+    Handles the job creation process, now with a deal stage check.
+
+    Progress is kept in the CreateJob ledger, so a retry resumes after the
+    last completed step and a repeat for a finished deal makes no calls.
+    """
+    deal_id = event_data.get("deal_record_id")
+    if not deal_id:
+        logging.error("No deal_record_id provided in the event data.")
+        return
+
+    done = create_job_ledger.get(deal_id)
+    if done and done["status"] == "done":
+        logging.info("Job already exists for deal %s with sm8_job_id: %s (ledger)", deal_id, done["job_uuid"])
+        return
+
+    entry = create_job_ledger.claim(deal_id)
+    if entry is None:
+        # Another run holds the deal; fail so this event is retried after it.
+        record_failure("ledger", f"deal {deal_id} is being created by another run")
+        return
+    try:
+        create_job_steps(deal_id, event_data, entry)
+    finally:
+        if entry["status"] != "done":
+            create_job_ledger.release(entry)
+
+
+def create_job_steps(deal_id, event_data, entry):
+    if not entry["job_uuid"]:
+        deal = get_job_deal(deal_id)
+        if not deal:
+            logging.error("Could not read deal %s. Aborting.", deal_id)
+            return
+        deal_properties = deal.get("properties", {})
+        if deal_properties.get("sm8_job_id"):
+            create_job_ledger.complete(entry, deal_properties["sm8_job_id"])
+        if not deal_ready_for_job(deal_id, deal_properties):
+            return
+
+    contact_props = {}
+    if not (entry["client_uuid"] and entry["contact_linked"] and entry["job_contact_created"]):
+        contact_details = get_deal_details_with_associations(deal_id)
+        if not contact_details:
+            logging.error("Could not retrieve details for deal %s. Aborting.", deal_id)
+            return
+        contact_props = contact_details.get("contact", {})
+        if not entry["contact_id"]:
+            create_job_ledger.record(entry, **contact_client(contact_details, entry["client_uuid"]))
+
+    if not entry["client_uuid"]:
+        client_uuid = create_servicem8_client(client_name(contact_props))
+        if not client_uuid:
+            return
+        create_job_ledger.record(entry, client_uuid=client_uuid)
+
+    if not entry["contact_linked"]:
+        # Nothing to link when the deal's contact has no record id.
+        if not entry["contact_id"] or update_hubspot_contact_sm8_client_id(
+            entry["contact_id"], entry["client_uuid"]
+        ):
+            create_job_ledger.record(entry, contact_linked=1)
+
+    if not entry["job_uuid"]:
+        job_uuid = create_servicem8_job(build_job_data(event_data))
+        if not job_uuid:
+            return
+        create_job_ledger.record(entry, job_uuid=job_uuid)
+    job_uuid = entry["job_uuid"]
+
+    if not entry["job_contact_created"]:
+        if create_servicem8_job_contact(job_uuid, build_contact_data(contact_props)):
+            create_job_ledger.record(entry, job_contact_created=1)
+    if not entry["deal_patched"]:
+        if update_hubspot_deal_sm8_job_id(deal_id, job_uuid):
+            create_job_ledger.record(entry, deal_patched=1)
+
+    if entry["contact_linked"] and entry["job_contact_created"] and entry["deal_patched"]:
+        create_job_ledger.complete(entry)
+
+
+def prefetch_create_jobs(events_data):
+    """
+    Read what a set of queued CreateJob events needs with batch calls: one
+    deal read, one v4 association read and one contact read per
+    HUBSPOT_BATCH_LIMIT deals instead of three calls per deal. Returns, per
+    event, the memo entries to seed its handling with. A deal missing from
+    the batch results is simply read again by its own event.
+    """
+    deal_ids = [str(data.get("deal_record_id")) for data in events_data if data.get("deal_record_id")]
+    if not deal_ids:
+        return [{} for _ in events_data]
+    done = {
+        deal_id for deal_id in deal_ids
+        if (create_job_ledger.get(deal_id) or {}).get("status") == "done"
+    }
+    deals = {
+        str(deal.get("id")): deal
+        for deal in get_objects_properties("deals", [i for i in deal_ids if i not in done], JOB_DEAL_PROPERTIES)
+    }
+    ready = [
+        deal_id for deal_id, deal in deals.items()
+        if not deal.get("properties", {}).get("sm8_job_id")
+        and deal.get("properties", {}).get("dealstage") == REQUIRED_DEAL_STAGE_ID
+    ]
+    contacts = get_deals_details_with_associations(ready) if ready else {}
+
+    memos = []
+    for data in events_data:
+        deal_id = str(data.get("deal_record_id"))
+        memo = {}
+        if deal_id in deals:
+            memo[memo_key("job_deal", data.get("deal_record_id"))] = deals[deal_id]
+        if deal_id in contacts:
+            memo[memo_key("deal_contact", data.get("deal_record_id"))] = contacts[deal_id]
+        memos.append(memo)
+    return memos
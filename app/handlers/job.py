@@ -1,36 +1,73 @@
-import os
 import logging
-import requests
 from datetime import datetime
-from dotenv import load_dotenv
+from app.utility.clients import servicem8
+from app.utility.context import memoize_per_event
 from app.utility.job import update_job_status_to_work_order
+from app.utility.tracing import traced
+from app.utility.rules import QUOTE_ACCEPTED_STAGES, WORK_ORDER_DEAL_STAGES
 from app.utility.hubspot import (
-    get_objects_properties,
     update_hubspot_deal,
     QUOTE_SENT_PIPELINE_ID,
-    QUOTE_ACCEPTED_PIPELINE_ID,
     find_hubspot_deal_by_job_uuid,
 )
 
-load_dotenv()
-
-SERVICEM8_API_KEY = os.getenv("SERVICEM8_API_KEY")
-HUBSPOT_API_TOKEN = os.getenv("HUBSPOT_API_TOKEN")
-
 
+@memoize_per_event("job")
+@traced
 def get_job(uuid):
-    url = f"https://api.servicem8.com/api_1.0/job/{uuid}.json"
-    headers = {"accept": "application/json", "X-Api-Key": SERVICEM8_API_KEY}
     try:
-        response = requests.get(url, headers=headers)
+        response = servicem8.hedged_get(f"job/{uuid}.json")
         response.raise_for_status()
         return response.json()
     except Exception as e:
-        logging.error(f"Error fetching job: {e}")
+        logging.error("Error fetching job: %s", e)
         return None
 
 
-def handle_job_quote_sent(data):
+def format_sm8_date(value):
+    if not value or value == "0000-00-00 00:00:00":
+        return None
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d")
+
+
+def job_status(job):
+    return (job.get("status") or "").strip().lower()
+
+
+def quote_sent_properties(job):
+    """
+    Deal properties for a job whose quote has been sent, or None if the quote
+    has not been sent yet.
+    """
+    if job.get("quote_sent") is not True:
+        return None
+
+    properties = {"dealstage": QUOTE_SENT_PIPELINE_ID}
+    formatted_date = format_sm8_date(job.get("quote_date"))
+    if formatted_date:
+        properties["quote_date"] = formatted_date
+    total_amount = job.get("total_invoice_amount")
+    if total_amount:
+        properties["amount"] = float(total_amount)
+    return properties
+
+
+def quote_accepted_properties(job):
+    """
+    Deal properties for a job that became a Work Order, or None otherwise.
+    """
+    dealstage_id = QUOTE_ACCEPTED_STAGES.get(job_status(job))
+    if not dealstage_id:
+        return None
+
+    properties = {"dealstage": dealstage_id}
+    total_amount = job.get("total_invoice_amount")
+    if total_amount:
+        properties["amount"] = float(total_amount)
+    return properties
+
+
+def quote_sent_job_uuid(data):
     # First try to extract from Webhook payload
     entry = data.get("entry", [{}])[0]
     job_uuid = entry.get("uuid")
@@ -38,92 +75,93 @@ def handle_job_quote_sent(data):
     # Fallback to sm8_job_id (HubSpot payload)
     if not job_uuid:
         job_uuid = data.get("sm8_job_id")
+    return job_uuid
+
 
+@traced
+def handle_job_quote_sent(data):
+    job_uuid = quote_sent_job_uuid(data)
     if not job_uuid:
         logging.error("No job uuid provided (neither in entry nor sm8_job_id).")
         return
 
     job = get_job(job_uuid)
     if not job:
-        logging.error(f"Could not fetch Job with uuid: {job_uuid}")
+        logging.error("Could not fetch Job with uuid: %s", job_uuid)
         return
 
-    if job.get("quote_sent") is True:
-        total_amount = job.get("total_invoice_amount")
-        quote_date_str = job.get("quote_date")
-
-        print(f"Quote date for job {job_uuid}: {quote_date_str}")
-        print(f"Total amount for job {job_uuid}: {total_amount}")
-
-        formatted_date = None
-        if quote_date_str and quote_date_str != "0000-00-00 00:00:00":
-            formatted_date = datetime.strptime(
-                quote_date_str, "%Y-%m-%d %H:%M:%S"
-            ).strftime("%Y-%m-%d")
-
-        deal_id = find_hubspot_deal_by_job_uuid(job_uuid)
-
-        if deal_id:
-            properties = {}
-
-            properties["dealstage"] = QUOTE_SENT_PIPELINE_ID
-            if formatted_date:
-                properties["quote_date"] = formatted_date
-            if total_amount:
-                properties["amount"] = float(total_amount)
+    properties = quote_sent_properties(job)
+    if not properties:
+        logging.info("Quote not sent yet for this job.")
+        return
 
-            update_hubspot_deal(deal_id, properties)
+    logging.debug(
+        "Quote date for job %s: %s, total amount: %s",
+        job_uuid, job.get("quote_date"), job.get("total_invoice_amount"),
+    )
 
-        else:
-            logging.warning(f"No HubSpot deal found with sm8_job_uuid = {job_uuid}")
+    deal_id = find_hubspot_deal_by_job_uuid(job_uuid)
+    if deal_id:
+        update_hubspot_deal(deal_id, properties)
     else:
-        logging.info("Quote not sent yet for this job.")
+        logging.warning("No HubSpot deal found with sm8_job_uuid = %s", job_uuid)
 
 
+@traced
 def handle_sm8_job_quote_accepted(job_uuid):
     sm8_job = get_job(job_uuid)
-    sm8_job_status = sm8_job.get("status", "").strip().lower()
-    total_amount = sm8_job.get("total_invoice_amount")
+    if not sm8_job:
+        logging.error("Could not fetch Job with uuid: %s", job_uuid)
+        return
 
-    if sm8_job_status == "work order":
-        logging.error(f"Job {job_uuid} Status is {sm8_job_status}")
+    sm8_job_status = job_status(sm8_job)
+    properties = quote_accepted_properties(sm8_job)
+    if not properties:
+        logging.info("Job %s Status is %s, no action taken.", job_uuid, sm8_job_status)
+        return
 
-        deal_id = find_hubspot_deal_by_job_uuid(job_uuid)
-        if not deal_id:
-            logging.warning(f"No HubSpot deal found for job_id: {job_uuid}")
-            return
+    logging.error("Job %s Status is %s", job_uuid, sm8_job_status)
 
-        properties = {}
-        properties["dealstage"] = QUOTE_ACCEPTED_PIPELINE_ID
-        if total_amount:
-            properties["amount"] = float(total_amount)
+    deal_id = find_hubspot_deal_by_job_uuid(job_uuid)
+    if not deal_id:
+        logging.warning("No HubSpot deal found for job_id: %s", job_uuid)
+        return
 
-        logging.info(f"Found deal {deal_id}, updating stage to Quote Accepted.")
-        update_hubspot_deal(deal_id, properties)
-    else:
-        logging.info(f"Job {job_uuid} Status is {sm8_job_status}, no action taken.")
+    logging.info("Found deal %s, updating stage to Quote Accepted.", deal_id)
+    update_hubspot_deal(deal_id, properties)
 
-def handle_hubspot_job_quote_accepted(data):
+
+def needs_work_order(data):
+    """
+    Whether a HubSpot QuoteAccepted event asks to move its job to Work Order,
+    judged from the payload alone.
+    """
     deal_id = data.get("deal_record_id")
     job_id = data.get("sm8_job_id")
-    deal_stage = data.get("dealstage")
-    logging.info(f"Handling quote accepted for job: {job_id}")
-
     if not job_id or not deal_id:
         logging.error("Missing job_id or deal_id.")
-        return
+        return False
+
+    if data.get("dealstage") not in WORK_ORDER_DEAL_STAGES:
+        logging.info("Deal %s is not in 'Deposit Paid' stage. No action required.", deal_id)
+        return False
+    return True
 
-    if deal_stage != "1793082865":  # Deposit Paid stage
-        logging.info(
-            f"Deal {deal_id} is not in 'Deposit Paid' stage. No action required."
-        )
+
+def handle_hubspot_job_quote_accepted(data):
+    job_id = data.get("sm8_job_id")
+    logging.info("Handling quote accepted for job: %s", job_id)
+
+    if not needs_work_order(data):
         return
 
     sm8_job = get_job(job_id)
-    sm8_job_status = sm8_job.get("status", "").strip().lower()
+    if not sm8_job:
+        logging.error("Could not fetch Job with uuid: %s", job_id)
+        return
 
-    if sm8_job_status == "work order":
-        logging.info(f"Job {job_id} is already a Work Order. No action needed.")
+    if job_status(sm8_job) == "work order":
+        logging.info("Job %s is already a Work Order. No action needed.", job_id)
         return
 
     update_job_status_to_work_order(job_id)
@@ -1,33 +1,41 @@
-import os
 import logging
-import requests
-from dotenv import load_dotenv
-from datetime import datetime
-from app.handlers.job import get_job
+from app.handlers.job import format_sm8_date, get_job, job_status
+from app.utility.clients import servicem8
+from app.utility.context import memoize_per_event
+from app.utility.tracing import traced
+from app.utility.rules import CONSULT_VISIT_STAGES
 from app.utility.hubspot import (
     find_hubspot_deal_by_job_uuid,
     update_hubspot_deal,
-    CLOSED_WON_PIPELINE_ID,
-    CONSULT_VISIT_SCHEDULED_PIPELINE_ID,
 )
 
 
-load_dotenv()
-
-SERVICEM8_API_KEY = os.getenv("SERVICEM8_API_KEY")
-HUBSPOT_API_TOKEN = os.getenv("HUBSPOT_API_TOKEN")
-
+@memoize_per_event("job_activity")
+@traced
 def get_job_activity(uuid):
-    url = f"https://api.servicem8.com/api_1.0/jobactivity/{uuid}.json"
-    headers = {"accept": "application/json", "X-Api-Key": SERVICEM8_API_KEY}
     try:
-        response = requests.get(url, headers=headers)
+        response = servicem8.hedged_get(f"jobactivity/{uuid}.json")
         response.raise_for_status()
         return response.json()
     except Exception as e:
-        logging.error(f"Error fetching job activity: {e}")
+        logging.error("Error fetching job activity: %s", e)
+        return None
+
+
+def consult_visit_properties(job_activity, sm8_job):
+    """
+    Deal properties for a scheduled JobActivity, or None when the job's
+    status does not trigger a dealstage update.
+    """
+    dealstage_id = CONSULT_VISIT_STAGES.get(job_status(sm8_job))
+    if not dealstage_id:
         return None
 
+    return {
+        "consult_visit_date": format_sm8_date(job_activity.get("start_date")),
+        "dealstage": dealstage_id,
+    }
+
 
 def handle_job_activity(data):
     entry = data.get("entry", [{}])[0]
@@ -38,39 +46,29 @@ def handle_job_activity(data):
 
     job_activity = get_job_activity(job_activity_uuid)
     if not job_activity:
-        logging.error(f"Could not fetch JobActivity with uuid: {job_activity_uuid}")
+        logging.error("Could not fetch JobActivity with uuid: %s", job_activity_uuid)
         return
 
-    if str(job_activity.get("activity_was_scheduled")) == "1":
-        job_uuid = job_activity.get("job_uuid")
-        if not job_uuid:
-            logging.error("No job_uuid in JobActivity.")
-            return
+    if str(job_activity.get("activity_was_scheduled")) != "1":
+        return
 
-        sm8_job = get_job(job_uuid)
-        sm8_job_status = sm8_job.get("status", "").strip().lower()
+    job_uuid = job_activity.get("job_uuid")
+    if not job_uuid:
+        logging.error("No job_uuid in JobActivity.")
+        return
 
-        start_date_str = job_activity.get("start_date")
-        formatted_date = datetime.strptime(
-            start_date_str, "%Y-%m-%d %H:%M:%S"
-        ).strftime("%Y-%m-%d")
+    sm8_job = get_job(job_uuid)
+    if not sm8_job:
+        logging.error("Could not fetch Job with uuid: %s", job_uuid)
+        return
 
-        deal_id = find_hubspot_deal_by_job_uuid(job_uuid)
-        if deal_id:
-            if sm8_job_status == "work order":
-                dealstage_id = CLOSED_WON_PIPELINE_ID
-            elif sm8_job_status == "quote":
-                dealstage_id = CONSULT_VISIT_SCHEDULED_PIPELINE_ID
-            else:
-                logging.info(
-                    f"Job status '{sm8_job_status}' does not trigger a dealstage update."
-                )
-                return
+    properties_to_update = consult_visit_properties(job_activity, sm8_job)
+    if not properties_to_update:
+        logging.info("Job status '%s' does not trigger a dealstage update.", job_status(sm8_job))
+        return
 
-            properties_to_update = {
-                "consult_visit_date": formatted_date,
-                "dealstage": dealstage_id,
-            }
-            update_hubspot_deal(deal_id, properties_to_update)
-        else:
-            logging.warning(f"No HubSpot deal found with sm8_job_uuid = {job_uuid}")
+    deal_id = find_hubspot_deal_by_job_uuid(job_uuid)
+    if deal_id:
+        update_hubspot_deal(deal_id, properties_to_update)
+    else:
+        logging.warning("No HubSpot deal found with sm8_job_uuid = %s", job_uuid)
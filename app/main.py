@@ -1,13 +1,144 @@
 import logging
-from flask import Flask, request, jsonify
-from app.utility.worker import start_worker, queue
+from flask import Flask, Response, g, request, jsonify
+from app.utility import metrics
+from app.utility.worker import (
+    EMBEDDED_WORKER,
+    QUEUE_RETRY_AFTER,
+    enqueue,
+    enqueue_many,
+    lane_for,
+    overloaded_lanes,
+    queue,
+    shard_depths,
+    shard_for_key,
+    start_worker,
+)
 from app.handlers import webhook_handlers
+from app.utility.clients import circuit_stats, rate_limit_stats, warm_up_clients
+from app.utility.ledger import create_job_ledger
+from app.utility.persistent_queue import QueueUnavailable
+from app.utility.client_index import client_index, load_client_index_in_background
+from app.utility.rules import prefilter_stats
+from app.utility.tracing import new_event_id
+from app.utility.logs import Payload, configure_logging, reset_event_id, set_event_id
+from app.utility.hubspot import (
+    deal_id_cache,
+    deal_searches,
+    deal_snapshots,
+    deal_updates,
+    invalidate_deal_for_job,
+    invalidate_deal_snapshot,
+)
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 
-# Start background worker thread
-start_worker()
+# Start background worker threads, unless they run as separate processes
+# (python -m app.worker) and this process only ingests.
+if EMBEDDED_WORKER:
+    start_worker()
+    warm_up_clients()
+    load_client_index_in_background()
+
+# Existing stats, read when /metrics is scraped.
+metrics.Gauge(
+    "queue_depth", "Events waiting or in flight per shard.", ("shard",),
+    lambda: {(str(shard),): depth for shard, depth in enumerate(shard_depths())},
+)
+metrics.Gauge(
+    "queue_lane_depth", "Events waiting or in flight per priority lane.", ("lane",),
+    lambda: {(lane,): depth for lane, depth in queue.lane_depths().items()},
+)
+metrics.Gauge(
+    "queue_events", "Events accepted by this process, and how many were coalesced.", ("result",),
+    lambda: {("enqueued",): queue.enqueued, ("coalesced",): queue.coalesced},
+)
+metrics.Gauge(
+    "deal_cache", "Job uuid to deal id cache size and lookups.", ("stat",),
+    lambda: {(stat,): value for stat, value in deal_id_cache.stats().items()},
+)
+metrics.Gauge(
+    "deal_snapshots", "Deal property snapshot cache size and lookups.", ("stat",),
+    lambda: {(stat,): value for stat, value in deal_snapshots.stats().items()},
+)
+metrics.Gauge(
+    "rate_limiter", "Upstream token bucket state.", ("limiter", "stat"),
+    lambda: {
+        (name, stat): value
+        for name, stats in rate_limit_stats().items()
+        for stat, value in stats.items()
+    },
+)
+metrics.Gauge(
+    "client_index", "Contact to ServiceM8 client index size and lookups.", ("stat",),
+    lambda: {(stat,): value for stat, value in client_index.stats().items()},
+)
+metrics.Gauge(
+    "circuit_open", "1 while an upstream's circuit breaker is refusing calls.", ("upstream",),
+    lambda: {(name,): int(stats["state"] != "closed") for name, stats in circuit_stats().items()},
+)
+metrics.Gauge(
+    "dead_letters", "Events waiting in the dead-letter store.", ("object_type",),
+    lambda: {(object_type,): count for object_type, count in queue.dead_letter_counts().items()},
+)
+metrics.Gauge(
+    "batcher", "HubSpot micro-batcher submissions and flushed batches.", ("batcher", "stat"),
+    lambda: {
+        (batcher.name, stat): value
+        for batcher in (deal_searches, deal_updates)
+        for stat, value in batcher.stats().items()
+    },
+)
+
+
+# Routes that accept events. Each request gets its event id up front, so
+# every record it logs carries the id the queued events will have.
+INGEST_ENDPOINTS = {"webhook", "webhook_batch", "create_job", "create_job_batch"}
+
+
+@app.before_request
+def bind_event_id():
+    if request.endpoint in INGEST_ENDPOINTS:
+        g.event_id = new_event_id()
+        g.event_id_token = set_event_id(g.event_id)
+
+
+@app.teardown_request
+def unbind_event_id(error=None):
+    token = g.pop("event_id_token", None)
+    if token is not None:
+        reset_event_id(token)
+
+
+def queue_full(object_types):
+    """
+    A 503 with Retry-After when any of these events' lanes is at the
+    high-water mark, so the sender backs off instead of the queue growing
+    without bound. None when they can be queued.
+    """
+    lanes = overloaded_lanes(object_types)
+    if not lanes:
+        return None
+    for lane in lanes:
+        metrics.ingest_rejections.inc(lane)
+    logging.warning("Queue lanes %s are full, asking the sender to retry", ", ".join(lanes))
+    response = jsonify({"error": "Queue is full, retry later", "lanes": lanes})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(QUEUE_RETRY_AFTER)
+    return response
+
+
+@app.errorhandler(QueueUnavailable)
+def queue_unavailable(error):
+    """
+    The queue could not commit in time (e.g. its writer is stuck); ask the
+    sender to retry rather than hang or drop the event.
+    """
+    logging.error("Queue unavailable: %s", error)
+    response = jsonify({"error": "Queue unavailable, retry later"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(QUEUE_RETRY_AFTER)
+    return response
 
 
 @app.route("/webhook", methods=["POST"])
@@ -17,39 +148,230 @@ def webhook():
     if mode == "subscribe" and challenge:
         return challenge, 200
 
-    data = request.get_json()
+    data = request.get_json(silent=True)
     if not data:
         return jsonify({"error": "No JSON data provided"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object; use /webhook/batch for several events"}), 400
 
-    logging.info(f"Received webhook: {data}")
+    logging.info("Received webhook: %s", Payload(data))
 
     object_type = data.get("object")
-    handler = webhook_handlers.get(object_type)
-    if handler:
-        queue.put((handler, data))
-        logging.info(f"Queued handler for object type: {object_type}")
-        return jsonify({"status": "queued"}), 200
+    if object_type in webhook_handlers:
+        full = queue_full([object_type])
+        if full:
+            return full
+        event_id = g.event_id
+        shards = enqueue(object_type, data, event_id)
+        if not shards:
+            return jsonify({"status": "skipped", "queued": 0, "event_id": event_id}), 200
+        logging.info("Queued handler for object type: %s on shards %s as event %s", object_type, shards, event_id)
+        return jsonify({"status": "queued", "queued": len(shards), "event_id": event_id}), 200
     else:
-        logging.warning(f"No handler for object type: {object_type}")
+        logging.warning("No handler for object type: %s", object_type)
         return jsonify({"error": f"No handler for object type: {object_type}"}), 400
 
 
+@app.route("/webhook/batch", methods=["POST"])
+def webhook_batch():
+    """
+    Accept a JSON array of webhook bodies (or ``{"events": [...]}``) and
+    enqueue them in one commit. Events without a handler are reported back
+    by index; the rest are still queued.
+    """
+    data = request.get_json(silent=True)
+    events = data.get("events") if isinstance(data, dict) else data
+    if not isinstance(events, list) or not events:
+        return jsonify({"error": "Expected a JSON array of events"}), 400
+
+    accepted = []
+    rejected = []
+    for index, event in enumerate(events):
+        object_type = event.get("object") if isinstance(event, dict) else None
+        if object_type in webhook_handlers:
+            accepted.append((object_type, event))
+        else:
+            rejected.append({"index": index, "error": f"No handler for object type: {object_type}"})
+
+    # All or nothing, so the sender can simply retry the whole batch.
+    full = queue_full(object_type for object_type, _ in accepted)
+    if full:
+        return full
+    event_id = g.event_id
+    shards = enqueue_many(accepted, event_id) if accepted else []
+    logging.info(
+        "Queued %s events from a batch of %s as event %s, rejected %s",
+        len(shards), len(events), event_id, len(rejected),
+    )
+    status = 200 if accepted else 400
+    return jsonify({
+        "status": "queued" if accepted else "rejected",
+        "queued": len(shards),
+        "rejected": rejected,
+        "event_id": event_id,
+    }), status
+
+
 @app.route("/job/create", methods=["POST"])
 def create_job():
-    data = request.get_json()
+    data = request.get_json(silent=True)
     if not data:
         return jsonify({"error": "No JSON data provided"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object; use /job/create/batch for several deals"}), 400
 
-    logging.info(f"Received create_job request: {data}")
-    handler = webhook_handlers.get("CreateJob")
-    if handler:
-        queue.put((handler, data))
-        logging.info("Queued create_job handler")
-        return jsonify({"status": "job queued"}), 200
+    logging.info("Received create_job request: %s", Payload(data))
+    existing = create_job_ledger.get(data.get("deal_record_id")) if data.get("deal_record_id") else None
+    if existing and existing["status"] == "done":
+        logging.info("Job for deal %s already created: %s", existing["deal_id"], existing["job_uuid"])
+        return jsonify({"status": "job exists", "sm8_job_id": existing["job_uuid"]}), 200
+
+    if "CreateJob" in webhook_handlers:
+        full = queue_full(["CreateJob"])
+        if full:
+            return full
+        event_id = g.event_id
+        shards = enqueue("CreateJob", data, event_id)
+        if not shards:
+            return jsonify({"status": "skipped", "event_id": event_id}), 200
+        logging.info("Queued create_job handler on shards %s as event %s", shards, event_id)
+        return jsonify({"status": "job queued", "event_id": event_id}), 200
     else:
         logging.warning("No handler for create_job")
         return jsonify({"error": "No handler for create_job"}), 400
 
 
+@app.route("/job/create/batch", methods=["POST"])
+def create_job_batch():
+    """
+    Accept a JSON array of CreateJob bodies (or ``{"deals": [...]}``) and
+    enqueue them in one commit. Workers lease queued CreateJob events
+    together and read their deals, contacts and associations with batch
+    calls. Deals whose job already exists and bodies without a
+    ``deal_record_id`` are reported back by index.
+    """
+    data = request.get_json(silent=True)
+    deals = (data.get("deals") or data.get("events")) if isinstance(data, dict) else data
+    if not isinstance(deals, list) or not deals:
+        return jsonify({"error": "Expected a JSON array of deals"}), 400
+    if "CreateJob" not in webhook_handlers:
+        logging.warning("No handler for create_job")
+        return jsonify({"error": "No handler for create_job"}), 400
+
+    accepted = []
+    existing = []
+    rejected = []
+    for index, deal in enumerate(deals):
+        deal_id = deal.get("deal_record_id") if isinstance(deal, dict) else None
+        if not deal_id:
+            rejected.append({"index": index, "error": "No deal_record_id provided"})
+            continue
+        done = create_job_ledger.get(deal_id)
+        if done and done["status"] == "done":
+            existing.append({"index": index, "deal_record_id": deal_id, "sm8_job_id": done["job_uuid"]})
+        else:
+            accepted.append(("CreateJob", deal))
+
+    full = queue_full(["CreateJob"]) if accepted else None
+    if full:
+        return full
+    event_id = g.event_id
+    shards = enqueue_many(accepted, event_id) if accepted else []
+    logging.info(
+        "Queued %s create_job events from a batch of %s as event %s, %s exist, rejected %s",
+        len(shards), len(deals), event_id, len(existing), len(rejected),
+    )
+    status = 200 if accepted or existing else 400
+    return jsonify({
+        "status": "jobs queued" if accepted else "jobs exist" if existing else "rejected",
+        "queued": len(shards),
+        "existing": existing,
+        "rejected": rejected,
+        "event_id": event_id,
+    }), status
+
+
+@app.route("/queue/depth", methods=["GET"])
+def queue_depth():
+    depths = shard_depths()
+    return jsonify({
+        "total": sum(depths),
+        "shards": depths,
+        "lanes": queue.lane_depths(),
+        **queue.coalescing_stats(),
+    }), 200
+
+
+@app.route("/cache/deals", methods=["GET"])
+def deal_cache_stats():
+    return jsonify({**deal_id_cache.stats(), "snapshots": deal_snapshots.stats()}), 200
+
+
+@app.route("/cache/deals/invalidate", methods=["POST"])
+def invalidate_deal_cache():
+    """
+    Drop the job to deal link for ``job_uuid`` and the property snapshot of
+    ``deal_id`` (e.g. from a HubSpot deal property change webhook). With
+    neither, both caches are cleared.
+    """
+    data = request.get_json(silent=True) or {}
+    job_uuid = data.get("job_uuid")
+    deal_id = data.get("deal_id")
+    if job_uuid or not deal_id:
+        invalidate_deal_for_job(job_uuid)
+    if deal_id or not job_uuid:
+        invalidate_deal_snapshot(deal_id)
+    return jsonify({"status": "invalidated"}), 200
+
+
+@app.route("/rate-limits", methods=["GET"])
+def rate_limits():
+    return jsonify(rate_limit_stats()), 200
+
+
+@app.route("/prefilter", methods=["GET"])
+def prefilter_counts():
+    return jsonify(prefilter_stats()), 200
+
+
+@app.route("/circuits", methods=["GET"])
+def circuits():
+    return jsonify(circuit_stats()), 200
+
+
+@app.route("/dead-letters", methods=["GET"])
+def dead_letters():
+    limit = request.args.get("limit", default=100, type=int)
+    object_type = request.args.get("object_type")
+    return jsonify({
+        "counts": queue.dead_letter_counts(),
+        "dead_letters": queue.dead_letters(limit=limit, object_type=object_type),
+    }), 200
+
+
+@app.route("/dead-letters/replay", methods=["POST"])
+def replay_dead_letters():
+    """
+    Move dead letters back onto the queue: the given ``ids``, or up to
+    ``limit`` of ``object_type``. The workers then handle them at their
+    usual concurrency.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get("ids")
+    if ids is None:
+        selected = queue.dead_letters(limit=int(data.get("limit", 100)), object_type=data.get("object_type"))
+        ids = [dead_letter["id"] for dead_letter in selected]
+    requeued = queue.requeue_dead_letters(ids, shard_for_key, lane_for)
+    logging.info("Requeued %s dead letters", requeued)
+    return jsonify({"status": "requeued", "requeued": requeued}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    # No reloader: its parent and child would both import this module, start
+    # workers and recover the queue, releasing each other's leases.
+    app.run(debug=True, use_reloader=False)
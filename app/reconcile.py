@@ -0,0 +1,265 @@
+"""
+Bring HubSpot deals back in line with ServiceM8 after missed webhooks.
+
+    python -m app.reconcile [--since "2025-01-01 00:00:00"] [--dry-run]
+
+Jobs and job activities changed since the stored ``edit_date`` cursor are
+streamed page by page. For each page the linked deals are looked up in bulk,
+the properties each deal should have are computed with the same rules as the
+webhook handlers, and only the differences are written back with batch
+updates. Progress is checkpointed after every page, so an interrupted run
+resumes where it stopped.
+"""
+import os
+import json
+import logging
+import argparse
+from app.utility.clients import servicem8
+from app.utility.context import event_context
+from app.utility.logs import configure_logging
+from app.utility.hubspot import (
+    CLOSED_WON_PIPELINE_ID,
+    CONSULT_VISIT_SCHEDULED_PIPELINE_ID,
+    DEAL_PROPERTIES,
+    DEPOSIT_PAID_STAGE_ID,
+    QUOTE_ACCEPTED_PIPELINE_ID,
+    QUOTE_SENT_PIPELINE_ID,
+    batch_update_objects,
+    normalize_property,
+    search_deals_by_job_uuids,
+)
+from app.handlers.create_job import REQUIRED_DEAL_STAGE_ID
+from app.handlers.job import get_job, quote_accepted_properties, quote_sent_properties
+from app.handlers.job_activity import consult_visit_properties
+
+RECONCILE_CHECKPOINT_PATH = os.getenv("RECONCILE_CHECKPOINT_PATH", "data/reconcile.json")
+RECONCILE_DEFAULT_SINCE = os.getenv("RECONCILE_DEFAULT_SINCE", "1970-01-01 00:00:00")
+
+# Pipeline order of the stages the integration sets or moves deals on from.
+# Deposit Paid is set in HubSpot; the job then becomes a Work Order and the
+# deal moves on to Quote Accepted. A deal is only moved forward along it;
+# deals in any other stage keep their stage.
+STAGE_ORDER = [
+    REQUIRED_DEAL_STAGE_ID,
+    CONSULT_VISIT_SCHEDULED_PIPELINE_ID,
+    QUOTE_SENT_PIPELINE_ID,
+    DEPOSIT_PAID_STAGE_ID,
+    QUOTE_ACCEPTED_PIPELINE_ID,
+    CLOSED_WON_PIPELINE_ID,
+]
+
+
+def load_checkpoint(path=RECONCILE_CHECKPOINT_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(checkpoint, path=RECONCILE_CHECKPOINT_PATH):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def stream_records(resource, since, cursor=None, extra_filter=None):
+    """
+    Yield ``(records, next_cursor)`` pages of a ServiceM8 resource changed
+    at or after ``since``, following the ``x-next-cursor`` header. ``ge``,
+    not ``gt``: records sharing the last run's final ``edit_date`` may not
+    all have been seen.
+    """
+    record_filter = f"edit_date ge '{since}'"
+    if extra_filter:
+        record_filter = f"{record_filter} and {extra_filter}"
+    cursor = cursor or "-1"
+    while True:
+        response = servicem8.get(
+            f"{resource}.json", params={"$filter": record_filter, "cursor": cursor}
+        )
+        response.raise_for_status()
+        records = response.json()
+        next_cursor = response.headers.get("x-next-cursor")
+        yield records, next_cursor
+        if not records or not next_cursor:
+            return
+        cursor = next_cursor
+
+
+def merge_desired(current, new):
+    """
+    Combine two desired property sets for one deal, keeping the stage that is
+    furthest along the pipeline.
+    """
+    merged = {**current, **new}
+    stages = [props["dealstage"] for props in (current, new) if props.get("dealstage")]
+    if stages:
+        merged["dealstage"] = max(stages, key=STAGE_ORDER.index)
+    return merged
+
+
+def diff_deal(current, desired):
+    """
+    Properties of ``desired`` that differ from the deal's ``current`` values.
+    """
+    changes = {}
+    for name, value in desired.items():
+        if value is None:
+            continue
+        if name == "dealstage":
+            current_stage = current.get("dealstage")
+            if current_stage not in STAGE_ORDER:
+                continue
+            if STAGE_ORDER.index(value) <= STAGE_ORDER.index(current_stage):
+                continue
+        elif normalize_property(name, value) == normalize_property(name, current.get(name)):
+            continue
+        changes[name] = value
+    return changes
+
+
+def desired_from_jobs(jobs):
+    desired = {}
+    for job in jobs:
+        job_uuid = job.get("uuid")
+        if not job_uuid:
+            continue
+        for properties in (quote_sent_properties(job), quote_accepted_properties(job)):
+            if properties:
+                desired[job_uuid] = merge_desired(desired.get(job_uuid, {}), properties)
+    return desired
+
+
+def desired_from_activities(activities):
+    desired = {}
+    # One event context per page so jobs shared by several activities are
+    # fetched once.
+    with event_context():
+        for activity in activities:
+            if str(activity.get("activity_was_scheduled")) != "1":
+                continue
+            job_uuid = activity.get("job_uuid")
+            if not job_uuid:
+                continue
+            job = get_job(job_uuid)
+            if not job:
+                continue
+            properties = consult_visit_properties(activity, job)
+            if properties:
+                desired[job_uuid] = merge_desired(desired.get(job_uuid, {}), properties)
+    return desired
+
+
+def apply_desired(desired, dry_run=False):
+    """
+    Write the differences between ``desired`` (keyed by sm8 job uuid) and the
+    linked deals. Returns ``(deals_checked, deals_updated)``.
+    """
+    if not desired:
+        return 0, 0
+    deals = search_deals_by_job_uuids(list(desired), properties=DEAL_PROPERTIES)
+    updates = {}
+    for job_uuid, deal in deals.items():
+        changes = diff_deal(deal.get("properties", {}), desired[job_uuid])
+        if changes:
+            updates[deal["id"]] = changes
+
+    if dry_run:
+        for deal_id, changes in updates.items():
+            logging.info("[dry run] Would update deal %s with: %s", deal_id, changes)
+        return len(deals), len(updates)
+
+    results = batch_update_objects("deals", updates) if updates else {}
+    failed = [deal_id for deal_id, ok in results.items() if not ok]
+    if failed:
+        raise RuntimeError(f"Failed to update deals: {', '.join(failed)}")
+    return len(deals), len(updates)
+
+
+def reconcile_stream(name, resource, desired_for_page, checkpoint, since_override=None, extra_filter=None, dry_run=False):
+    state = checkpoint.setdefault(name, {})
+    if since_override:
+        state.update({"since": since_override, "cursor": None, "max_edit_date": None, "max_uuids": None, "boundary": None})
+    since = state.get("since") or RECONCILE_DEFAULT_SINCE
+    # Records at exactly ``since`` that an earlier run already reconciled.
+    boundary = set(state.get("boundary") or [])
+    max_edit_date = state.get("max_edit_date") or since
+    max_uuids = set(state.get("max_uuids") or (boundary if max_edit_date == since else []))
+    totals = {"records": 0, "deals_checked": 0, "deals_updated": 0}
+
+    if state.get("cursor"):
+        logging.info("Resuming %s reconciliation since %s from saved cursor", name, since)
+    for records, next_cursor in stream_records(resource, since, state.get("cursor"), extra_filter):
+        records = [
+            record for record in records
+            if not (record.get("edit_date") == since and record.get("uuid") in boundary)
+        ]
+        checked, updated = apply_desired(desired_for_page(records), dry_run=dry_run)
+        totals["records"] += len(records)
+        totals["deals_checked"] += checked
+        totals["deals_updated"] += updated
+        for record in records:
+            edit_date = record.get("edit_date") or since
+            if edit_date > max_edit_date:
+                max_edit_date, max_uuids = edit_date, set()
+            if edit_date == max_edit_date and record.get("uuid"):
+                max_uuids.add(record["uuid"])
+
+        if not dry_run:
+            state.update({
+                "since": since,
+                "cursor": next_cursor,
+                "max_edit_date": max_edit_date,
+                "max_uuids": sorted(max_uuids),
+            })
+            save_checkpoint(checkpoint)
+
+    if not dry_run:
+        state.update({
+            "since": max_edit_date,
+            "cursor": None,
+            "max_edit_date": None,
+            "max_uuids": None,
+            "boundary": sorted(max_uuids),
+        })
+        save_checkpoint(checkpoint)
+    logging.info(
+        "Reconciled %s: %s records, %s deals checked, %s updated",
+        name, totals["records"], totals["deals_checked"], totals["deals_updated"],
+    )
+    return totals
+
+
+def reconcile(since=None, dry_run=False):
+    checkpoint = load_checkpoint()
+    return {
+        "jobs": reconcile_stream("job", "job", desired_from_jobs, checkpoint, since, dry_run=dry_run),
+        "activities": reconcile_stream(
+            "activity",
+            "jobactivity",
+            desired_from_activities,
+            checkpoint,
+            since,
+            extra_filter="activity_was_scheduled eq '1'",
+            dry_run=dry_run,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile HubSpot deals with ServiceM8 jobs.")
+    parser.add_argument("--since", help="Override the stored edit_date cursor (YYYY-MM-DD HH:MM:SS).")
+    parser.add_argument("--dry-run", action="store_true", help="Log the changes without writing them.")
+    args = parser.parse_args()
+
+    configure_logging()
+    reconcile(since=args.since, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Replay dead-lettered webhook events once the upstream has recovered.
+
+    python -m app.replay [--object-type Job] [--limit 500] [--concurrency 8] [--requeue] [--dry-run]
+
+By default the events are handled in this process by a pool of
+``--concurrency`` threads. Dead letters for the same job or deal are replayed
+in order by one thread, and if one fails the later ones for that entity are
+left for the next run. Once an upstream's circuit opens again no new events
+are started. Replayed events are removed from the store; failed ones keep
+their place with the new reason and attempt count.
+
+``--requeue`` instead moves the dead letters back onto the worker queue,
+like ``POST /dead-letters/replay``.
+"""
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.utility.logs import configure_logging
+from app.utility.worker import handle_event, lane_for, queue, shard_for_key, upstreams_open
+
+
+def group_by_entity(dead_letters):
+    groups = {}
+    for dead_letter in dead_letters:
+        key = dead_letter["entity_key"] or f"dead-letter:{dead_letter['id']}"
+        groups.setdefault(key, []).append(dead_letter)
+    return list(groups.values())
+
+
+def replay_group(dead_letters, stop):
+    totals = {"replayed": 0, "failed": 0, "skipped": 0}
+    for index, dead_letter in enumerate(dead_letters):
+        if stop.is_set() or upstreams_open(dead_letter["object_type"]):
+            stop.set()
+            totals["skipped"] += len(dead_letters) - index
+            break
+        failure = handle_event(dead_letter["object_type"], dead_letter["data"])
+        if failure is None:
+            queue.remove_dead_letter(dead_letter["id"])
+            totals["replayed"] += 1
+            continue
+        queue.fail_dead_letter(dead_letter["id"], failure)
+        totals["failed"] += 1
+        # Later events for this entity must not overtake the failed one.
+        totals["skipped"] += len(dead_letters) - index - 1
+        break
+    return totals
+
+
+def replay(object_type=None, limit=1000, concurrency=8):
+    dead_letters = queue.dead_letters(limit=limit, object_type=object_type)
+    stop = threading.Event()
+    totals = {"replayed": 0, "failed": 0, "skipped": 0}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for result in pool.map(lambda group: replay_group(group, stop), group_by_entity(dead_letters)):
+            for name, value in result.items():
+                totals[name] += value
+    if stop.is_set():
+        logging.warning("An upstream circuit opened during the replay; the remaining dead letters were left in place.")
+    return totals
+
+
+def requeue(object_type=None, limit=1000):
+    dead_letters = queue.dead_letters(limit=limit, object_type=object_type)
+    return queue.requeue_dead_letters([dead_letter["id"] for dead_letter in dead_letters], shard_for_key, lane_for)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay dead-lettered webhook events.")
+    parser.add_argument("--object-type", help="Only replay events of this type.")
+    parser.add_argument("--limit", type=int, default=1000, help="Maximum number of dead letters to replay.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Events handled at the same time.")
+    parser.add_argument("--requeue", action="store_true", help="Move them back onto the worker queue instead.")
+    parser.add_argument("--dry-run", action="store_true", help="List the dead letters without replaying them.")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.dry_run:
+        for dead_letter in queue.dead_letters(limit=args.limit, object_type=args.object_type):
+            logging.info(
+                "[dry run] %s %s %s attempts=%s: %s",
+                dead_letter["id"], dead_letter["object_type"], dead_letter["entity_key"], dead_letter["attempts"],
+                dead_letter["reason"],
+            )
+        return
+    if args.requeue:
+        logging.info("Requeued %s dead letters", requeue(args.object_type, args.limit))
+        return
+    totals = replay(args.object_type, args.limit, args.concurrency)
+    logging.info(
+        "Replayed %s dead letters, %s failed again, %s left for later",
+        totals["replayed"], totals["failed"], totals["skipped"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Summarize a trace file written with TRACE_SAMPLE_RATE > 0.
+
+    python -m app.trace_report [data/traces.jsonl ...] [--top 10]
+
+With no paths TRACE_PATH, the per-process files of ``app.worker`` and their
+rotated backups are read. For
+every handler it prints how long events took and where that time went along
+the critical path: the chain of steps and HTTP calls the event actually
+waited on, so calls that ran alongside a longer one do not count. It then
+lists the slowest upstream endpoints.
+"""
+import json
+import argparse
+from app.utility.tracing import TRACE_PATH, trace_paths
+
+
+def read_spans(paths):
+    for path in paths:
+        with open(path) as trace_file:
+            for line in trace_file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def group_events(spans):
+    """
+    Spans by handling: a retried event is traced once per attempt, each with
+    its own root and span ids.
+    """
+    events = {}
+    for span in spans:
+        span["end_ms"] = span["start_ms"] + span["duration_ms"]
+        events.setdefault((span["event_id"], span.get("attempt")), []).append(span)
+    return events
+
+
+def critical_path(span, children, totals):
+    """
+    Add the time each span spent on the critical path below ``span`` to
+    ``totals``: walk back from its end through the child that finished last,
+    then the last one to finish before that child started, and so on. Gaps
+    between them are the span's own time.
+    """
+    name = self_name(span)
+    cursor = span["end_ms"]
+    for child in sorted(children.get(span["span_id"], ()), key=lambda child: child["end_ms"], reverse=True):
+        if child["end_ms"] > cursor:
+            continue
+        totals[name] = totals.get(name, 0.0) + cursor - child["end_ms"]
+        critical_path(child, children, totals)
+        cursor = child["start_ms"]
+    totals[name] = totals.get(name, 0.0) + max(0.0, cursor - span["start_ms"])
+
+
+def self_name(span):
+    return f"{span['name']} (handler)" if span["kind"] == "event" else span["name"]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(events):
+    handlers = {}
+    endpoints = {}
+    for spans in events.values():
+        root = next((span for span in spans if span["parent_id"] is None), None)
+        if root is None:
+            continue
+        children = {}
+        for span in spans:
+            if span["parent_id"] is not None:
+                children.setdefault(span["parent_id"], []).append(span)
+            if span["kind"] == "http":
+                endpoints.setdefault(span["name"], []).append(span["duration_ms"])
+        handler = handlers.setdefault(
+            root["name"], {"durations": [], "queue_waits": [], "failed": 0, "path": {}}
+        )
+        handler["durations"].append(root["duration_ms"])
+        handler["queue_waits"].append(root.get("queue_wait_ms", 0.0))
+        handler["failed"] += bool(root.get("failed"))
+        critical_path(root, children, handler["path"])
+    return handlers, endpoints
+
+
+def report(handlers, endpoints, top=10):
+    lines = []
+    for name, handler in sorted(handlers.items(), key=lambda item: -sum(item[1]["durations"])):
+        durations = handler["durations"]
+        total = sum(durations)
+        lines.append(
+            f"{name}: {len(durations)} events, {handler['failed']} failed, "
+            f"p50 {percentile(durations, 0.5):.1f} ms, p99 {percentile(durations, 0.99):.1f} ms, "
+            f"mean queue wait {sum(handler['queue_waits']) / len(durations):.1f} ms"
+        )
+        lines.append(f"  {'critical path':<60} {'ms/event':>10} {'share':>7}")
+        for step, spent in sorted(handler["path"].items(), key=lambda item: -item[1])[:top]:
+            share = spent / total if total else 0.0
+            lines.append(f"  {step:<60} {spent / len(durations):>10.1f} {share:>7.1%}")
+        lines.append("")
+
+    lines.append("Slowest endpoints (by p99)")
+    lines.append(f"  {'endpoint':<60} {'calls':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    ranked = sorted(endpoints.items(), key=lambda item: -percentile(item[1], 0.99))
+    for name, durations in ranked[:top]:
+        lines.append(
+            f"  {name:<60} {len(durations):>7} {percentile(durations, 0.5):>9.1f} "
+            f"{percentile(durations, 0.99):>9.1f} {max(durations):>9.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a webhook event trace file.")
+    parser.add_argument("paths", nargs="*", help="Trace files (default: every file under TRACE_PATH).")
+    parser.add_argument("--top", type=int, default=10, help="Rows to show per table.")
+    args = parser.parse_args()
+
+    paths = args.paths or trace_paths()
+    if not paths:
+        parser.error(f"No trace files found at {TRACE_PATH}")
+    handlers, endpoints = summarize(group_events(read_spans(paths)))
+    print(report(handlers, endpoints, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+asyncio versions of the ServiceM8 and HubSpot helpers used by the handlers.
+
+They mirror the blocking helpers in ``app.utility`` and ``app.handlers`` and
+share their caches, batchers and rate limiters; only the HTTP transport is
+different.
+"""
+import asyncio
+import logging
+from app.utility.clients import TIMEOUT_ERRORS, async_servicem8, async_hubspot
+from app.utility.context import forget, memoize_per_event, record_failure, record_timeout, time_left
+from app.utility.cache import MISSING
+from app.utility.client_index import client_index
+from app.utility.tracing import traced
+from app.utility.hubspot import (
+    CONTACT_PROPERTIES,
+    JOB_DEAL_PROPERTIES,
+    contact_updates,
+    deal_id_cache,
+    deal_searches,
+    deal_updates,
+    remember_deal_for_job,
+    remember_deals,
+    skip_unchanged,
+    too_late_to_batch,
+)
+
+
+async def batched(future):
+    """
+    Wait for a batcher future within the event's deadline. The future itself
+    is shielded: other events may be waiting on the same batch.
+    """
+    return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), time_left())
+
+
+async def batched_update(batcher, object_type, object_id, properties):
+    if too_late_to_batch(batcher, object_type, object_id):
+        return False
+    try:
+        updated = await batched(batcher.submit(object_id, properties))
+    except TIMEOUT_ERRORS as e:
+        logging.error("Timed out updating HubSpot %s %s: %r", object_type, object_id, e)
+        record_timeout("hubspot", f"update of {object_type} {object_id}: timed out")
+        return False
+    except Exception as e:
+        logging.error("Error updating HubSpot %s %s: %s", object_type, object_id, e)
+        updated = False
+    if not updated:
+        record_failure("hubspot", f"update of {object_type} {object_id}")
+    return updated
+
+
+@memoize_per_event("job")
+@traced
+async def get_job(uuid):
+    try:
+        response = await async_servicem8.hedged_get(f"job/{uuid}.json")
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        logging.error("Error fetching job: %s", e)
+        return None
+
+
+@memoize_per_event("job_activity")
+@traced
+async def get_job_activity(uuid):
+    try:
+        response = await async_servicem8.hedged_get(f"jobactivity/{uuid}.json")
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        logging.error("Error fetching job activity: %s", e)
+        return None
+
+
+@traced
+async def update_job_status_to_work_order(uuid):
+    payload = {"status": "Work Order"}
+
+    try:
+        response = await async_servicem8.post(f"job/{uuid}.json", json=payload)
+        response.raise_for_status()
+        forget("job", uuid)
+        logging.info("Successfully updated job %s to Work Order.", uuid)
+        return response.json()
+    except Exception as e:
+        logging.error("Error updating job %s to Work Order: %s", uuid, e)
+        return None
+
+
+@memoize_per_event("deal_id")
+@traced
+async def find_hubspot_deal_by_job_uuid(job_uuid):
+    deal_id = deal_id_cache.get(job_uuid)
+    if deal_id is not MISSING:
+        return deal_id
+
+    try:
+        deal_id = await batched(deal_searches.submit(job_uuid))
+        remember_deal_for_job(job_uuid, deal_id)
+        return deal_id
+    except Exception as e:
+        record = record_timeout if isinstance(e, TIMEOUT_ERRORS) else record_failure
+        record("hubspot", f"deal search for job {job_uuid}: {e!r}")
+        logging.error("Error searching HubSpot deal: %s", e)
+        return None
+
+
+@traced
+async def update_hubspot_deal(deal_id, properties_to_update):
+    changes = skip_unchanged(deal_id, properties_to_update)
+    if changes is None:
+        return True
+    return await batched_update(deal_updates, "deal", deal_id, changes)
+
+
+@traced
+async def get_associated_ids(from_object, from_id, to_object):
+    try:
+        resp = await async_hubspot.hedged_get(
+            f"crm/v4/objects/{from_object}/{from_id}/associations/{to_object}"
+        )
+        resp.raise_for_status()
+        results = resp.json().get("results", [])
+        return [item["toObjectId"] for item in results]
+    except Exception as e:
+        logging.error("Error getting associations from %s %s to %s: %s", from_object, from_id, to_object, e)
+        return []
+
+
+@traced
+async def get_objects_properties(object_type, object_ids, properties):
+    payload = {
+        "properties": properties,
+        "inputs": [{"id": obj_id} for obj_id in object_ids],
+    }
+    try:
+        resp = await async_hubspot.post(f"crm/v3/objects/{object_type}/batch/read", json=payload)
+        resp.raise_for_status()
+        results = resp.json().get("results", [])
+        if object_type == "deals":
+            remember_deals(results)
+        return results
+    except Exception as e:
+        logging.error("Error batch reading %s: %s", object_type, e)
+        return []
+
+
+@memoize_per_event("job_deal")
+async def get_job_deal(deal_id):
+    deals = await get_objects_properties("deals", [deal_id], JOB_DEAL_PROPERTIES)
+    return deals[0] if deals else None
+
+
+@memoize_per_event("deal_contact")
+@traced
+async def get_deal_details_with_associations(deal_id):
+    contact_ids = await get_associated_ids("deals", deal_id, "contacts")
+    if not contact_ids:
+        logging.warning("Aborting: No contacts associated with deal %s", deal_id)
+        return None
+
+    contacts = await get_objects_properties("contacts", [contact_ids[0]], CONTACT_PROPERTIES)
+
+    if not contacts:
+        logging.error("Aborting: Failed to fetch properties for objects associated with deal %s", deal_id)
+        return None
+
+    return {
+        "id": contacts[0].get("id"),
+        "contact": contacts[0].get("properties", {}),
+    }
+
+
+@traced
+async def create_servicem8_client(full_name):
+    try:
+        resp = await async_servicem8.post("company.json", json={"name": full_name})
+        resp.raise_for_status()
+        client_uuid = resp.headers.get("x-record-uuid")
+        await asyncio.to_thread(client_index.remember_company, full_name, client_uuid)
+        logging.info("Created ServiceM8 client UUID: %s", client_uuid)
+        return client_uuid
+    except Exception as e:
+        logging.error("Error creating ServiceM8 client: %s", e)
+        return None
+
+
+@traced
+async def update_hubspot_contact_sm8_client_id(contact_id, client_uuid):
+    if not await batched_update(contact_updates, "contact", contact_id, {"sm8_client_id": client_uuid}):
+        return False
+    await asyncio.to_thread(client_index.remember, contact_id, client_uuid)
+    return True
+
+
+@traced
+async def create_servicem8_job(job_data):
+    try:
+        resp = await async_servicem8.post("job.json", json=job_data)
+        resp.raise_for_status()
+        job_uuid = resp.headers.get("x-record-uuid")
+        logging.info("Created ServiceM8 Job UUID: %s", job_uuid)
+        return job_uuid
+    except Exception as e:
+        logging.error("Error creating ServiceM8 job: %s", e)
+        return None
+
+
+@traced
+async def create_servicem8_job_contact(job_uuid, contact):
+    contact_payload = {
+        "job_uuid": job_uuid,
+        "first": contact.get("firstname"),
+        "last": contact.get("lastname"),
+        "phone": contact.get("phone"),
+        "email": contact.get("email"),
+        "type": "JOB",
+        "is_primary_contact": 1,
+    }
+    try:
+        resp = await async_servicem8.post("jobcontact.json", json=contact_payload)
+        resp.raise_for_status()
+        logging.info("Created JobContact for job: %s", job_uuid)
+        return True
+    except Exception as e:
+        logging.error("Error creating JobContact: %s", e)
+        return False
+
+
+@traced
+async def update_hubspot_deal_sm8_job_id(deal_id, job_uuid):
+    if not await batched_update(deal_updates, "deal", deal_id, {"sm8_job_id": job_uuid}):
+        return False
+    remember_deal_for_job(job_uuid, deal_id)
+    return True
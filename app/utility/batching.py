@@ -0,0 +1,103 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Collects concurrent submissions for up to ``window`` seconds (or until
+    ``max_size`` distinct keys are waiting) and hands them to ``flush`` in one
+    call. Submissions for a key that is already waiting are folded together
+    with ``merge``; every submitter still gets its own future.
+
+    ``flush`` receives ``{key: value}`` and returns ``{key: result}``. Keys
+    missing from the returned dict resolve to ``default``.
+    """
+
+    def __init__(self, flush, window, max_size, merge=None, default=None, name="batcher"):
+        self.flush = flush
+        self.window = window
+        self.max_size = max_size
+        self.merge = merge
+        self.default = default
+        self.name = name
+        self.batches = 0
+        self.submissions = 0
+
+        self._pending = {}
+        self._first_at = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def submit(self, key, value=None):
+        future = Future()
+        if self.window <= 0:
+            # Batching disabled: flush this submission on the caller's thread.
+            self._resolve({key: value}, {key: [future]})
+            return future
+
+        with self._cond:
+            self._ensure_thread()
+            self.submissions += 1
+            if key in self._pending:
+                current, futures = self._pending[key]
+                if self.merge:
+                    value = self.merge(current, value)
+                futures.append(future)
+                self._pending[key] = (value, futures)
+            else:
+                self._pending[key] = (value, [future])
+                if self._first_at is None:
+                    self._first_at = time.monotonic()
+            self._cond.notify()
+        return future
+
+    def call(self, key, value=None, timeout=None):
+        return self.submit(key, value).result(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                while len(self._pending) < self.max_size:
+                    remaining = self._first_at + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending
+                self._pending = {}
+                self._first_at = None
+            self.batches += 1
+            self._resolve(
+                {key: value for key, (value, _) in batch.items()},
+                {key: futures for key, (_, futures) in batch.items()},
+            )
+
+    def _resolve(self, values, futures):
+        try:
+            results = self.flush(values)
+        except Exception as e:
+            logging.error("Error flushing %s batch of %s: %s", self.name, len(values), e)
+            for waiting in futures.values():
+                for future in waiting:
+                    future.set_exception(e)
+            return
+        for key, waiting in futures.items():
+            result = results.get(key, self.default)
+            for future in waiting:
+                future.set_result(result)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "submissions": self.submissions,
+                "batches": self.batches,
+            }
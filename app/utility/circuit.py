@@ -0,0 +1,132 @@
+import time
+import threading
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} circuit is open, retry in {retry_in:.1f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Fails calls to one upstream fast once it looks down.
+
+    After ``failure_threshold`` consecutive failures (connection errors and
+    5xx) the circuit opens and ``before_call()`` raises CircuitOpenError
+    without touching the network. After ``reset_timeout`` seconds a single
+    probe call is let through: success closes the circuit, failure opens it
+    for another ``reset_timeout``. A probe that ends any other way (429,
+    deadline, cancelled) is released with ``release_probe()`` so the next
+    call can probe; one that never reports back stops blocking after
+    ``probe_timeout`` seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold, reset_timeout, probe_timeout=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = reset_timeout if probe_timeout is None else probe_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.short_circuits = 0
+        self._opened_at = 0.0
+        # Id and start of the half-open probe in flight, if any.
+        self._probe = None
+        self._probe_started = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _probing(self):
+        return self._probe is not None and time.monotonic() - self._probe_started < self.probe_timeout
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError when calls are refused. Returns an id when this
+        call is the half-open probe, for ``release_probe`` once it finished;
+        otherwise None.
+        """
+        if self.state == self.CLOSED:
+            return None
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.short_circuits += 1
+                    raise CircuitOpenError(self.name, self._retry_in())
+                self.state = self.HALF_OPEN
+                self._probe = None
+            if self.state == self.HALF_OPEN:
+                if self._probing():
+                    self.short_circuits += 1
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self._probes += 1
+                self._probe = self._probes
+                self._probe_started = time.monotonic()
+                return self._probe
+            return None
+
+    def release_probe(self, probe):
+        """
+        Let the next call probe again when ``probe`` ended without recording
+        a success or failure. A no-op for None or a probe already settled.
+        """
+        if probe is None:
+            return
+        with self._lock:
+            if self._probe == probe:
+                self._probe = None
+
+    def record_success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opens += 1
+                self._opened_at = time.monotonic()
+                self._probe = None
+
+    def _retry_in(self):
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def is_open(self):
+        """
+        Whether calls are currently being refused (open, or half-open with the
+        probe already in flight).
+        """
+        if self.state == self.CLOSED:
+            return False
+        with self._lock:
+            if self.state == self.OPEN:
+                return self._retry_in() > 0
+            return self._probing()
+
+    def retry_in(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                return self._retry_in()
+            return 0.0 if self.state == self.CLOSED else self.reset_timeout
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opens": self.opens,
+                "short_circuits": self.short_circuits,
+            }
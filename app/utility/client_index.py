@@ -0,0 +1,188 @@
+import os
+import re
+import time
+import logging
+import threading
+from app.utility.clients import hubspot, servicem8
+from app.utility.db import connect
+
+# Fill the index from HubSpot (and ServiceM8 company names) at startup.
+CLIENT_INDEX_BULK_LOAD = os.getenv("CLIENT_INDEX_BULK_LOAD", "false").lower() in ("1", "true", "yes")
+# Reuse an existing ServiceM8 company whose normalized name matches the
+# contact's exactly once. Off by default: two customers can share a name.
+CLIENT_NAME_MATCH = os.getenv("CLIENT_NAME_MATCH", "false").lower() in ("1", "true", "yes")
+CLIENT_INDEX_PAGE_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contact_clients (
+    contact_id TEXT PRIMARY KEY,
+    client_uuid TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS company_names (
+    normalized_name TEXT NOT NULL,
+    client_uuid TEXT NOT NULL,
+    PRIMARY KEY (normalized_name, client_uuid)
+);
+"""
+
+
+def normalize_name(name):
+    """
+    Lower-case, drop punctuation and collapse whitespace, so
+    ``"  O'Brien,  Pat "`` and ``"obrien pat"`` compare equal.
+    """
+    name = re.sub(r"[^\w\s]", "", (name or "").lower())
+    return " ".join(name.split())
+
+
+class ClientIndex:
+    """
+    HubSpot contact id -> ServiceM8 client uuid, kept in the state database.
+
+    Written through whenever a contact is linked to a client, and
+    optionally bulk-loaded from HubSpot at startup, so CreateJob can reuse a
+    contact's client even before HubSpot shows the ``sm8_client_id``. It
+    also indexes ServiceM8 company names for the optional name match.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def lookup(self, contact_id):
+        if not contact_id:
+            return None
+        row = self._conn().execute(
+            "SELECT client_uuid FROM contact_clients WHERE contact_id = ?", (str(contact_id),)
+        ).fetchone()
+        if row:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def remember(self, contact_id, client_uuid):
+        self.remember_many([(contact_id, client_uuid)])
+
+    def remember_many(self, pairs):
+        now = time.time()
+        rows = [(str(contact_id), client_uuid, now) for contact_id, client_uuid in pairs if contact_id and client_uuid]
+        if rows:
+            self._conn().executemany(
+                "INSERT OR REPLACE INTO contact_clients (contact_id, client_uuid, updated_at) VALUES (?, ?, ?)",
+                rows,
+            )
+
+    def remember_company(self, name, client_uuid):
+        self.remember_companies([(name, client_uuid)])
+
+    def remember_companies(self, pairs):
+        rows = [(normalize_name(name), client_uuid) for name, client_uuid in pairs if normalize_name(name) and client_uuid]
+        if rows:
+            self._conn().executemany(
+                "INSERT OR IGNORE INTO company_names (normalized_name, client_uuid) VALUES (?, ?)", rows
+            )
+
+    def find_by_name(self, name):
+        """
+        The uuid of the only ServiceM8 company with this normalized name;
+        None when there is no match or more than one.
+        """
+        normalized = normalize_name(name)
+        if not normalized:
+            return None
+        rows = self._conn().execute(
+            "SELECT client_uuid FROM company_names WHERE normalized_name = ? LIMIT 2", (normalized,)
+        ).fetchall()
+        return rows[0][0] if len(rows) == 1 else None
+
+    def find_client(self, contact_id, name):
+        """
+        An existing client for the contact: from the contact index, then (if
+        enabled) by company name. Makes no API calls.
+        """
+        client_uuid = self.lookup(contact_id)
+        if not client_uuid and CLIENT_NAME_MATCH:
+            client_uuid = self.find_by_name(name)
+            if client_uuid:
+                logging.info("Reusing ServiceM8 client %s matched by name '%s'", client_uuid, name)
+        return client_uuid
+
+    def load_contacts_from_hubspot(self):
+        """
+        Index every HubSpot contact that has an ``sm8_client_id``. Pages by
+        ascending object id rather than ``after``, which stops at 10,000
+        search results.
+        """
+        loaded = 0
+        last_id = "0"
+        while True:
+            payload = {
+                "filterGroups": [{
+                    "filters": [
+                        {"propertyName": "sm8_client_id", "operator": "HAS_PROPERTY"},
+                        {"propertyName": "hs_object_id", "operator": "GT", "value": last_id},
+                    ]
+                }],
+                "sorts": [{"propertyName": "hs_object_id", "direction": "ASCENDING"}],
+                "properties": ["sm8_client_id"],
+                "limit": CLIENT_INDEX_PAGE_SIZE,
+            }
+            response = hubspot.post("crm/v3/objects/contacts/search", json=payload)
+            response.raise_for_status()
+            results = response.json().get("results", [])
+            self.remember_many(
+                (contact["id"], contact.get("properties", {}).get("sm8_client_id")) for contact in results
+            )
+            loaded += len(results)
+            if len(results) < CLIENT_INDEX_PAGE_SIZE:
+                return loaded
+            last_id = str(results[-1]["id"])
+
+    def load_companies_from_servicem8(self):
+        loaded = 0
+        cursor = "-1"
+        while True:
+            response = servicem8.get("company.json", params={"$filter": "active eq 1", "cursor": cursor})
+            response.raise_for_status()
+            companies = response.json()
+            self.remember_companies((company.get("name"), company.get("uuid")) for company in companies)
+            loaded += len(companies)
+            cursor = response.headers.get("x-next-cursor")
+            if not companies or not cursor:
+                return loaded
+
+    def bulk_load(self):
+        try:
+            contacts = self.load_contacts_from_hubspot()
+            companies = self.load_companies_from_servicem8() if CLIENT_NAME_MATCH else 0
+            logging.info("Client index loaded %s HubSpot contacts and %s ServiceM8 companies", contacts, companies)
+        except Exception as e:
+            logging.error("Error bulk loading the client index: %s", e)
+
+    def stats(self):
+        conn = self._conn()
+        return {
+            "contacts": conn.execute("SELECT COUNT(*) FROM contact_clients").fetchone()[0],
+            "company_names": conn.execute("SELECT COUNT(*) FROM company_names").fetchone()[0],
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+client_index = ClientIndex()
+
+
+def load_client_index_in_background():
+    if CLIENT_INDEX_BULK_LOAD:
+        threading.Thread(target=client_index.bulk_load, name="client-index-load", daemon=True).start()
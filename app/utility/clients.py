@@ -0,0 +1,489 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+import httpx
+import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from app.utility.ratelimit import TokenBucket, retry_delay
+from app.utility.circuit import CircuitBreaker
+from app.utility.context import (
+    DeadlineExceeded,
+    current_event,
+    record_failure,
+    record_timeout,
+    time_left,
+    use_context,
+)
+from app.utility.metrics import endpoint_label, http_hedges, http_timeouts, record_http
+from app.utility.tracing import is_tracing, record_span
+
+load_dotenv()
+
+SERVICEM8_API_KEY = os.getenv("SERVICEM8_API_KEY")
+HUBSPOT_API_TOKEN = os.getenv("HUBSPOT_API_TOKEN")
+
+SERVICEM8_BASE_URL = os.getenv("SERVICEM8_BASE_URL", "https://api.servicem8.com/api_1.0")
+HUBSPOT_BASE_URL = os.getenv("HUBSPOT_BASE_URL", "https://api.hubapi.com")
+
+# One pooled connection per thread that can handle an event by default: each
+# worker runs up to EVENT_BATCH_SIZE batched events side by side. python -m
+# app.worker sets it for the shards each of its processes runs.
+HTTP_POOL_SIZE = int(
+    os.getenv("HTTP_POOL_SIZE")
+    or int(os.getenv("WORKER_COUNT", "4")) * max(1, int(os.getenv("EVENT_BATCH_SIZE", "20")))
+)
+HTTP_WARM_UP = os.getenv("HTTP_WARM_UP", "false").lower() in ("1", "true", "yes")
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+# The asyncio engine keeps many more requests in flight than there are workers.
+ASYNC_HTTP_POOL_SIZE = int(os.getenv("ASYNC_HTTP_POOL_SIZE", "100"))
+
+# Seconds to wait for a connection and, once connected, between bytes of the
+# response. Calls made while handling an event are also cut short to fit in
+# what is left of the event's deadline (EVENT_DEADLINE).
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+# Idempotent reads still unanswered after this many milliseconds are sent a
+# second time and the first answer wins. 0 disables hedging.
+HTTP_HEDGE_AFTER_MS = float(os.getenv("HTTP_HEDGE_AFTER_MS", "0"))
+
+# Errors that mean a call ran out of time rather than failed.
+TIMEOUT_ERRORS = (TimeoutError, requests.Timeout, httpx.TimeoutException)
+
+# Request budgets. HubSpot private apps get 100 requests per 10 seconds (more
+# on higher tiers) and the CRM search endpoint is limited separately to about
+# 5 requests per second. ServiceM8 allows 180 requests per minute.
+HUBSPOT_RATE_LIMIT = int(os.getenv("HUBSPOT_RATE_LIMIT", "100"))
+HUBSPOT_RATE_PERIOD = float(os.getenv("HUBSPOT_RATE_PERIOD", "10"))
+HUBSPOT_SEARCH_RATE_LIMIT = int(os.getenv("HUBSPOT_SEARCH_RATE_LIMIT", "5"))
+SERVICEM8_RATE_LIMIT = int(os.getenv("SERVICEM8_RATE_LIMIT", "180"))
+SERVICEM8_RATE_PERIOD = float(os.getenv("SERVICEM8_RATE_PERIOD", "60"))
+# Processes that call the upstreams side by side, each with its own buckets.
+# python -m app.worker sets it, so every process keeps 1/shares of each
+# budget above and together they stay within it.
+UPSTREAM_BUDGET_SHARES = max(1, int(os.getenv("UPSTREAM_BUDGET_SHARES", "1")))
+
+# Consecutive connection errors/5xx before an upstream's circuit opens, and
+# how long it stays open before a probe call is let through.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# A half-open probe that has not reported back after this long no longer
+# keeps other calls out.
+CIRCUIT_PROBE_TIMEOUT = float(
+    os.getenv("CIRCUIT_PROBE_TIMEOUT") or HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT
+)
+
+
+def usable(result):
+    # A hedged attempt's (response, error, branch) that can be handed back.
+    response, error, _ = result
+    return error is None and response.status_code < 500
+
+
+class ApiClient:
+    """
+    Keep-alive session for one upstream API. The session (and its connection
+    pool) is shared by every worker, so calls reuse established TCP+TLS
+    connections instead of paying a new handshake each time.
+
+    Every request first takes a token from the API's shared limiter. A 429 is
+    retried after the upstream's Retry-After (or a jittered backoff), and the
+    limiter slows every worker down so the budget is not exceeded again.
+
+    The API's circuit breaker refuses calls while the upstream is down.
+    Failed calls are recorded on the current event so the worker can retry,
+    park or dead-letter it.
+
+    Every attempt has connect and read timeouts, capped by the current
+    event's deadline; once that has passed no further call is started.
+    """
+
+    name = "api"
+
+    def __init__(self, base_url, headers, limiter, breaker, pool_size=HTTP_POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.headers = headers
+        self.limiter = limiter
+        self.breaker = breaker
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._hedge_pool = None
+
+    def url(self, path):
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def limiters_for(self, path):
+        return (self.limiter,)
+
+    def before_attempt(self, method, path):
+        """
+        Check the circuit; returns the probe id to release after the attempt.
+        """
+        try:
+            return self.breaker.before_call()
+        except Exception as e:
+            record_failure(self.name, f"{method} {path}: {e}")
+            raise
+
+    def reserve_limiters(self, limiters, method, path):
+        """
+        Take a token from each of ``limiters`` and return how long to wait
+        before the call. Raises DeadlineExceeded, taking nothing, when that
+        wait would outlast the event's deadline.
+        """
+        remaining = time_left()
+        delays = []
+        for limiter in limiters:
+            delay = limiter.reserve(max_wait=remaining)
+            if delay is None:
+                for taken in limiters[:len(delays)]:
+                    taken.release()
+                reason = f"{method} {path}: rate limit wait exceeds the event deadline"
+                record_timeout(self.name, reason)
+                raise DeadlineExceeded(reason)
+            delays.append(delay)
+        return max(delays, default=0.0)
+
+    def attempt_timeout(self, method, path):
+        """
+        ``(connect, read)`` timeouts for the next attempt, cut down to what is
+        left of the event's deadline. Raises DeadlineExceeded when nothing is.
+        """
+        remaining = time_left()
+        if remaining is None:
+            return HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+        if remaining <= 0:
+            reason = f"{method} {path}: event deadline exceeded"
+            record_timeout(self.name, reason)
+            raise DeadlineExceeded(reason)
+        return min(HTTP_CONNECT_TIMEOUT, remaining), min(HTTP_READ_TIMEOUT, remaining)
+
+    def after_attempt(self, method, path, started, response=None, error=None):
+        ended = time.perf_counter()
+        status = "error" if error is not None else response.status_code
+        record_http(self.name, method, path, started, ended, status)
+        if is_tracing():
+            record_span(f"{self.name} {method} {endpoint_label(path)}", "http", started, ended, status=status)
+        if error is not None or response.status_code >= 500:
+            self.breaker.record_failure()
+            reason = f"{method} {path}: {error if error is not None else f'HTTP {response.status_code}'}"
+            if isinstance(error, TIMEOUT_ERRORS):
+                http_timeouts.inc(self.name)
+                record_timeout(self.name, reason)
+            else:
+                record_failure(self.name, reason)
+        elif response.status_code != 429:
+            self.breaker.record_success()
+
+    def request(self, method, path, **kwargs):
+        limiters = self.limiters_for(path)
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            probe = self.before_attempt(method, path)
+            try:
+                delay = self.reserve_limiters(limiters, method, path)
+                if delay > 0:
+                    time.sleep(delay)
+                timeout = self.attempt_timeout(method, path)
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, self.url(path), timeout=timeout, **kwargs)
+                except Exception as e:
+                    self.after_attempt(method, path, started, error=e)
+                    raise
+                self.after_attempt(method, path, started, response)
+            finally:
+                # A 429, a passed deadline or an error before the call leave
+                # the probe unrecorded; the next call may probe again.
+                self.breaker.release_probe(probe)
+            if response.status_code != 429:
+                for limiter in limiters:
+                    limiter.succeeded()
+                return response
+            delay = retry_delay(response, attempt)
+            for limiter in limiters:
+                limiter.throttle(delay)
+            if attempt == HTTP_MAX_RETRIES:
+                break
+            logging.warning(
+                "%s %s rate limited, retrying in %.2fs (attempt %s/%s)",
+                method, path, delay, attempt + 1, HTTP_MAX_RETRIES,
+            )
+        record_failure(self.name, f"{method} {path}: still rate limited after {HTTP_MAX_RETRIES} retries")
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def hedging(self):
+        # A second request to an upstream that is already failing only adds load.
+        return HTTP_HEDGE_AFTER_MS > 0 and self.breaker.state == CircuitBreaker.CLOSED
+
+    @property
+    def hedge_pool(self):
+        if self._hedge_pool is None:
+            self._hedge_pool = ThreadPoolExecutor(
+                max_workers=2 * self.pool_size, thread_name_prefix=f"{self.name}-hedge"
+            )
+        return self._hedge_pool
+
+    def hedged_get(self, path, **kwargs):
+        """
+        GET for idempotent reads. When no answer has arrived after
+        HTTP_HEDGE_AFTER_MS a second request is sent, and the first attempt
+        to come back with a usable response wins. The other one is left to
+        finish on its own and its failures are not recorded on the event.
+        """
+        if not self.hedging():
+            return self.get(path, **kwargs)
+        parent = current_event()
+
+        def attempt():
+            with use_context(parent.branch() if parent else None) as branch:
+                try:
+                    return self.get(path, **kwargs), None, branch
+                except Exception as e:
+                    return None, e, branch
+
+        attempts = [self.hedge_pool.submit(contextvars.copy_context().run, attempt)]
+        done, _ = wait(attempts, timeout=HTTP_HEDGE_AFTER_MS / 1000)
+        if not done:
+            http_hedges.inc(self.name, "sent")
+            attempts.append(self.hedge_pool.submit(contextvars.copy_context().run, attempt))
+
+        results = {}
+        pending = set(attempts)
+        while pending and not any(usable(result) for result in results.values()):
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[attempts.index(future)] = future.result()
+        return self.hedge_result(parent, results)
+
+    def hedge_result(self, parent, results):
+        """
+        The winner among finished hedged attempts (``{index: (response,
+        error, branch)}``): the first usable response, else the first attempt.
+        """
+        index = next((index for index, result in sorted(results.items()) if usable(result)), min(results))
+        if index:
+            http_hedges.inc(self.name, "won")
+        response, error, branch = results[index]
+        if parent is not None:
+            parent.merge(branch)
+        if error is not None:
+            raise error
+        return response
+
+    def warm_up(self, connections=None):
+        """
+        Open up to ``connections`` pooled connections ahead of the first event.
+        The HEAD requests run concurrently so each one takes its own socket.
+        """
+        connections = min(connections or self.pool_size, self.pool_size)
+
+        def touch(_):
+            try:
+                self.session.head(self.base_url, timeout=5)
+            except Exception as e:
+                logging.warning("Warm-up request to %s failed: %s", self.base_url, e)
+
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            list(pool.map(touch, range(connections)))
+
+
+servicem8_limiter = TokenBucket(
+    "servicem8", SERVICEM8_RATE_LIMIT / UPSTREAM_BUDGET_SHARES, SERVICEM8_RATE_PERIOD
+)
+hubspot_limiter = TokenBucket("hubspot", HUBSPOT_RATE_LIMIT / UPSTREAM_BUDGET_SHARES, HUBSPOT_RATE_PERIOD)
+hubspot_search_limiter = TokenBucket("hubspot_search", HUBSPOT_SEARCH_RATE_LIMIT / UPSTREAM_BUDGET_SHARES, 1)
+servicem8_breaker = CircuitBreaker(
+    "servicem8", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_PROBE_TIMEOUT
+)
+hubspot_breaker = CircuitBreaker("hubspot", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_PROBE_TIMEOUT)
+breakers = {breaker.name: breaker for breaker in (servicem8_breaker, hubspot_breaker)}
+
+
+class ServiceM8Client(ApiClient):
+    name = "servicem8"
+
+    def __init__(
+        self,
+        api_key=SERVICEM8_API_KEY,
+        base_url=SERVICEM8_BASE_URL,
+        limiter=servicem8_limiter,
+        breaker=servicem8_breaker,
+        **kwargs,
+    ):
+        headers = {"accept": "application/json"}
+        if api_key:
+            headers["X-Api-Key"] = api_key
+        super().__init__(base_url, headers, limiter, breaker, **kwargs)
+
+
+class HubSpotClient(ApiClient):
+    name = "hubspot"
+
+    def __init__(
+        self,
+        api_token=HUBSPOT_API_TOKEN,
+        base_url=HUBSPOT_BASE_URL,
+        limiter=hubspot_limiter,
+        search_limiter=hubspot_search_limiter,
+        breaker=hubspot_breaker,
+        **kwargs,
+    ):
+        headers = {"accept": "application/json"}
+        if api_token:
+            headers["Authorization"] = f"Bearer {api_token}"
+        self.search_limiter = search_limiter
+        super().__init__(base_url, headers, limiter, breaker, **kwargs)
+
+    def limiters_for(self, path):
+        if path.endswith("/search"):
+            return (self.limiter, self.search_limiter)
+        return (self.limiter,)
+
+
+class AsyncApiClient:
+    """
+    asyncio counterpart of an ApiClient. It shares the sync client's base URL,
+    headers and rate limiters, so both engines draw from the same budget.
+    The httpx client is created lazily inside the running event loop.
+    """
+
+    def __init__(self, client, pool_size=ASYNC_HTTP_POOL_SIZE):
+        self.client = client
+        self.pool_size = pool_size
+        self._http = None
+
+    @property
+    def http(self):
+        if self._http is None:
+            limits = httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            )
+            self._http = httpx.AsyncClient(headers=self.client.headers, limits=limits)
+        return self._http
+
+    async def request(self, method, path, **kwargs):
+        limiters = self.client.limiters_for(path)
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            probe = self.client.before_attempt(method, path)
+            try:
+                delay = self.client.reserve_limiters(limiters, method, path)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                connect, read = self.client.attempt_timeout(method, path)
+                started = time.perf_counter()
+                try:
+                    response = await self.http.request(
+                        method, self.client.url(path), timeout=httpx.Timeout(read, connect=connect), **kwargs
+                    )
+                except Exception as e:
+                    self.client.after_attempt(method, path, started, error=e)
+                    raise
+                self.client.after_attempt(method, path, started, response)
+            finally:
+                # Also runs when a losing hedge is cancelled.
+                self.client.breaker.release_probe(probe)
+            if response.status_code != 429:
+                for limiter in limiters:
+                    limiter.succeeded()
+                return response
+            delay = retry_delay(response, attempt)
+            for limiter in limiters:
+                limiter.throttle(delay)
+            if attempt == HTTP_MAX_RETRIES:
+                break
+            logging.warning(
+                "%s %s rate limited, retrying in %.2fs (attempt %s/%s)",
+                method, path, delay, attempt + 1, HTTP_MAX_RETRIES,
+            )
+        record_failure(self.client.name, f"{method} {path}: still rate limited after {HTTP_MAX_RETRIES} retries")
+        return response
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def patch(self, path, **kwargs):
+        return await self.request("PATCH", path, **kwargs)
+
+    async def hedged_get(self, path, **kwargs):
+        """
+        asyncio version of ``ApiClient.hedged_get``; the losing attempt is
+        cancelled.
+        """
+        if not self.client.hedging():
+            return await self.get(path, **kwargs)
+        parent = current_event()
+
+        async def attempt():
+            with use_context(parent.branch() if parent else None) as branch:
+                try:
+                    return await self.get(path, **kwargs), None, branch
+                except Exception as e:
+                    return None, e, branch
+
+        attempts = [asyncio.ensure_future(attempt())]
+        done, _ = await asyncio.wait(attempts, timeout=HTTP_HEDGE_AFTER_MS / 1000)
+        if not done:
+            http_hedges.inc(self.client.name, "sent")
+            attempts.append(asyncio.ensure_future(attempt()))
+
+        results = {}
+        pending = set(attempts)
+        try:
+            while pending and not any(usable(result) for result in results.values()):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results[attempts.index(task)] = task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        return self.client.hedge_result(parent, results)
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+servicem8 = ServiceM8Client()
+hubspot = HubSpotClient()
+async_servicem8 = AsyncApiClient(servicem8)
+async_hubspot = AsyncApiClient(hubspot)
+
+
+def rate_limit_stats():
+    return {
+        limiter.name: limiter.stats()
+        for limiter in (servicem8_limiter, hubspot_limiter, hubspot_search_limiter)
+    }
+
+
+def circuit_stats():
+    return {name: breaker.stats() for name, breaker in breakers.items()}
+
+
+def warm_up_clients():
+    if not HTTP_WARM_UP:
+        return
+    for client in (servicem8, hubspot):
+        client.warm_up()
+    logging.info("Warmed up ServiceM8 and HubSpot connection pools")
@@ -0,0 +1,172 @@
+import time
+import asyncio
+import inspect
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+_current_event = contextvars.ContextVar("current_event", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised instead of starting a call once the event's time budget is spent.
+    """
+
+
+class EventContext:
+    """
+    State that lives for the handling of one queued event.
+
+    ``failures`` collects ``(upstream, reason)`` for calls that failed while
+    handling it. The helpers log and swallow their errors, so this is how
+    the worker learns that the event did not go through. ``trace`` holds the
+    event's spans when it is sampled for tracing.
+
+    ``deadline`` is the ``time.monotonic()`` by which the event must be done;
+    every outbound call is cut short to fit in what is left of it.
+    ``timed_out`` is set when a call hit its timeout or the deadline.
+    """
+
+    def __init__(self, budget=None):
+        self.memo = {}
+        self.failures = []
+        self.trace = None
+        self.deadline = time.monotonic() + budget if budget else None
+        self.timed_out = False
+
+    def branch(self):
+        """
+        A context for one of several racing attempts at the same call. It
+        shares the memo, trace and deadline but keeps its own failures, so
+        only the attempt that is used reports them.
+        """
+        branch = EventContext()
+        branch.memo = self.memo
+        branch.trace = self.trace
+        branch.deadline = self.deadline
+        return branch
+
+    def merge(self, branch):
+        self.failures.extend(branch.failures)
+        self.timed_out = self.timed_out or branch.timed_out
+
+
+@contextmanager
+def event_context(budget=None):
+    context = EventContext(budget)
+    token = _current_event.set(context)
+    try:
+        yield context
+    finally:
+        _current_event.reset(token)
+
+
+@contextmanager
+def use_context(context):
+    token = _current_event.set(context)
+    try:
+        yield context
+    finally:
+        _current_event.reset(token)
+
+
+def current_event():
+    return _current_event.get()
+
+
+def record_failure(upstream, reason):
+    context = _current_event.get()
+    if context is not None:
+        context.failures.append((upstream, reason))
+
+
+def record_timeout(upstream, reason):
+    """
+    Record a failed call that ran out of time, so the event is counted as
+    timed out when it is settled.
+    """
+    context = _current_event.get()
+    if context is not None:
+        context.failures.append((upstream, reason))
+        context.timed_out = True
+
+
+def time_left():
+    """
+    Seconds left in the current event's budget, or None without a deadline.
+    """
+    context = _current_event.get()
+    if context is None or context.deadline is None:
+        return None
+    return context.deadline - time.monotonic()
+
+
+def memoize_per_event(kind):
+    """
+    Reuse the result of a record fetch for the rest of the current event, so
+    handlers that look at the same job or deal share one network call.
+    Failed fetches (None) are not remembered. Outside an event context the
+    function is called as usual.
+
+    Coroutine functions are supported too: concurrent awaits of the same
+    record within one event share a single in-flight task. They also reuse a
+    result the blocking version remembered or a batch read seeded.
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            return _memoize_async(kind, func)
+
+        @wraps(func)
+        def wrapper(*args):
+            context = _current_event.get()
+            if context is None:
+                return func(*args)
+            key = memo_key(kind, *args)
+            if key in context.memo:
+                return context.memo[key]
+            result = func(*args)
+            if result is not None:
+                context.memo[key] = result
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _memoize_async(kind, func):
+    @wraps(func)
+    async def wrapper(*args):
+        context = _current_event.get()
+        if context is None:
+            return await func(*args)
+        if memo_key(kind, *args) in context.memo:
+            return context.memo[memo_key(kind, *args)]
+        key = ("async", kind, args)
+        task = context.memo.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            context.memo[key] = task
+        result = await task
+        if result is None and context.memo.get(key) is task:
+            del context.memo[key]
+        return result
+
+    return wrapper
+
+
+def memo_key(kind, *args):
+    """
+    Where ``memoize_per_event`` keeps a result, e.g. to seed an event's memo
+    with what a batch read already fetched.
+    """
+    return (kind, args)
+
+
+def forget(kind, *args):
+    context = _current_event.get()
+    if context is not None:
+        context.memo.pop(memo_key(kind, *args), None)
+        context.memo.pop(("async", kind, args), None)
@@ -1,84 +1,63 @@
-import os
 import logging
-import requests
-
-
-SERVICEM8_API_KEY = os.getenv("SERVICEM8_API_KEY")
-HUBSPOT_API_TOKEN = os.getenv("HUBSPOT_API_TOKEN")
+from app.utility.clients import servicem8, hubspot
+from app.utility.hubspot import batched_update, contact_updates, deal_updates, remember_deal_for_job
+from app.utility.client_index import client_index
+from app.utility.tracing import traced
 
 
+@traced
 def create_servicem8_client(full_name):
-    url = "https://api.servicem8.com/api_1.0/company.json"
-    headers = {"X-Api-Key": SERVICEM8_API_KEY, "Content-Type": "application/json"}
     payload = {"name": full_name}
 
     try:
-        resp = requests.post(url, json=payload, headers=headers)
+        resp = servicem8.post("company.json", json=payload)
         resp.raise_for_status()
         client_uuid = resp.headers.get("x-record-uuid")
-        logging.info(f"Created ServiceM8 client UUID: {client_uuid}")
+        client_index.remember_company(full_name, client_uuid)
+        logging.info("Created ServiceM8 client UUID: %s", client_uuid)
         return client_uuid
     except Exception as e:
-        logging.error(f"Error creating ServiceM8 client: {e}")
+        logging.error("Error creating ServiceM8 client: %s", e)
         return None
 
 
+@traced
 def update_hubspot_contact_sm8_client_id(contact_id, client_uuid):
-    url = f"https://api.hubapi.com/crm/v3/objects/contacts/{contact_id}"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    data = {"properties": {"sm8_client_id": client_uuid}}
-
-    try:
-        resp = requests.patch(url, json=data, headers=headers)
-        resp.raise_for_status()
-        logging.info(
-            f"Updated HubSpot contact {contact_id} with sm8_client_id: {client_uuid}"
-        )
-        return True
-    except Exception as e:
-        logging.error(f"Error updating HubSpot contact {contact_id}: {e}")
+    if not batched_update(contact_updates, "contact", contact_id, {"sm8_client_id": client_uuid}):
         return False
+    client_index.remember(contact_id, client_uuid)
+    return True
 
 
 def fetch_hubspot_contact_sm8_client_id(contact_id):
-    url = f"https://api.hubapi.com/crm/v3/objects/contacts/{contact_id}"
     params = {"properties": "sm8_client_id"}
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
     try:
-        resp = requests.get(url, headers=headers, params=params)
+        resp = hubspot.get(f"crm/v3/objects/contacts/{contact_id}", params=params)
         resp.raise_for_status()
         properties = resp.json().get("properties", {})
         sm8_client_id = properties.get("sm8_client_id")
-        logging.info(f"Fetched sm8_client_id for contact {contact_id}: {sm8_client_id}")
+        logging.info("Fetched sm8_client_id for contact %s: %s", contact_id, sm8_client_id)
         return sm8_client_id
     except Exception as e:
-        logging.error(f"Error fetching HubSpot contact {contact_id} sm8_client_id: {e}")
+        logging.error("Error fetching HubSpot contact %s sm8_client_id: %s", contact_id, e)
         return None
 
 
+@traced
 def create_servicem8_job(job_data):
-    url = "https://api.servicem8.com/api_1.0/job.json"
-    headers = {"X-Api-Key": SERVICEM8_API_KEY, "Content-Type": "application/json"}
     try:
-        resp = requests.post(url, json=job_data, headers=headers)
+        resp = servicem8.post("job.json", json=job_data)
         resp.raise_for_status()
         job_uuid = resp.headers.get("x-record-uuid")
-        logging.info(f"Created ServiceM8 Job UUID: {job_uuid}")
+        logging.info("Created ServiceM8 Job UUID: %s", job_uuid)
         return job_uuid
     except Exception as e:
-        logging.error(f"Error creating ServiceM8 job: {e}")
+        logging.error("Error creating ServiceM8 job: %s", e)
         return None
 
 
+@traced
 def create_servicem8_job_contact(job_uuid, contact):
-    url = "https://api.servicem8.com/api_1.0/jobcontact.json"
-    headers = {"X-Api-Key": SERVICEM8_API_KEY, "Content-Type": "application/json"}
     contact_payload = {
         "job_uuid": job_uuid,
         "first": contact.get("firstname"),
@@ -89,27 +68,18 @@ def create_servicem8_job_contact(job_uuid, contact):
         "is_primary_contact": 1,
     }
     try:
-        resp = requests.post(url, json=contact_payload, headers=headers)
+        resp = servicem8.post("jobcontact.json", json=contact_payload)
         resp.raise_for_status()
-        logging.info(f"Created JobContact for job: {job_uuid}")
+        logging.info("Created JobContact for job: %s", job_uuid)
         return True
     except Exception as e:
-        logging.error(f"Error creating JobContact: {e}")
+        logging.error("Error creating JobContact: %s", e)
         return False
 
 
+@traced
 def update_hubspot_deal_sm8_job_id(deal_id, job_uuid):
-    url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    data = {"properties": {"sm8_job_id": job_uuid}}
-    try:
-        resp = requests.patch(url, json=data, headers=headers)
-        resp.raise_for_status()
-        logging.info(f"Updated HubSpot deal {deal_id} with sm8_job_id: {job_uuid}")
-        return True
-    except Exception as e:
-        logging.error(f"Error updating HubSpot deal {deal_id}: {e}")
+    if not batched_update(deal_updates, "deal", deal_id, {"sm8_job_id": job_uuid}):
         return False
+    remember_deal_for_job(job_uuid, deal_id)
+    return True
@@ -0,0 +1,18 @@
+import os
+import sqlite3
+
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "data/state.db")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+
+
+def connect(path=None):
+    path = path or STATE_DB_PATH
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Autocommit mode; callers open explicit transactions where they need them.
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
@@ -1,130 +1,298 @@
 import os
 import logging
-import requests
-from dotenv import load_dotenv
+from app.utility.batching import MicroBatcher
+from app.utility.cache import MISSING, TTLCache
+from app.utility.clients import TIMEOUT_ERRORS, hubspot
+from app.utility.context import memoize_per_event, record_failure, record_timeout, time_left
+from app.utility.metrics import deal_updates_skipped
+from app.utility.tracing import traced
 
-load_dotenv()
-
-HUBSPOT_API_TOKEN = os.getenv("HUBSPOT_API_TOKEN")
+DEAL_CACHE_SIZE = int(os.getenv("DEAL_CACHE_SIZE", "10000"))
+DEAL_CACHE_TTL = float(os.getenv("DEAL_CACHE_TTL", "86400"))
+DEAL_CACHE_NEGATIVE_TTL = float(os.getenv("DEAL_CACHE_NEGATIVE_TTL", "30"))
+HUBSPOT_BATCH_WINDOW_MS = float(os.getenv("HUBSPOT_BATCH_WINDOW_MS", "50"))
+HUBSPOT_SEARCH_WINDOW_MS = float(os.getenv("HUBSPOT_SEARCH_WINDOW_MS", "5"))
+# Deal property snapshots are trusted for this long. A change made in HubSpot
+# itself is only noticed once the snapshot expires or is invalidated.
+DEAL_SNAPSHOT_SIZE = int(os.getenv("DEAL_SNAPSHOT_SIZE", "10000"))
+DEAL_SNAPSHOT_TTL = float(os.getenv("DEAL_SNAPSHOT_TTL", "300"))
+HUBSPOT_BATCH_LIMIT = 100
 
 CONSULT_VISIT_SCHEDULED_PIPELINE_ID = "1735909846"
 QUOTE_SENT_PIPELINE_ID = "1735909848"
 QUOTE_ACCEPTED_PIPELINE_ID = "1735909859"
 QUOTE_VIEWED_PIPELINE_ID = "953048617"
 CLOSED_WON_PIPELINE_ID = "closedwon"
+DEPOSIT_PAID_STAGE_ID = "1793082865"
 
-def find_hubspot_deal_by_job_uuid(job_uuid):
-    url = "https://api.hubapi.com/crm/v3/objects/deals/search"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
-    }
-    payload = {
-        "filterGroups": [
-            {
-                "filters": [
-                    {
-                        "propertyName": "sm8_job_id",
-                        "operator": "EQ",
-                        "value": job_uuid,
-                    }
-                ]
-            }
-        ],
-        "properties": ["dealstage"],
+# Deal properties the integration writes, read wherever deals are fetched so
+# writes can be compared with what the deal already holds.
+DEAL_PROPERTIES = ["dealstage", "amount", "quote_date", "consult_visit_date"]
+DATE_PROPERTIES = ("quote_date", "consult_visit_date")
+# What job creation reads from a deal and from its contact.
+JOB_DEAL_PROPERTIES = ["dealstage", "sm8_job_id"]
+CONTACT_PROPERTIES = ["firstname", "lastname", "email", "phone", "sm8_client_id"]
+
+# sm8 job uuid -> HubSpot deal id. The link is written once at job creation
+# and practically never changes, so every Job/JobActivity/quote event after
+# the first can skip the CRM search.
+deal_id_cache = TTLCache(
+    DEAL_CACHE_SIZE, DEAL_CACHE_TTL, negative_ttl=DEAL_CACHE_NEGATIVE_TTL
+)
+
+
+# deal id -> the values of DEAL_PROPERTIES last read from or written to it.
+# Only properties actually seen are kept, so a missing key means unknown.
+deal_snapshots = TTLCache(DEAL_SNAPSHOT_SIZE, DEAL_SNAPSHOT_TTL)
+
+
+def remember_deal_for_job(job_uuid, deal_id):
+    deal_id_cache.set(job_uuid, deal_id)
+
+
+def invalidate_deal_for_job(job_uuid=None):
+    """
+    Drop the cached deal for ``job_uuid``, or the whole cache when omitted.
+    """
+    deal_id_cache.invalidate(job_uuid)
+
+
+def normalize_property(name, value):
+    if value in (None, ""):
+        return None
+    if name == "amount":
+        try:
+            return round(float(value), 2)
+        except (TypeError, ValueError):
+            return value
+    if name in DATE_PROPERTIES:
+        return str(value)[:10]
+    return str(value)
+
+
+def remember_deal_snapshot(deal_id, properties):
+    known = {name: properties[name] for name in DEAL_PROPERTIES if name in properties}
+    if not deal_id or not known:
+        return
+    snapshot = deal_snapshots.get(str(deal_id))
+    deal_snapshots.set(str(deal_id), {**(snapshot if snapshot is not MISSING else {}), **known})
+
+
+def remember_deals(deals):
+    for deal in deals:
+        remember_deal_snapshot(deal.get("id"), deal.get("properties") or {})
+
+
+def invalidate_deal_snapshot(deal_id=None):
+    deal_snapshots.invalidate(None if deal_id is None else str(deal_id))
+
+
+def deal_changes(deal_id, properties):
+    """
+    The part of ``properties`` that differs from the deal's snapshot. Values
+    the snapshot does not know are always kept.
+    """
+    snapshot = deal_snapshots.get(str(deal_id))
+    if snapshot is MISSING:
+        return dict(properties)
+    return {
+        name: value
+        for name, value in properties.items()
+        if name not in snapshot or normalize_property(name, value) != normalize_property(name, snapshot[name])
     }
+
+
+def search_deals_by_job_uuids(job_uuids, properties=None):
+    """
+    Find the deals linked to many sm8 job uuids with ``IN`` searches, paging
+    through the results. Returns ``{job_uuid: deal}`` for the uuids that have
+    a deal. Errors are raised so callers can tell them from "no deal".
+    """
+    properties = sorted(set(properties or ["dealstage"]) | {"sm8_job_id"})
+    job_uuids = list(dict.fromkeys(job_uuids))
+    deals = {}
+    for start in range(0, len(job_uuids), HUBSPOT_BATCH_LIMIT):
+        payload = {
+            "filterGroups": [
+                {
+                    "filters": [
+                        {
+                            "propertyName": "sm8_job_id",
+                            "operator": "IN",
+                            "values": job_uuids[start : start + HUBSPOT_BATCH_LIMIT],
+                        }
+                    ]
+                }
+            ],
+            "properties": properties,
+            "limit": HUBSPOT_BATCH_LIMIT,
+        }
+        while True:
+            response = hubspot.post("crm/v3/objects/deals/search", json=payload)
+            response.raise_for_status()
+            body = response.json()
+            remember_deals(body.get("results", []))
+            for deal in body.get("results", []):
+                job_uuid = deal.get("properties", {}).get("sm8_job_id")
+                if job_uuid and job_uuid not in deals:
+                    deals[job_uuid] = deal
+            after = body.get("paging", {}).get("next", {}).get("after")
+            if not after:
+                break
+            payload["after"] = after
+    return deals
+
+
+def _flush_deal_searches(lookups):
+    # Ask for the written properties too; it costs nothing and fills the
+    # snapshots the following deal update is compared with.
+    deals = search_deals_by_job_uuids(lookups, properties=DEAL_PROPERTIES)
+    return {job_uuid: deal.get("id") for job_uuid, deal in deals.items()}
+
+
+# Lookups from concurrent workers are gathered for a few milliseconds and
+# answered by a single IN search instead of one EQ search each.
+deal_searches = MicroBatcher(
+    _flush_deal_searches,
+    window=HUBSPOT_SEARCH_WINDOW_MS / 1000.0,
+    max_size=HUBSPOT_BATCH_LIMIT,
+    default=None,
+    name="deal-searches",
+)
+
+
+@memoize_per_event("deal_id")
+@traced
+def find_hubspot_deal_by_job_uuid(job_uuid):
+    deal_id = deal_id_cache.get(job_uuid)
+    if deal_id is not MISSING:
+        return deal_id
+
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        results = response.json().get("results", [])
-        if results:
-            return results[0].get("id")
-        return None
+        deal_id = deal_searches.call(job_uuid, timeout=time_left())
+        remember_deal_for_job(job_uuid, deal_id)
+        return deal_id
     except Exception as e:
-        logging.error(f"Error searching HubSpot deal: {e}")
+        # The search ran on the batcher's thread; record it on this event.
+        record = record_timeout if isinstance(e, TIMEOUT_ERRORS) else record_failure
+        record("hubspot", f"deal search for job {job_uuid}: {e!r}")
+        logging.error("Error searching HubSpot deal: %s", e)
         return None
 
 
 def update_hubspot_deal_stage(deal_id, new_stage):
-    url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
-    }
     payload = {"properties": {"dealstage": new_stage}}
     try:
-        response = requests.patch(url, headers=headers, json=payload)
+        response = hubspot.patch(f"crm/v3/objects/deals/{deal_id}", json=payload)
         response.raise_for_status()
-        logging.info(
-            f"Successfully updated HubSpot deal {deal_id} to stage {new_stage}"
-        )
+        logging.info("Successfully updated HubSpot deal %s to stage %s", deal_id, new_stage)
         return True
     except Exception as e:
-        logging.error(f"Error updating HubSpot deal: {e}")
+        logging.error("Error updating HubSpot deal: %s", e)
         return False
 
 
 def update_hubspot_deal_quote_viewed(deal_id, new_stage):
-    url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
-    }
     payload = {"properties": {"dealstage": new_stage, "sm8_quote_viewed": "true"}}
     try:
-        response = requests.patch(url, headers=headers, json=payload)
+        response = hubspot.patch(f"crm/v3/objects/deals/{deal_id}", json=payload)
         response.raise_for_status()
-        logging.info(
-            f"Successfully updated HubSpot deal {deal_id} to stage {new_stage}"
-        )
+        logging.info("Successfully updated HubSpot deal %s to stage %s", deal_id, new_stage)
         return True
     except Exception as e:
-        logging.error(f"Error updating HubSpot deal: {e}")
+        logging.error("Error updating HubSpot deal: %s", e)
         return False
 
 
+@traced
 def get_associated_ids(from_object, from_id, to_object):
-    url = f"https://api.hubapi.com/crm/v4/objects/{from_object}/{from_id}/associations/{to_object}"
-    headers = {"Authorization": f"Bearer {HUBSPOT_API_TOKEN}"}
     try:
-        resp = requests.get(url, headers=headers)
+        resp = hubspot.hedged_get(
+            f"crm/v4/objects/{from_object}/{from_id}/associations/{to_object}"
+        )
         resp.raise_for_status()
         results = resp.json().get("results", [])
         # Return a list of associated IDs
         return [item["toObjectId"] for item in results]
     except Exception as e:
-        logging.error(f"Error getting associations from {from_object} {from_id} to {to_object}: {e}")
+        logging.error("Error getting associations from %s %s to %s: %s", from_object, from_id, to_object, e)
         return []
 
 
+def get_associated_ids_batch(from_object, from_ids, to_object):
+    """
+    ``get_associated_ids`` for many records through the v4 batch read.
+    Returns ``{from_id: [to_id, ...]}`` for the ids that were read; a chunk
+    that fails is logged and left out.
+    """
+    from_ids = [str(from_id) for from_id in dict.fromkeys(from_ids)]
+    associated = {}
+    for start in range(0, len(from_ids), HUBSPOT_BATCH_LIMIT):
+        chunk = from_ids[start : start + HUBSPOT_BATCH_LIMIT]
+        try:
+            resp = hubspot.post(
+                f"crm/v4/associations/{from_object}/{to_object}/batch/read",
+                json={"inputs": [{"id": from_id} for from_id in chunk]},
+            )
+            resp.raise_for_status()
+        except Exception as e:
+            logging.error("Error batch reading %s associations to %s: %s", from_object, to_object, e)
+            continue
+        # Records without associations are reported as errors, not results.
+        associated.update({from_id: [] for from_id in chunk})
+        for result in resp.json().get("results", []):
+            from_id = str(result.get("from", {}).get("id"))
+            associated[from_id] = [item["toObjectId"] for item in result.get("to", [])]
+    return associated
+
+
+@traced
 def get_objects_properties(object_type, object_ids, properties):
-    url = f"https://api.hubapi.com/crm/v3/objects/{object_type}/batch/read"
-    headers = {"Authorization": f"Bearer {HUBSPOT_API_TOKEN}", "Content-Type": "application/json"}
-    payload = {
-        "properties": properties,
-        "inputs": [{"id": obj_id} for obj_id in object_ids]
-    }
-    try:
-        resp = requests.post(url, json=payload, headers=headers)
-        resp.raise_for_status()
-        # Return the list of result objects with their properties
-        return resp.json().get("results", [])
-    except Exception as e:
-        logging.error(f"Error batch reading {object_type}: {e}")
-        return []
+    """
+    Batch read ``object_ids``, HUBSPOT_BATCH_LIMIT per call. A chunk that
+    fails is logged and left out of the results.
+    """
+    object_ids = list(object_ids)
+    results = []
+    for start in range(0, len(object_ids), HUBSPOT_BATCH_LIMIT):
+        payload = {
+            "properties": properties,
+            "inputs": [{"id": obj_id} for obj_id in object_ids[start : start + HUBSPOT_BATCH_LIMIT]],
+        }
+        try:
+            resp = hubspot.post(f"crm/v3/objects/{object_type}/batch/read", json=payload)
+            resp.raise_for_status()
+            # Return the list of result objects with their properties
+            results.extend(resp.json().get("results", []))
+        except Exception as e:
+            logging.error("Error batch reading %s: %s", object_type, e)
+    if object_type == "deals":
+        remember_deals(results)
+    return results
+
+
+@memoize_per_event("job_deal")
+def get_job_deal(deal_id):
+    """
+    The deal as job creation sees it: its stage and sm8_job_id.
+    """
+    deals = get_objects_properties("deals", [deal_id], JOB_DEAL_PROPERTIES)
+    return deals[0] if deals else None
 
+
+@memoize_per_event("deal_contact")
+@traced
 def get_deal_details_with_associations(deal_id):
 
     contact_ids = get_associated_ids("deals", deal_id, "contacts")
     if not contact_ids:
-        logging.warning(f"Aborting: No contacts associated with deal {deal_id}")
+        logging.warning("Aborting: No contacts associated with deal %s", deal_id)
         return None
 
-    contact_props = ["firstname", "lastname", "email", "phone", "sm8_client_id"]
-    contacts = get_objects_properties("contacts", [contact_ids[0]], contact_props)
+    contacts = get_objects_properties("contacts", [contact_ids[0]], CONTACT_PROPERTIES)
 
     if not contacts:
-        logging.error(f"Aborting: Failed to fetch properties for objects associated with deal {deal_id}")
+        logging.error("Aborting: Failed to fetch properties for objects associated with deal %s", deal_id)
         return None
 
     details = {
@@ -134,23 +302,162 @@ def get_deal_details_with_associations(deal_id):
     return details
 
 
-def update_hubspot_deal(deal_id, properties_to_update):
+def get_deals_details_with_associations(deal_ids):
     """
-    Generic function to update a HubSpot deal with a dictionary of properties.
+    ``get_deal_details_with_associations`` for many deals: one v4 batch
+    association read and one contact batch read per HUBSPOT_BATCH_LIMIT
+    deals. Deals whose contact could not be read are left out.
     """
-    url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_TOKEN}",
+    associated = get_associated_ids_batch("deals", deal_ids, "contacts")
+    first_contacts = {deal_id: str(ids[0]) for deal_id, ids in associated.items() if ids}
+    contacts = {
+        str(contact.get("id")): contact
+        for contact in get_objects_properties("contacts", dict.fromkeys(first_contacts.values()), CONTACT_PROPERTIES)
+    }
+    details = {}
+    for deal_id, contact_id in first_contacts.items():
+        contact = contacts.get(contact_id)
+        if contact:
+            details[deal_id] = {"id": contact.get("id"), "contact": contact.get("properties", {})}
+    return details
+
+
+def batch_update_objects(object_type, updates):
+    """
+    Update many objects through the batch/update API. ``updates`` maps object
+    id to its properties; returns ``{object_id: success}`` for every id.
+    """
+    results = {}
+    object_ids = list(updates)
+    for start in range(0, len(object_ids), HUBSPOT_BATCH_LIMIT):
+        chunk = {obj_id: updates[obj_id] for obj_id in object_ids[start : start + HUBSPOT_BATCH_LIMIT]}
+        results.update(_batch_update_chunk(object_type, chunk))
+    return results
+
+
+def _batch_update_chunk(object_type, updates):
+    payload = {
+        "inputs": [
+            {"id": obj_id, "properties": properties}
+            for obj_id, properties in updates.items()
+        ]
     }
-    payload = {"properties": properties_to_update}
     try:
-        response = requests.patch(url, headers=headers, json=payload)
-        response.raise_for_status()
-        logging.info(
-            f"Successfully updated HubSpot deal {deal_id} with: {properties_to_update}"
-        )
-        return True
+        resp = hubspot.post(f"crm/v3/objects/{object_type}/batch/update", json=payload)
+        if 400 <= resp.status_code < 500 and resp.status_code != 429 and len(updates) > 1:
+            # One bad input rejects the whole batch. Split it so the valid
+            # updates still go through and only the bad one reports failure.
+            logging.warning(
+                "Batch update of %s %s rejected (%s), splitting.",
+                len(updates), object_type, resp.status_code,
+            )
+            object_ids = list(updates)
+            middle = len(object_ids) // 2
+            results = _batch_update_chunk(object_type, {i: updates[i] for i in object_ids[:middle]})
+            results.update(_batch_update_chunk(object_type, {i: updates[i] for i in object_ids[middle:]}))
+            return results
+        resp.raise_for_status()
+        updated = {str(item.get("id")) for item in resp.json().get("results", [])}
+        results = {}
+        for obj_id, properties in updates.items():
+            results[obj_id] = str(obj_id) in updated
+            if results[obj_id]:
+                if object_type == "deals":
+                    remember_deal_snapshot(obj_id, properties)
+                logging.info("Successfully updated HubSpot %s %s with: %s", object_type, obj_id, properties)
+            else:
+                logging.error("HubSpot batch update did not update %s %s", object_type, obj_id)
+        return results
     except Exception as e:
-        logging.error(f"Error updating HubSpot deal: {e}")
+        logging.error("Error batch updating HubSpot %s: %s", object_type, e)
+        return {obj_id: False for obj_id in updates}
+
+
+def _merge_properties(current, new):
+    return {**current, **new}
+
+
+# Contact writes are batched the same way as deal writes below.
+contact_updates = MicroBatcher(
+    lambda updates: batch_update_objects("contacts", updates),
+    window=HUBSPOT_BATCH_WINDOW_MS / 1000.0,
+    max_size=HUBSPOT_BATCH_LIMIT,
+    merge=_merge_properties,
+    default=False,
+    name="contact-updates",
+)
+
+
+# Deal writes from all workers are collected for a short window and sent
+# together through batch/update; later writes to the same deal win.
+deal_updates = MicroBatcher(
+    lambda updates: batch_update_objects("deals", updates),
+    window=HUBSPOT_BATCH_WINDOW_MS / 1000.0,
+    max_size=HUBSPOT_BATCH_LIMIT,
+    merge=_merge_properties,
+    default=False,
+    name="deal-updates",
+)
+
+
+def too_late_to_batch(batcher, object_type, object_id):
+    """
+    Whether the event's deadline ends before ``batcher`` would flush. The
+    write is then not submitted at all: the caller would give up waiting
+    while it is still sent, and the retried event would send it again.
+    """
+    remaining = time_left()
+    if remaining is None or remaining > batcher.window:
+        return False
+    logging.error("No time left to update HubSpot %s %s; not submitted", object_type, object_id)
+    record_timeout("hubspot", f"update of {object_type} {object_id}: deadline before the batch window")
+    return True
+
+
+def batched_update(batcher, object_type, object_id, properties):
+    """
+    Write ``properties`` through ``batcher`` within the event's deadline.
+    The batch runs on the batcher's thread, so a failure is recorded on
+    this event here.
+    """
+    if too_late_to_batch(batcher, object_type, object_id):
+        return False
+    try:
+        updated = batcher.call(object_id, properties, timeout=time_left())
+    except TIMEOUT_ERRORS as e:
+        logging.error("Timed out updating HubSpot %s %s: %r", object_type, object_id, e)
+        record_timeout("hubspot", f"update of {object_type} {object_id}: timed out")
         return False
+    except Exception as e:
+        logging.error("Error updating HubSpot %s %s: %s", object_type, object_id, e)
+        updated = False
+    if not updated:
+        record_failure("hubspot", f"update of {object_type} {object_id}")
+    return updated
+
+
+def skip_unchanged(deal_id, properties_to_update):
+    """
+    The properties worth sending, or None when the deal already holds them
+    all and the update can be skipped.
+    """
+    changes = deal_changes(deal_id, properties_to_update)
+    if not changes:
+        deal_updates_skipped.inc("unchanged")
+        logging.info("HubSpot deal %s already has %s, not updating", deal_id, properties_to_update)
+        return None
+    if len(changes) < len(properties_to_update):
+        deal_updates_skipped.inc("partial")
+    return changes
+
+
+@traced
+def update_hubspot_deal(deal_id, properties_to_update):
+    """
+    Generic function to update a HubSpot deal with a dictionary of properties.
+    Only properties that differ from the deal's cached snapshot are sent.
+    """
+    changes = skip_unchanged(deal_id, properties_to_update)
+    if changes is None:
+        return True
+    return batched_update(deal_updates, "deal", deal_id, changes)
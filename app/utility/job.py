@@ -1,23 +1,19 @@
-import os
 import logging
-import requests
+from app.utility.clients import servicem8
+from app.utility.context import forget
+from app.utility.tracing import traced
 
-SERVICEM8_API_KEY = os.getenv("SERVICEM8_API_KEY")
 
+@traced
 def update_job_status_to_work_order(uuid):
-    url = f"https://api.servicem8.com/api_1.0/job/{uuid}.json"
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "X-Api-Key": SERVICEM8_API_KEY,
-    }
     payload = {"status": "Work Order"}
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = servicem8.post(f"job/{uuid}.json", json=payload)
         response.raise_for_status()
-        logging.info(f"Successfully updated job {uuid} to Work Order.")
+        forget("job", uuid)
+        logging.info("Successfully updated job %s to Work Order.", uuid)
         return response.json()
     except Exception as e:
-        logging.error(f"Error updating job {uuid} to Work Order: {e}")
+        logging.error("Error updating job %s to Work Order: %s", uuid, e)
         return None
@@ -0,0 +1,121 @@
+import os
+import time
+import uuid
+import threading
+from app.utility.db import connect
+
+CREATE_JOB_CLAIM_TTL = float(os.getenv("CREATE_JOB_CLAIM_TTL", "300"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS create_job_ledger (
+    deal_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'in_progress',
+    client_uuid TEXT,
+    contact_id TEXT,
+    contact_linked INTEGER NOT NULL DEFAULT 0,
+    job_uuid TEXT,
+    job_contact_created INTEGER NOT NULL DEFAULT 0,
+    deal_patched INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    claimed_at REAL,
+    updated_at REAL NOT NULL
+);
+"""
+
+STEPS = ("client_uuid", "contact_id", "contact_linked", "job_uuid", "job_contact_created", "deal_patched")
+COLUMNS = ("deal_id", "status") + STEPS + ("owner",)
+
+
+class CreateJobLedger:
+    """
+    Local record of how far job creation got for each deal.
+
+    A CreateJob run claims the deal's row, records every step as it
+    completes (client created, contact linked, job created, job contact
+    created, deal patched) and marks the row done at the end. A retried or
+    concurrent run for the same deal resumes after the last recorded step
+    instead of creating a second client or job, and a repeat request for a
+    finished deal is answered without calling either API.
+    """
+
+    def __init__(self, path=None, claim_ttl=CREATE_JOB_CLAIM_TTL):
+        self.path = path
+        self.claim_ttl = claim_ttl
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def get(self, deal_id):
+        row = self._conn().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM create_job_ledger WHERE deal_id = ?", (str(deal_id),)
+        ).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def claim(self, deal_id):
+        """
+        Take ownership of the deal's row, creating it if needed. Returns the
+        row (with its ``owner`` token) or None when another run holds an
+        unexpired claim or the deal is already done.
+        """
+        deal_id = str(deal_id)
+        now = time.time()
+        owner = uuid.uuid4().hex
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO create_job_ledger (deal_id, updated_at) VALUES (?, ?)", (deal_id, now)
+            )
+            cursor = conn.execute(
+                "UPDATE create_job_ledger SET owner = ?, claimed_at = ? "
+                "WHERE deal_id = ? AND status != 'done' AND (owner IS NULL OR claimed_at < ?)",
+                (owner, now, deal_id, now - self.claim_ttl),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(deal_id) if cursor.rowcount else None
+
+    def record(self, entry, **steps):
+        """
+        Save completed steps on a claimed row and on ``entry`` itself.
+        """
+        unknown = set(steps) - set(STEPS)
+        if unknown:
+            raise ValueError(f"Unknown ledger steps: {', '.join(sorted(unknown))}")
+        assignments = ", ".join(f"{name} = ?" for name in steps)
+        self._conn().execute(
+            f"UPDATE create_job_ledger SET {assignments}, updated_at = ? WHERE deal_id = ? AND owner = ?",
+            (*steps.values(), time.time(), entry["deal_id"], entry["owner"]),
+        )
+        entry.update(steps)
+
+    def complete(self, entry, job_uuid=None):
+        if job_uuid:
+            entry["job_uuid"] = job_uuid
+        self._conn().execute(
+            "UPDATE create_job_ledger SET status = 'done', job_uuid = ?, owner = NULL, updated_at = ? "
+            "WHERE deal_id = ? AND owner = ?",
+            (entry["job_uuid"], time.time(), entry["deal_id"], entry["owner"]),
+        )
+        entry["status"] = "done"
+
+    def release(self, entry):
+        self._conn().execute(
+            "UPDATE create_job_ledger SET owner = NULL WHERE deal_id = ? AND owner = ?",
+            (entry["deal_id"], entry["owner"]),
+        )
+
+    def stats(self):
+        return dict(
+            self._conn().execute("SELECT status, COUNT(*) FROM create_job_ledger GROUP BY status")
+        )
+
+
+create_job_ledger = CreateJobLedger()
@@ -0,0 +1,178 @@
+"""
+Structured, non-blocking logging.
+
+``configure_logging()`` gives the root logger a single handler that only puts
+records on a queue. A listener thread formats them, as JSON lines by default
+or in the classic text format with ``LOG_FORMAT=text``, and writes them to
+stderr, so a log call on the ingest or worker path neither formats its
+message nor waits on the stream. Log with %-style arguments rather than
+f-strings: the message is then only built if the record is written at all,
+and later, so arguments must not be changed after the call.
+
+Every record carries the id of the event being received or handled, bound
+with ``bind_event_id``. Webhook bodies are logged through ``Payload``: only a
+sample of events (``LOG_PAYLOAD_SAMPLE_RATE``, chosen by event id) log the
+body, cut to ``LOG_PAYLOAD_MAX_CHARS``.
+"""
+import os
+import sys
+import json
+import atexit
+import logging
+import threading
+import contextvars
+from queue import SimpleQueue
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from app.utility.tracing import sampled
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Set to false to format and write records on the calling thread, e.g. when
+# debugging a crash that would lose the queued tail.
+LOG_QUEUE = os.getenv("LOG_QUEUE", "true").lower() in ("1", "true", "yes")
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+# 0 logs sampled payloads in full.
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(event_id)s] %(message)s"
+
+_event_id = contextvars.ContextVar("log_event_id", default=None)
+_configure_lock = threading.Lock()
+_listener = None
+
+
+def set_event_id(event_id):
+    """
+    Bind ``event_id`` to the records logged from here on; returns the token
+    for ``reset_event_id``.
+    """
+    return _event_id.set(event_id)
+
+
+def reset_event_id(token):
+    _event_id.reset(token)
+
+
+@contextmanager
+def bind_event_id(event_id):
+    token = set_event_id(event_id)
+    try:
+        yield event_id
+    finally:
+        reset_event_id(token)
+
+
+def current_event_id():
+    return _event_id.get()
+
+
+class EventIdFilter(logging.Filter):
+    # Handler filters run on the thread that logs, where the id is bound.
+    def filter(self, record):
+        if getattr(record, "event_id", None) is None:
+            event_id = _event_id.get()
+            if event_id is not None:
+                record.event_id = event_id
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        event_id = getattr(record, "event_id", None)
+        if event_id is not None:
+            entry["event_id"] = event_id
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc_text:
+            entry["exc_info"] = exc_text
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The listener thread builds the message. The traceback is rendered
+        # here so the queued record does not keep its frames alive.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class Payload:
+    """
+    A webhook body as a log argument. Sampled events log it as JSON cut to
+    LOG_PAYLOAD_MAX_CHARS, the others only its size in keys. Nothing is
+    serialized unless the record is written.
+    """
+
+    __slots__ = ("data", "event_id")
+
+    def __init__(self, data, event_id=None):
+        self.data = data
+        # Captured now: the record is formatted on the listener thread.
+        self.event_id = event_id or _event_id.get()
+
+    def __str__(self):
+        if not sampled(self.event_id, LOG_PAYLOAD_SAMPLE_RATE):
+            size = len(self.data) if isinstance(self.data, (dict, list)) else 1
+            return f"<{size} keys, not sampled>"
+        text = json.dumps(self.data, separators=(",", ":"), default=str)
+        if LOG_PAYLOAD_MAX_CHARS and len(text) > LOG_PAYLOAD_MAX_CHARS:
+            return f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} chars)"
+        return text
+
+
+def formatter(log_format=None):
+    if (log_format or LOG_FORMAT) == "json":
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT, defaults={"event_id": "-"})
+
+
+def configure_logging(level=None, stream=None, queued=None, log_format=None):
+    """
+    Send every record through the queue (or, with ``queued=False``, straight
+    to ``stream``). Calling it again replaces the previous setup.
+    """
+    global _listener
+    queued = LOG_QUEUE if queued is None else queued
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(formatter(log_format))
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        if queued:
+            records = SimpleQueue()
+            handler = LogQueueHandler(records)
+            _listener = QueueListener(records, output)
+            _listener.start()
+        else:
+            handler = output
+        handler.addFilter(EventIdFilter())
+        root = logging.getLogger()
+        for previous in root.handlers[:]:
+            root.removeHandler(previous)
+        root.addHandler(handler)
+        root.setLevel(level or LOG_LEVEL)
+
+
+def stop_logging():
+    """
+    Write out every queued record and stop the listener thread.
+    """
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,248 @@
+"""
+Prometheus metrics for the ingest routes, workers and upstream clients.
+
+Counters and histograms are recorded into a per-thread dict, so the hot path
+only touches memory owned by the calling thread and never takes a lock. The
+per-thread values are summed when ``/metrics`` is scraped. Gauges are read
+from a callback at scrape time.
+"""
+import re
+import bisect
+import threading
+
+PREFIX = "integration_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+AGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+ID_SEGMENT = re.compile(r"^[^.]*[0-9-][^.]*")
+KEEP_SEGMENTS = {"v1", "v2", "v3", "v4"}
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def endpoint_label(path):
+    """
+    Collapse record ids in an API path so it can be used as a label, e.g.
+    ``job/{id}.json`` or ``crm/v3/objects/deals/{id}``.
+    """
+    return "/".join(
+        segment if segment in KEEP_SEGMENTS else ID_SEGMENT.sub("{id}", segment)
+        for segment in path.lstrip("/").split("/")
+    )
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+class ThreadShardedMetric:
+    """
+    Base for metrics recorded without locks: each thread writes to its own
+    dict of ``{label_values: value}``. Dicts of threads that have exited are
+    folded into ``_retired`` at scrape time so short-lived threads don't pile up.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def _shard(self):
+        values = getattr(self._local, "values", None)
+        if values is None:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+        return values
+
+    def _combine(self, current, value):
+        raise NotImplementedError
+
+    def _collect_values(self):
+        with self._lock:
+            live = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    live.append((thread, values))
+                else:
+                    self._fold(self._retired, values)
+            self._shards = live
+            totals = {}
+            self._fold(totals, self._retired)
+            for _, values in live:
+                # Copy first: the owning thread may add a key while we iterate.
+                self._fold(totals, dict(values))
+        return totals
+
+    def _fold(self, into, values):
+        for key, value in values.items():
+            into[key] = self._combine(into.get(key), value)
+
+
+class Counter(ThreadShardedMetric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        values = self._shard()
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def _combine(self, current, value):
+        return (current or 0) + value
+
+    def values(self):
+        """
+        Current totals as ``{label_values: value}``.
+        """
+        return self._collect_values()
+
+    def samples(self):
+        for label_values, value in sorted(self._collect_values().items()):
+            yield f"{self.name}_total{_format_labels(self.labels, label_values)} {_format_value(value)}"
+
+
+class Histogram(ThreadShardedMetric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        values = self._shard()
+        counts = values.get(label_values)
+        if counts is None:
+            # One slot per bucket plus +Inf, then the running sum.
+            counts = values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _combine(self, current, value):
+        if current is None:
+            return list(value)
+        return [a + b for a, b in zip(current, value)]
+
+    def samples(self):
+        for label_values, counts in sorted(self._collect_values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """
+    Value read at scrape time. ``collect`` returns ``{label_values: value}``.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, collect):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        register(self)
+
+    def samples(self):
+        for label_values, value in sorted(self.collect().items()):
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}"
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+event_age = Histogram(
+    "event_age_seconds", "Time from enqueue to dequeue of a webhook event.", ("object_type",), AGE_BUCKETS
+)
+handler_duration = Histogram(
+    "handler_duration_seconds", "Handler run time per webhook event.", ("object_type",)
+)
+handler_errors = Counter(
+    "handler_errors", "Webhook events that failed: the handler raised or an upstream call failed.",
+    ("object_type",),
+)
+ingest_rejections = Counter(
+    "ingest_rejections", "Webhook events refused because their queue lane was at the high-water mark.",
+    ("lane",),
+)
+prefilter_skips = Counter(
+    "prefilter_skips", "Webhook events dropped because no rule could lead to a write.", ("object_type", "check"),
+)
+prefilter_calls_skipped = Counter(
+    "prefilter_calls_skipped", "Outbound calls the dropped events would have made before doing nothing.",
+    ("object_type",),
+)
+deal_updates_skipped = Counter(
+    "deal_updates_skipped", "Deal updates skipped (unchanged) or trimmed (partial) by the snapshot diff.",
+    ("result",),
+)
+event_outcomes = Counter(
+    "event_outcomes",
+    "How handled events were settled: ok, skipped, retried, timed_out, parked or dead_lettered.",
+    ("object_type", "outcome"),
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Upstream HTTP call latency per attempt.",
+    ("api", "method", "endpoint"),
+)
+http_responses = Counter(
+    "http_responses", "Upstream HTTP responses by status code.", ("api", "method", "endpoint", "status")
+)
+
+
+http_timeouts = Counter(
+    "http_timeouts", "Upstream HTTP attempts that hit their connect or read timeout.", ("api",)
+)
+http_hedges = Counter(
+    "http_hedges", "Hedged GETs: second requests sent, and those that answered first (won).", ("api", "result")
+)
+
+
+def record_http(api, method, path, started, ended, status):
+    endpoint = endpoint_label(path)
+    http_request_duration.observe(ended - started, api, method, endpoint)
+    http_responses.inc(api, method, endpoint, str(status))
@@ -0,0 +1,661 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from app.utility.db import connect
+
+QUEUE_BATCH_WINDOW_MS = float(os.getenv("QUEUE_BATCH_WINDOW_MS", "1"))
+QUEUE_BATCH_SIZE = int(os.getenv("QUEUE_BATCH_SIZE", "500"))
+QUEUE_VISIBILITY_TIMEOUT = float(os.getenv("QUEUE_VISIBILITY_TIMEOUT", "300"))
+# How often idle consumers check for commits made by other processes.
+QUEUE_POLL_INTERVAL_MS = float(os.getenv("QUEUE_POLL_INTERVAL_MS", "50"))
+# Idle consumers retry at least this often to pick up expired leases and
+# delayed events, which become visible without any commit.
+QUEUE_RETRY_INTERVAL = 1.0
+# Seconds put() waits for the writer to commit before giving up with
+# QueueUnavailable, so a stuck writer surfaces as an error, not a hang.
+QUEUE_ENQUEUE_TIMEOUT = float(os.getenv("QUEUE_ENQUEUE_TIMEOUT", "30"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    object_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    entity_key TEXT,
+    enqueued_at REAL NOT NULL,
+    visible_at REAL NOT NULL,
+    lease_token TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    coalesce_key TEXT,
+    lane TEXT NOT NULL DEFAULT 'default',
+    event_id TEXT
+);
+CREATE INDEX IF NOT EXISTS events_shard ON events (shard, id);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id INTEGER,
+    object_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    entity_key TEXT,
+    attempts INTEGER NOT NULL,
+    reason TEXT,
+    enqueued_at REAL NOT NULL,
+    failed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dead_letters_type ON dead_letters (object_type, id);
+"""
+
+# Columns added after the first release, created on existing databases.
+MIGRATIONS = {
+    "coalesce_key": "ALTER TABLE events ADD COLUMN coalesce_key TEXT",
+    "lane": "ALTER TABLE events ADD COLUMN lane TEXT NOT NULL DEFAULT 'default'",
+    "event_id": "ALTER TABLE events ADD COLUMN event_id TEXT",
+}
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS events_coalesce ON events (coalesce_key) WHERE coalesce_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS events_entity ON events (entity_key, id);
+CREATE INDEX IF NOT EXISTS events_lane ON events (shard, lane, id);
+"""
+
+
+DEFAULT_LANE = "default"
+
+
+class QueueUnavailable(Exception):
+    pass
+
+
+class PendingPut:
+    def __init__(self, object_type, data, shard, entity_key, coalesce_key, lane=DEFAULT_LANE, event_id=None):
+        self.object_type = object_type
+        self.data = data
+        self.shard = shard
+        self.entity_key = entity_key
+        self.coalesce_key = coalesce_key
+        self.lane = lane
+        self.event_id = event_id
+        self.row_id = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class WeightedLanes:
+    """
+    Smooth weighted round robin over the lanes that currently have work.
+
+    Every pick credits each non-empty lane with its weight and hands the
+    turn to the lane with the most credit, which then pays back the total.
+    A lane with weight 8 next to one with weight 1 gets eight turns for
+    every one of the other, interleaved, and no lane with work ever waits
+    more than one full round.
+    """
+
+    def __init__(self, weights):
+        self.weights = dict(weights)
+        self._credit = {}
+        self._lock = threading.Lock()
+
+    def pick(self, lanes):
+        lanes = list(lanes)
+        with self._lock:
+            total = 0
+            for lane in lanes:
+                weight = self.weights.get(lane, 1)
+                self._credit[lane] = self._credit.get(lane, 0) + weight
+                total += weight
+            chosen = max(lanes, key=lambda lane: self._credit[lane])
+            self._credit[chosen] -= total
+            return chosen
+
+
+class PersistentQueue:
+    """
+    SQLite-backed work queue (WAL mode).
+
+    Producers block in put() until their event is committed, but concurrent
+    puts are group-committed by a single writer thread, so one transaction
+    covers every event that arrived during the batch window. Consumers lease
+    events with a visibility timeout and ack them once handled; an event that
+    is never acked becomes visible again when its lease expires.
+
+    Puts that carry a ``coalesce_key`` are folded with ``merge`` into an
+    event with the same key that is still waiting (not leased), so a burst
+    of updates to one record is handled once on its latest state.
+
+    Every event belongs to a priority ``lane``. Consumers take turns between
+    the lanes that have ready events in proportion to ``lane_weights``, so
+    interactive events are not stuck behind a burst of bulk notifications
+    and bulk events still make progress. Events for the same entity are
+    always handed out in order, whatever their lanes.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        batch_window_ms=QUEUE_BATCH_WINDOW_MS,
+        batch_size=QUEUE_BATCH_SIZE,
+        visibility_timeout=QUEUE_VISIBILITY_TIMEOUT,
+        merge=None,
+        poll_interval_ms=QUEUE_POLL_INTERVAL_MS,
+        lane_weights=None,
+    ):
+        self.path = path
+        self.merge = merge
+        self.enqueued = 0
+        self.coalesced = 0
+        self.batch_window = batch_window_ms / 1000.0
+        self.batch_size = batch_size
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval_ms / 1000.0
+        self.lane_weights = dict(lane_weights or {DEFAULT_LANE: 1})
+        self.lane_weights.setdefault(DEFAULT_LANE, 1)
+        self._lane_turns = {}
+        self._lane_turns_lock = threading.Lock()
+        self._lane_depths = ({}, 0.0)
+
+        self._local = threading.local()
+        self._pending = []
+        self._pending_lock = threading.Condition()
+        self._available = threading.Condition()
+        self._listeners = []
+        self._writer = None
+        self._watch_conn = None
+        self._watch_lock = threading.Lock()
+
+        self._migrate()
+
+    def _migrate(self):
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(events)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                conn.execute(statement)
+        conn.executescript(INDEXES)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def _ensure_writer(self):
+        # Also restarts a writer that died, so queued puts are not stranded.
+        if self._writer is None or not self._writer.is_alive():
+            with self._pending_lock:
+                if self._writer is None or not self._writer.is_alive():
+                    self._writer = threading.Thread(
+                        target=self._write_loop, name="queue-writer", daemon=True
+                    )
+                    self._writer.start()
+
+    def put(self, object_type, data, shard=0, entity_key=None, coalesce_key=None, lane=DEFAULT_LANE, event_id=None):
+        return self.put_many([(object_type, data, shard, entity_key, coalesce_key, lane, event_id)])[0]
+
+    def put_many(self, events):
+        """
+        Enqueue ``(object_type, data, shard, entity_key, coalesce_key[, lane,
+        event_id])`` tuples and wait until all of them are committed. They are handed to
+        the writer together, so they normally share one transaction. Raises
+        QueueUnavailable when they are not committed within
+        QUEUE_ENQUEUE_TIMEOUT; they may still be committed later.
+        """
+        self._ensure_writer()
+        items = [PendingPut(*event) for event in events]
+        with self._pending_lock:
+            self._pending.extend(items)
+            self._pending_lock.notify()
+        deadline = time.monotonic() + QUEUE_ENQUEUE_TIMEOUT
+        for item in items:
+            if not item.done.wait(max(0.0, deadline - time.monotonic())):
+                raise QueueUnavailable(f"events not committed within {QUEUE_ENQUEUE_TIMEOUT:g}s")
+        for item in items:
+            if item.error:
+                raise item.error
+        return [item.row_id for item in items]
+
+    def _write_loop(self):
+        conn = self._conn()
+        while True:
+            with self._pending_lock:
+                while not self._pending:
+                    self._pending_lock.wait()
+            if self.batch_window:
+                time.sleep(self.batch_window)
+            with self._pending_lock:
+                batch = self._pending[: self.batch_size]
+                del self._pending[: self.batch_size]
+            try:
+                self._commit(conn, batch)
+            except Exception:
+                logging.exception("Queue writer failed to settle %s events", len(batch))
+                for item in batch:
+                    item.error = item.error or QueueUnavailable("queue writer failed")
+                    item.done.set()
+
+    def _commit(self, conn, batch):
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            coalesced = 0
+            for item in batch:
+                if item.coalesce_key and self.merge and self._coalesce(conn, item):
+                    coalesced += 1
+                    continue
+                cursor = conn.execute(
+                    "INSERT INTO events (object_type, payload, shard, entity_key, coalesce_key, lane, event_id, enqueued_at, visible_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        item.object_type,
+                        json.dumps(item.data),
+                        item.shard,
+                        item.entity_key,
+                        item.coalesce_key,
+                        item.lane,
+                        item.event_id,
+                        now,
+                        now,
+                    ),
+                )
+                item.row_id = cursor.lastrowid
+            conn.execute("COMMIT")
+            self.enqueued += len(batch)
+            self.coalesced += coalesced
+        except Exception as e:
+            logging.error("Error committing %s queued events: %s", len(batch), e)
+            try:
+                conn.execute("ROLLBACK")
+            except Exception:
+                pass
+            for item in batch:
+                item.error = e
+        for item in batch:
+            item.done.set()
+        self._notify()
+
+    def _notify(self):
+        with self._available:
+            self._available.notify_all()
+        for listener in self._listeners:
+            # A broken listener (e.g. for a closed event loop) must not stop
+            # the writer thread it runs on.
+            try:
+                listener()
+            except Exception:
+                logging.exception("Queue listener %r failed", listener)
+
+    def add_listener(self, callback):
+        """
+        Call ``callback`` (from the writer thread) after every local commit.
+        """
+        self._listeners.append(callback)
+
+    def wait_for_events(self, timeout):
+        with self._available:
+            self._available.wait(timeout)
+
+    def data_version(self):
+        """
+        A number that changes whenever another connection, in this or any
+        other process, commits to the queue database. Reading it takes no
+        lock on the database, so idle consumers can poll it cheaply.
+        """
+        with self._watch_lock:
+            if self._watch_conn is None:
+                self._watch_conn = connect(self.path)
+            return self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _coalesce(self, conn, item):
+        row = conn.execute(
+            "SELECT id, payload FROM events WHERE coalesce_key = ? AND lease_token IS NULL "
+            "ORDER BY id DESC LIMIT 1",
+            (item.coalesce_key,),
+        ).fetchone()
+        if not row:
+            return False
+        merged = self.merge(json.loads(row[1]), item.data)
+        conn.execute(
+            "UPDATE events SET payload = ? WHERE id = ?", (json.dumps(merged), row[0])
+        )
+        item.row_id = row[0]
+        return True
+
+    def coalescing_stats(self):
+        return {
+            "enqueued": self.enqueued,
+            "coalesced": self.coalesced,
+            "coalescing_ratio": self.coalesced / self.enqueued if self.enqueued else 0.0,
+        }
+
+    def lease(self, shard, timeout=None):
+        """
+        Lease the next visible event of a shard, taking turns between its
+        lanes by weight. Blocks for up to ``timeout``
+        seconds (forever when None) and returns None if nothing arrived.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            seen = self.data_version()
+            tried_at = time.time()
+            event = self._try_lease(shard)
+            if event:
+                return event
+            # Retry on a local commit, a commit by another process or once
+            # the retry interval has passed.
+            while True:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                with self._available:
+                    woken = self._available.wait(
+                        self.poll_interval if remaining is None else min(remaining, self.poll_interval)
+                    )
+                if (
+                    woken
+                    or self.data_version() != seen
+                    or time.time() - tried_at >= QUEUE_RETRY_INTERVAL
+                ):
+                    break
+
+    def _lanes(self, shard_key):
+        with self._lane_turns_lock:
+            turns = self._lane_turns.get(shard_key)
+            if turns is None:
+                turns = self._lane_turns[shard_key] = WeightedLanes(self.lane_weights)
+            return turns
+
+    def _ready(self, conn, shards, lane, now, limit, object_type=None):
+        """
+        The oldest visible events of one lane (or, with ``object_type``, of
+        one type) whose entity has no earlier event still queued or in
+        flight, in any lane.
+        """
+        column, value = ("object_type", object_type) if object_type else ("lane", lane)
+        return conn.execute(
+            "SELECT id, object_type, payload, attempts, enqueued_at, event_id FROM events e "
+            f"WHERE shard IN ({','.join('?' * len(shards))}) AND {column} = ? AND visible_at <= ? "
+            "AND NOT EXISTS (SELECT 1 FROM events p WHERE p.entity_key = e.entity_key AND p.id < e.id) "
+            "ORDER BY id LIMIT ?",
+            (*shards, value, now, limit),
+        ).fetchall()
+
+    def _lease_rows(self, conn, rows, now):
+        events = []
+        for row in rows:
+            token = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE events SET visible_at = ?, lease_token = ?, attempts = attempts + 1 WHERE id = ?",
+                (now + self.visibility_timeout, token, row[0]),
+            )
+            events.append({
+                "id": row[0],
+                "object_type": row[1],
+                "data": json.loads(row[2]),
+                "attempts": row[3] + 1,
+                "enqueued_at": row[4],
+                "event_id": row[5],
+                "lease_token": token,
+            })
+        return events
+
+    def _try_lease(self, shard):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            heads = {}
+            for lane in self.lane_weights:
+                rows = self._ready(conn, [shard], lane, now, 1)
+                if rows:
+                    heads[lane] = rows
+            if not heads:
+                conn.execute("COMMIT")
+                return None
+            lane = self._lanes(shard).pick(heads)
+            event = self._lease_rows(conn, heads[lane], now)[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return event
+
+    def lease_ready(self, shards, limit):
+        """
+        Lease up to ``limit`` visible events from ``shards`` without blocking,
+        taking turns between lanes by weight. An event is only handed out
+        when no earlier event for the same entity is still queued or in
+        flight, so many events can be processed at once while each entity's
+        events stay in order.
+        """
+        if limit <= 0:
+            return []
+        shards = list(shards)
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ready = {}
+            for lane in self.lane_weights:
+                rows = self._ready(conn, shards, lane, now, limit)
+                if rows:
+                    ready[lane] = rows[::-1]
+            turns = self._lanes(tuple(shards))
+            rows = []
+            while ready and len(rows) < limit:
+                lane = turns.pick(ready)
+                rows.append(ready[lane].pop())
+                if not ready[lane]:
+                    del ready[lane]
+            events = self._lease_rows(conn, rows, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return events
+
+    def lease_batch(self, shards, object_type, limit):
+        """
+        Lease up to ``limit`` ready events of ``object_type`` from ``shards``,
+        oldest first, to be handled together with one already leased. The
+        same per-entity ordering as ``lease_ready`` applies.
+        """
+        if limit <= 0:
+            return []
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._ready(conn, list(shards), None, now, limit, object_type)
+            events = self._lease_rows(conn, rows, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return events
+
+    def ack(self, event):
+        self._conn().execute(
+            "DELETE FROM events WHERE id = ? AND lease_token = ?",
+            (event["id"], event["lease_token"]),
+        )
+
+    def nack(self, event, delay=0, count_attempt=True):
+        """
+        Release a leased event so it is handed out again after ``delay``
+        seconds. With ``count_attempt=False`` the lease does not count
+        towards the event's attempts (used when parking it).
+        """
+        self._conn().execute(
+            "UPDATE events SET visible_at = ?, lease_token = NULL, attempts = attempts - ? "
+            "WHERE id = ? AND lease_token = ?",
+            (time.time() + delay, 0 if count_attempt else 1, event["id"], event["lease_token"]),
+        )
+
+    def dead_letter(self, event, reason):
+        """
+        Move a leased event to the dead-letter store with the reason it
+        failed, so it stops blocking its shard and can be replayed later.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                "INSERT INTO dead_letters (event_id, object_type, payload, entity_key, attempts, reason, enqueued_at, failed_at) "
+                "SELECT id, object_type, payload, entity_key, attempts, ?, enqueued_at, ? FROM events "
+                "WHERE id = ? AND lease_token = ?",
+                (reason, time.time(), event["id"], event["lease_token"]),
+            )
+            if cursor.rowcount:
+                conn.execute("DELETE FROM events WHERE id = ?", (event["id"],))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def dead_letters(self, limit=100, object_type=None, ids=None):
+        query = (
+            "SELECT id, event_id, object_type, payload, entity_key, attempts, reason, enqueued_at, failed_at "
+            "FROM dead_letters"
+        )
+        conditions, params = [], []
+        if object_type:
+            conditions.append("object_type = ?")
+            params.append(object_type)
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return []
+            conditions.append(f"id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        return [
+            {
+                "id": row[0],
+                "event_id": row[1],
+                "object_type": row[2],
+                "data": json.loads(row[3]),
+                "entity_key": row[4],
+                "attempts": row[5],
+                "reason": row[6],
+                "enqueued_at": row[7],
+                "failed_at": row[8],
+            }
+            for row in self._conn().execute(query, params)
+        ]
+
+    def dead_letter_counts(self):
+        return dict(
+            self._conn().execute("SELECT object_type, COUNT(*) FROM dead_letters GROUP BY object_type")
+        )
+
+    def remove_dead_letter(self, dead_letter_id):
+        self._conn().execute("DELETE FROM dead_letters WHERE id = ?", (dead_letter_id,))
+
+    def fail_dead_letter(self, dead_letter_id, reason):
+        self._conn().execute(
+            "UPDATE dead_letters SET attempts = attempts + 1, reason = ?, failed_at = ? WHERE id = ?",
+            (reason, time.time(), dead_letter_id),
+        )
+
+    def requeue_dead_letters(self, ids, shard_for_key, lane_for=None):
+        """
+        Move dead letters back onto the queue, in their original order, as
+        fresh events. ``lane_for(object_type)`` picks each event's lane.
+        Returns how many were requeued.
+        """
+        ids = list(ids)
+        if not ids:
+            return 0
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, object_type, payload, entity_key FROM dead_letters "
+                f"WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id",
+                ids,
+            ).fetchall()
+            for dead_letter_id, object_type, payload, entity_key in rows:
+                conn.execute(
+                    "INSERT INTO events (object_type, payload, shard, entity_key, lane, enqueued_at, visible_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        object_type,
+                        payload,
+                        shard_for_key(entity_key),
+                        entity_key,
+                        lane_for(object_type) if lane_for else DEFAULT_LANE,
+                        now,
+                        now,
+                    ),
+                )
+                conn.execute("DELETE FROM dead_letters WHERE id = ?", (dead_letter_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify()
+        return len(rows)
+
+    def recover(self, shard_for_key, lane_for=None):
+        """
+        Resume work left behind by a previous run: release expired leases,
+        re-shard pending events in case the worker count changed and, with
+        ``lane_for``, move them to their type's current lane. Live leases
+        are left alone: every process that starts workers runs this, and
+        another one may still be handling those events. A crashed run's
+        events come back once their lease expires.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE events SET lease_token = NULL WHERE lease_token IS NOT NULL AND visible_at <= ?",
+                (time.time(),),
+            )
+            rows = conn.execute("SELECT id, entity_key, shard FROM events").fetchall()
+            for event_id, entity_key, shard in rows:
+                new_shard = shard_for_key(entity_key, shard)
+                if new_shard != shard:
+                    conn.execute(
+                        "UPDATE events SET shard = ? WHERE id = ?", (new_shard, event_id)
+                    )
+            if lane_for:
+                for (object_type,) in conn.execute("SELECT DISTINCT object_type FROM events").fetchall():
+                    conn.execute(
+                        "UPDATE events SET lane = ? WHERE object_type = ?", (lane_for(object_type), object_type)
+                    )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def depths(self, shard_count):
+        depths = [0] * shard_count
+        for shard, depth in self._conn().execute(
+            "SELECT shard, COUNT(*) FROM events GROUP BY shard"
+        ):
+            if shard < shard_count:
+                depths[shard] = depth
+        return depths
+
+    def lane_depths(self, max_age=0.0):
+        """
+        Queued events per lane. With ``max_age`` a count taken less than
+        that many seconds ago is reused, so ingest can check it per request.
+        """
+        depths, counted_at = self._lane_depths
+        if max_age and time.time() - counted_at < max_age:
+            return depths
+        depths = dict(self._conn().execute("SELECT lane, COUNT(*) FROM events GROUP BY lane"))
+        self._lane_depths = (depths, time.time())
+        return depths
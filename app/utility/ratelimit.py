@@ -0,0 +1,97 @@
+import time
+import random
+import threading
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every worker that calls one upstream API.
+
+    ``reserve()`` takes a token and returns how long the caller must wait
+    before using it, so the same bucket serves blocking and asyncio callers.
+    When the upstream answers 429, ``throttle()`` puts the bucket into debt for
+    the Retry-After period and halves the refill rate; successful calls then
+    raise the rate again towards the configured budget.
+    """
+
+    def __init__(self, name, limit, period, min_rate_fraction=0.1):
+        self.name = name
+        self.capacity = float(limit)
+        self.max_rate = limit / float(period)
+        self.min_rate = self.max_rate * min_rate_fraction
+        self.rate = self.max_rate
+        self.tokens = self.capacity
+        self.waits = 0
+        self.throttles = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def reserve(self, tokens=1, max_wait=None):
+        """
+        Take ``tokens`` and return the wait before using them. When that wait
+        would be longer than ``max_wait`` nothing is taken and None is
+        returned.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if max_wait is not None and (tokens - self.tokens) / self.rate > max_wait:
+                return None
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            self.waits += 1
+            return -self.tokens / self.rate
+
+    def release(self, tokens=1):
+        """
+        Give back tokens reserved for a call that was not made.
+        """
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(self, retry_after):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0) - retry_after * self.rate
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "tokens": round(self.tokens, 2),
+                "capacity": self.capacity,
+                "rate_per_second": round(self.rate, 3),
+                "waits": self.waits,
+                "throttles": self.throttles,
+            }
+
+
+def retry_delay(response, attempt, base=0.5, cap=30.0):
+    """
+    Seconds to wait before retrying a throttled call: the upstream's
+    Retry-After when it sends one, otherwise jittered exponential backoff.
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after) + random.uniform(0, base)
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,158 @@
+"""
+Which webhook events can lead to a write, decided from the payload.
+
+``RULES`` lists, per event type, the ways an event can end in a write: the
+ServiceM8 fields whose change can trigger it, payload fields it needs and
+the values a payload field must have. The table is compiled once at
+import. An event that matches none of its type's rules is dropped, at
+ingest and again before the handler runs, without any outbound call.
+Nothing is decided from cached HubSpot state: a job without a deal a
+moment ago may have one by now, possibly written by another process.
+
+The status and stage mappings the handlers apply live here as well.
+"""
+import logging
+from app.utility.hubspot import (
+    CLOSED_WON_PIPELINE_ID,
+    CONSULT_VISIT_SCHEDULED_PIPELINE_ID,
+    DEPOSIT_PAID_STAGE_ID,
+    QUOTE_ACCEPTED_PIPELINE_ID,
+)
+from app.utility.metrics import prefilter_calls_skipped, prefilter_skips
+
+# ServiceM8 job status -> deal stage once the quote is accepted.
+QUOTE_ACCEPTED_STAGES = {"work order": QUOTE_ACCEPTED_PIPELINE_ID}
+# ServiceM8 job status -> deal stage when a visit is scheduled.
+CONSULT_VISIT_STAGES = {
+    "work order": CLOSED_WON_PIPELINE_ID,
+    "quote": CONSULT_VISIT_SCHEDULED_PIPELINE_ID,
+}
+# Deal stages at which HubSpot's QuoteAccepted moves the job to Work Order.
+WORK_ORDER_DEAL_STAGES = {DEPOSIT_PAID_STAGE_ID}
+
+# Where the job uuid is found: the ServiceM8 entry, else the HubSpot payload.
+JOB_KEY = ("entry.uuid", "sm8_job_id")
+
+RULES = {
+    "Job": [
+        {"name": "quote_accepted", "changed_fields": ["status"], "requires": [JOB_KEY]},
+        {"name": "quote_sent", "changed_fields": ["quote_sent"], "requires": [JOB_KEY]},
+    ],
+    "JobActivity": [
+        {"name": "consult_visit", "requires": ["entry.uuid"]},
+    ],
+    "ReadyToBeQuoted": [
+        {"name": "quote_sent", "requires": [JOB_KEY]},
+    ],
+    "QuoteAccepted": [
+        {
+            "name": "work_order",
+            "requires": ["sm8_job_id", "deal_record_id"],
+            "values": {"dealstage": WORK_ORDER_DEAL_STAGES},
+        },
+    ],
+    "CreateJob": [
+        {"name": "create_job", "requires": ["deal_record_id"]},
+    ],
+}
+
+# Outbound calls a handler would have made before finding out there is
+# nothing to do, by event type and why the event was dropped: what a dropped
+# event saves. Every rule today checks what the handler also checks before
+# its first call, so no drop saves one; kinds not listed save none.
+CALLS_SAVED = {}
+
+
+def lookup(data, path):
+    """
+    A payload value by dotted path; ``entry`` means the first entry.
+    """
+    value = data
+    for part in path.split("."):
+        if part == "entry":
+            value = (value.get("entry") or [{}])[0] if isinstance(value, dict) else None
+        else:
+            value = value.get(part) if isinstance(value, dict) else None
+        if value is None:
+            return None
+    return value
+
+
+def first_present(data, paths):
+    for path in paths:
+        value = lookup(data, path)
+        if value:
+            return value
+    return None
+
+
+class Rule:
+    def __init__(self, object_type, name, changed_fields=(), requires=(), values=None):
+        self.object_type = object_type
+        self.name = name
+        self.changed_fields = frozenset(changed_fields)
+        # Each requirement is a tuple of alternative paths.
+        self.requires = [(paths,) if isinstance(paths, str) else tuple(paths) for paths in requires]
+        self.values = {path: frozenset(allowed) for path, allowed in (values or {}).items()}
+
+    def check(self, data):
+        """
+        None when the event may trigger this rule, otherwise
+        ``(kind, detail)`` saying why it cannot.
+        """
+        if self.changed_fields:
+            changed = lookup(data, "entry.changed_fields") or []
+            if not self.changed_fields.intersection(changed):
+                return "changed_fields", f"none of {', '.join(sorted(self.changed_fields))} changed"
+        for paths in self.requires:
+            if not first_present(data, paths):
+                return "missing_field", f"no {' or '.join(paths)}"
+        for path, allowed in self.values.items():
+            value = lookup(data, path)
+            if value not in allowed:
+                return "value", f"{path} is {value!r}"
+        return None
+
+
+def compile_rules(rules):
+    return {
+        object_type: [Rule(object_type, **rule) for rule in object_rules]
+        for object_type, object_rules in rules.items()
+    }
+
+
+compiled_rules = compile_rules(RULES)
+
+
+def prefilter(object_type, data):
+    """
+    Why an event cannot lead to a write, or None when it may. Events of a
+    type without rules always pass. Dropped events are counted.
+    """
+    rules = compiled_rules.get(object_type)
+    if not rules:
+        return None
+    failures = []
+    for rule in rules:
+        failed = rule.check(data)
+        if failed is None:
+            return None
+        failures.append((rule.name, *failed))
+    reason = "; ".join(f"{name}: {detail}" for name, _, detail in failures)
+    prefilter_skips.inc(object_type, failures[0][1])
+    # The handler would have stopped at the rule that got furthest.
+    saved = max(CALLS_SAVED.get((object_type, kind), 0) for _, kind, _ in failures)
+    prefilter_calls_skipped.inc(object_type, amount=saved)
+    logging.info("Skipping %s event: %s", object_type, reason)
+    return reason
+
+
+def prefilter_stats():
+    return {
+        "skipped": {
+            f"{object_type}:{kind}": count for (object_type, kind), count in prefilter_skips.values().items()
+        },
+        "calls_skipped": {
+            object_type: count for (object_type,), count in prefilter_calls_skipped.values().items()
+        },
+    }
@@ -0,0 +1,243 @@
+"""
+Optional per-event tracing.
+
+A sampled event gets a span for the handling of the event itself, for every
+handler step decorated with ``@traced`` and for every outbound HTTP attempt,
+nested as they ran. When the event finishes its spans are written as JSON
+lines to a rotating file. The calling thread only puts them on a queue; a
+listener thread serializes and writes them, so tracing never waits on disk.
+File rotation is not safe across processes, so each ``app.worker`` process
+writes its own file, ``traces.worker<index>.jsonl`` next to ``TRACE_PATH``.
+
+Events are sampled by a hash of their event id, at ``TRACE_SAMPLE_RATE``
+(0 turns tracing off, 1 traces everything). ``python -m app.trace_report``
+summarizes a trace file.
+"""
+import os
+import glob
+import json
+import time
+import uuid
+import zlib
+import atexit
+import inspect
+import logging
+import threading
+import contextvars
+from queue import SimpleQueue
+from functools import wraps
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from app.utility.context import current_event
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_PATH = os.getenv("TRACE_PATH", "data/traces.jsonl")
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "5"))
+
+_parent_span = contextvars.ContextVar("parent_span", default=None)
+_writer_lock = threading.Lock()
+_span_handler = None
+_trace_process = None
+
+
+def new_event_id():
+    return uuid.uuid4().hex
+
+
+def sampled(event_id, rate=None):
+    """
+    Whether to trace ``event_id``. The decision only depends on the id, so
+    every process agrees on it.
+    """
+    rate = TRACE_SAMPLE_RATE if rate is None else rate
+    if rate <= 0 or not event_id:
+        return False
+    return rate >= 1 or zlib.crc32(str(event_id).encode("utf-8")) < rate * 2**32
+
+
+def trace_path(process=None):
+    """
+    The trace file written by ``app.worker`` process ``process``, or by a
+    single process running every worker itself.
+    """
+    if process is None:
+        return TRACE_PATH
+    root, extension = os.path.splitext(TRACE_PATH)
+    return f"{root}.worker{process}{extension}"
+
+
+def trace_paths():
+    """
+    Every trace file on disk, rotated backups included.
+    """
+    root, extension = os.path.splitext(TRACE_PATH)
+    paths = []
+    for current in [TRACE_PATH, *sorted(glob.glob(f"{glob.escape(root)}.worker*{extension}"))]:
+        backups = [f"{current}.{index}" for index in range(TRACE_BACKUP_COUNT, 0, -1)]
+        paths.extend(path for path in [*backups, current] if os.path.exists(path))
+    return paths
+
+
+def set_trace_process(process):
+    """
+    Write this process's spans to its own file; call before the first span.
+    """
+    global _trace_process
+    _trace_process = process
+
+
+class SpanFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, separators=(",", ":"), default=str)
+
+
+class SpanQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Spans are serialized by the listener thread, not the caller.
+        return record
+
+
+def _writer():
+    """
+    The queue handler spans are written through. They bypass the logger
+    tree, so log levels and ``logging.disable`` never drop them.
+    """
+    global _span_handler
+    if _span_handler is not None:
+        return _span_handler
+    with _writer_lock:
+        if _span_handler is not None:
+            return _span_handler
+        path = trace_path(_trace_process)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = RotatingFileHandler(
+            path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT, delay=True
+        )
+        file_handler.setFormatter(SpanFormatter())
+        spans = SimpleQueue()
+        listener = QueueListener(spans, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        _span_handler = SpanQueueHandler(spans)
+        return _span_handler
+
+
+class Trace:
+    def __init__(self, event_id, object_type, attempt=None):
+        self.event_id = event_id
+        self.object_type = object_type
+        # A retried event keeps its id and span ids restart at 1, so every
+        # span carries the attempt to tell the traces apart.
+        self.attempt = attempt
+        self.started = time.perf_counter()
+        self.spans = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def span_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def add(self, span_id, parent_id, name, kind, started, ended, **attributes):
+        self.spans.append({
+            "event_id": self.event_id,
+            "object_type": self.object_type,
+            "attempt": self.attempt,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "kind": kind,
+            "start_ms": round((started - self.started) * 1000, 3),
+            "duration_ms": round((ended - started) * 1000, 3),
+            **attributes,
+        })
+
+    def write(self):
+        handler = _writer()
+        for span in self.spans:
+            handler.handle(logging.makeLogRecord({"msg": span}))
+
+
+def _current_trace():
+    context = current_event()
+    return context.trace if context is not None else None
+
+
+def is_tracing():
+    return _current_trace() is not None
+
+
+@contextmanager
+def trace_event(context, event_id, object_type, **attributes):
+    """
+    Trace the handling of one event when it is sampled. Opens the root span
+    and writes every span of the event when it finishes.
+    """
+    event_id = event_id or new_event_id()
+    if not sampled(event_id):
+        yield
+        return
+    trace = context.trace = Trace(event_id, object_type, attributes.get("attempt"))
+    span_id = trace.span_id()
+    token = _parent_span.set(span_id)
+    try:
+        yield
+    finally:
+        _parent_span.reset(token)
+        failures = [f"{upstream}: {reason}" for upstream, reason in context.failures]
+        trace.add(
+            span_id, None, object_type, "event", trace.started, time.perf_counter(),
+            failed=bool(failures), failures=failures, **attributes,
+        )
+        trace.write()
+
+
+@contextmanager
+def span(name, kind="step", **attributes):
+    trace = _current_trace()
+    if trace is None:
+        yield
+        return
+    span_id = trace.span_id()
+    parent_id = _parent_span.get()
+    token = _parent_span.set(span_id)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _parent_span.reset(token)
+        trace.add(span_id, parent_id, name, kind, started, time.perf_counter(), **attributes)
+
+
+def record_span(name, kind, started, ended, **attributes):
+    """
+    Add an already timed span (``perf_counter`` values) under the current one.
+    """
+    trace = _current_trace()
+    if trace is not None:
+        trace.add(trace.span_id(), _parent_span.get(), name, kind, started, ended, **attributes)
+
+
+def traced(func):
+    """
+    Record a ``step`` span named after the function for each call made while
+    a sampled event is handled. Works on coroutine functions too.
+    """
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(func.__name__):
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
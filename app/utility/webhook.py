@@ -1,3 +1,4 @@
+import logging
 from app.handlers.job import handle_job_quote_sent
 from app.handlers.job import (
     handle_sm8_job_quote_accepted,
@@ -11,8 +12,8 @@ def handle_job_event(data):
 
     # Redirect based on changed fields
     if "status" in changed_fields:
-        print(f"Job {job_uuid} had its status updated.")
+        logging.info("Job %s had its status updated.", job_uuid)
         handle_sm8_job_quote_accepted(job_uuid)
     if "quote_sent" in changed_fields:
-        print(f"Job {job_uuid} had its quote sent.")
+        logging.info("Job %s had its quote sent.", job_uuid)
         handle_job_quote_sent(data)
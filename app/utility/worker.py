@@ -1,20 +1,504 @@
+import os
+import time
+import zlib
+import random
+import asyncio
 import logging
-from queue import Queue
+from itertools import count
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from app.handlers import batch_prefetchers, webhook_handlers
+from app.utility.clients import breakers
+from app.utility.context import event_context
+from app.utility.logs import bind_event_id, set_event_id
+from app.utility.metrics import event_age, event_outcomes, handler_duration, handler_errors
+from app.utility.persistent_queue import DEFAULT_LANE, QUEUE_RETRY_INTERVAL, PersistentQueue
+from app.utility.rules import prefilter
+from app.utility.tracing import new_event_id, trace_event
 
-queue = Queue()
+WORKER_COUNT = max(1, int(os.getenv("WORKER_COUNT", "4")))
+# "thread" runs one blocking worker per shard; "async" runs every shard on a
+# single asyncio loop with up to ASYNC_CONCURRENCY events in flight.
+WORKER_MODE = os.getenv("WORKER_MODE", "thread").lower()
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", "1000"))
+# Set to false when workers run as separate processes (python -m app.worker)
+# so the ingest processes only enqueue.
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "true").lower() in ("1", "true", "yes")
 
+# Failed events are retried with exponential backoff, then moved to the
+# dead-letter store.
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "5"))
+QUEUE_RETRY_BASE_DELAY = float(os.getenv("QUEUE_RETRY_BASE_DELAY", "2"))
+QUEUE_RETRY_MAX_DELAY = float(os.getenv("QUEUE_RETRY_MAX_DELAY", "60"))
+# Seconds a handler gets for all its upstream calls. Calls are cut short to
+# fit and none is started once it has passed; the event is then retried like
+# any other failure and settled as timed_out. 0 disables the deadline.
+EVENT_DEADLINE = float(os.getenv("EVENT_DEADLINE", "60"))
+# Up to this many ready events of a type in ``batch_prefetchers`` are leased
+# together; what they need is read with batch calls and they run side by
+# side, so their HubSpot writes also meet in the batchers. 1 disables it.
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "20"))
+# Seconds a worker waits after the queue itself failed (e.g. the database
+# stayed locked past its busy timeout) before it leases again.
+WORKER_ERROR_BACKOFF = float(os.getenv("WORKER_ERROR_BACKOFF", "1"))
+# Upstreams each event type calls. While one of them has an open circuit the
+# event is parked instead of run.
+EVENT_UPSTREAMS = {
+    "Job": ("servicem8", "hubspot"),
+    "JobActivity": ("servicem8", "hubspot"),
+    "ReadyToBeQuoted": ("servicem8", "hubspot"),
+    "QuoteAccepted": ("servicem8",),
+    "CreateJob": ("hubspot", "servicem8"),
+}
 
-def worker():
-    while True:
-        handler, data = queue.get()
+# Priority lane of each event type. Workers take turns between lanes with
+# ready events in proportion to QUEUE_LANE_WEIGHTS ("lane:weight,..."), so a
+# CreateJob someone is waiting on is not queued behind a burst of Job and
+# JobActivity notifications, and those still get their share.
+EVENT_LANES = {
+    "CreateJob": "interactive",
+    "QuoteAccepted": "default",
+    "ReadyToBeQuoted": "default",
+    "Job": "bulk",
+    "JobActivity": "bulk",
+}
+QUEUE_LANE_WEIGHTS = {
+    lane.strip(): int(weight)
+    for lane, weight in (
+        pair.split(":") for pair in os.getenv("QUEUE_LANE_WEIGHTS", "interactive:8,default:4,bulk:1").split(",")
+    )
+}
+# Workers only lease from lanes with a weight, so a lane EVENT_LANES routes
+# to but QUEUE_LANE_WEIGHTS leaves out would starve; it gets a weight of 1.
+for _lane in sorted(set(EVENT_LANES.values()) | {DEFAULT_LANE}):
+    if _lane not in QUEUE_LANE_WEIGHTS:
+        logging.warning("Queue lane %s has no weight in QUEUE_LANE_WEIGHTS, using 1", _lane)
+        QUEUE_LANE_WEIGHTS[_lane] = 1
+# Once a lane holds this many queued events, ingest refuses new events for it
+# with a Retry-After of QUEUE_RETRY_AFTER seconds. 0 disables the limit.
+QUEUE_HIGH_WATER = int(os.getenv("QUEUE_HIGH_WATER", "50000"))
+QUEUE_RETRY_AFTER = int(os.getenv("QUEUE_RETRY_AFTER", "30"))
+# How long ingest reuses a lane depth count.
+QUEUE_DEPTH_MAX_AGE = 0.5
+
+
+def coalesce_key(object_type, data):
+    # Only ServiceM8 change notifications are safe to fold together: handlers
+    # re-fetch the record, so running once on the latest state is enough.
+    entry = (data.get("entry") or [{}])[0]
+    if object_type in ("Job", "JobActivity") and entry.get("uuid"):
+        return f"{object_type}:{entry['uuid']}"
+    return None
+
+
+def merge_events(current, new):
+    current_entry = (current.get("entry") or [{}])[0]
+    new_entry = (new.get("entry") or [{}])[0]
+    changed_fields = list(
+        dict.fromkeys(
+            (current_entry.get("changed_fields") or [])
+            + (new_entry.get("changed_fields") or [])
+        )
+    )
+    merged = dict(new)
+    merged["entry"] = [dict(new_entry, changed_fields=changed_fields)]
+    return merged
+
+
+# Durable queue shared by the ingest routes and the workers. Events are routed
+# to a shard by their job/deal key and each shard is drained by one worker, so
+# everything touching the same entity is handled in order while unrelated
+# entities are processed in parallel.
+queue = PersistentQueue(merge=merge_events, lane_weights=QUEUE_LANE_WEIGHTS)
+
+_round_robin = count()
+
+
+def shard_key(data):
+    entry = (data.get("entry") or [{}])[0]
+    return entry.get("uuid") or data.get("sm8_job_id") or data.get("deal_record_id")
+
+
+def shard_for_key(key, default=None):
+    if not key:
+        # Nothing to keep in order, spread unkeyed events evenly.
+        if default is not None and default < WORKER_COUNT:
+            return default
+        return next(_round_robin) % WORKER_COUNT
+    return zlib.crc32(str(key).encode("utf-8")) % WORKER_COUNT
+
+
+def lane_for(object_type):
+    return EVENT_LANES.get(object_type, DEFAULT_LANE)
+
+
+def overloaded_lanes(object_types):
+    """
+    The lanes of ``object_types`` that are at the high-water mark.
+    """
+    if not QUEUE_HIGH_WATER:
+        return []
+    depths = queue.lane_depths(max_age=QUEUE_DEPTH_MAX_AGE)
+    lanes = dict.fromkeys(lane_for(object_type) for object_type in object_types)
+    return [lane for lane in lanes if depths.get(lane, 0) >= QUEUE_HIGH_WATER]
+
+
+def split_entries(data):
+    """
+    ServiceM8 may report several changed records in one notification. Give
+    each entry its own event so it is sharded, ordered and coalesced by its
+    own uuid; the handlers only look at the first entry.
+    """
+    entries = data.get("entry")
+    if not isinstance(entries, list) or len(entries) <= 1:
+        return [data]
+    return [dict(data, entry=[entry]) for entry in entries]
+
+
+def enqueue_many(events, event_id=None):
+    """
+    Enqueue ``(object_type, data)`` pairs in one commit and return the shard
+    of every resulting event. Events that cannot lead to a write are dropped
+    first. The rest carry ``event_id`` (numbered when there are several) so
+    their logs and traces can be found later.
+    """
+    event_id = event_id or new_event_id()
+    units = [
+        (object_type, unit)
+        for object_type, data in events
+        for unit in split_entries(data)
+        if prefilter(object_type, unit) is None
+    ]
+    if not units:
+        return []
+    items = []
+    for index, (object_type, unit) in enumerate(units):
+        key = shard_key(unit)
+        items.append((
+            object_type,
+            unit,
+            shard_for_key(key),
+            key,
+            coalesce_key(object_type, unit),
+            lane_for(object_type),
+            event_id if len(units) == 1 else f"{event_id}.{index}",
+        ))
+    queue.put_many(items)
+    return [item[2] for item in items]
+
+
+def enqueue(object_type, data, event_id=None):
+    return enqueue_many([(object_type, data)], event_id)
+
+
+def shard_depths():
+    return queue.depths(WORKER_COUNT)
+
+
+def upstreams_open(object_type):
+    """
+    The open circuit breakers among the upstreams ``object_type`` needs.
+    """
+    names = EVENT_UPSTREAMS.get(object_type, tuple(breakers))
+    return [breakers[name] for name in names if breakers[name].is_open()]
+
+
+def failure_reason(context):
+    return "; ".join(f"{upstream}: {reason}" for upstream, reason in context.failures)
+
+
+def settle(event, failure):
+    """
+    Finish a leased event: ack it, park it while an upstream is down, retry
+    it with backoff or move it to the dead-letter store.
+    """
+    object_type = event["object_type"]
+    if failure is None:
+        queue.ack(event)
+        event_outcomes.inc(object_type, "ok")
+        return
+
+    open_breakers = upstreams_open(object_type)
+    if open_breakers:
+        delay = max(breaker.retry_in() for breaker in open_breakers) + random.uniform(0, 1)
+        queue.nack(event, delay=delay, count_attempt=False)
+        event_outcomes.inc(object_type, "parked")
+        logging.warning("Parked %s event %s for %.1fs: %s", object_type, event["id"], delay, failure)
+    elif event["attempts"] < QUEUE_MAX_ATTEMPTS:
+        delay = min(QUEUE_RETRY_MAX_DELAY, QUEUE_RETRY_BASE_DELAY * 2 ** (event["attempts"] - 1))
+        queue.nack(event, delay=delay)
+        timed_out = event.get("timed_out")
+        event_outcomes.inc(object_type, "timed_out" if timed_out else "retried")
+        logging.warning(
+            "Retrying %s%s event %s in %.1fs (attempt %s/%s): %s",
+            "timed out " if timed_out else "", object_type, event["id"], delay, event["attempts"],
+            QUEUE_MAX_ATTEMPTS, failure,
+        )
+    else:
+        queue.dead_letter(event, failure)
+        event_outcomes.inc(object_type, "dead_lettered")
+        logging.error(
+            "Dead-lettered %s event %s after %s attempts: %s",
+            object_type, event["id"], event["attempts"], failure,
+        )
+
+
+def skip_if_filtered(event):
+    """
+    Ack an event without running it when it can no longer lead to a write,
+    e.g. its job turned out to have no deal since it was queued.
+    """
+    if prefilter(event["object_type"], event["data"]) is None:
+        return False
+    queue.ack(event)
+    event_outcomes.inc(event["object_type"], "skipped")
+    return True
+
+
+def park_if_open(event):
+    """
+    Park an event without running it when an upstream it needs is down.
+    """
+    open_breakers = upstreams_open(event["object_type"])
+    if not open_breakers:
+        return False
+    delay = max(breaker.retry_in() for breaker in open_breakers) + random.uniform(0, 1)
+    queue.nack(event, delay=delay, count_attempt=False)
+    event_outcomes.inc(event["object_type"], "parked")
+    return True
+
+
+def trace_attributes(event):
+    return {
+        "attempt": event["attempts"],
+        "queue_wait_ms": round((time.time() - event["enqueued_at"]) * 1000, 3),
+    }
+
+
+def handle_event(object_type, data, event=None, memo=None):
+    """
+    Run the handler for one event within EVENT_DEADLINE. Returns None when
+    it went through, otherwise the reason it failed. ``event`` is the leased
+    queue event, if there is one; it is marked when a call timed out.
+    ``memo`` seeds the event's memo, e.g. with batch-read records.
+    """
+    handler = webhook_handlers.get(object_type)
+    if not handler:
+        logging.warning("No handler for queued object type: %s", object_type)
+        return None
+    event_id, attributes = (event["event_id"], trace_attributes(event)) if event else (None, {})
+    started = time.perf_counter()
+    with bind_event_id(event_id), event_context(EVENT_DEADLINE) as context, trace_event(
+        context, event_id, object_type, **attributes
+    ):
+        context.memo.update(memo or {})
         try:
             handler(data)
         except Exception as e:
-            logging.error(f"Error processing webhook data: {e}")
+            logging.error("Error processing webhook data: %s", e)
+            context.failures.append(("handler", f"{type(e).__name__}: {e}"))
+    handler_duration.observe(time.perf_counter() - started, object_type)
+    if event is not None:
+        event["timed_out"] = context.timed_out
+    if context.failures:
+        handler_errors.inc(object_type)
+        return failure_reason(context)
+    return None
+
+
+def prefetch_batch(object_type, events):
+    """
+    Batch read what leased events of one type need. Returns their memos in
+    order; on failure none, and each event reads for itself.
+    """
+    try:
+        return batch_prefetchers[object_type]([event["data"] for event in events])
+    except Exception as e:
+        logging.error("Error prefetching %s batch of %s events: %s", object_type, len(events), e)
+        return [None] * len(events)
+
+
+def runnable(event):
+    with bind_event_id(event["event_id"]):
+        return not (skip_if_filtered(event) or park_if_open(event))
+
+
+def run_event(event, memo=None):
+    with bind_event_id(event["event_id"]):
+        failure = "not handled"
+        try:
+            failure = handle_event(event["object_type"], event["data"], event, memo)
         finally:
-            queue.task_done()
+            settle(event, failure)
+
+
+def run_batch(events):
+    """
+    Handle leased events of one type as a set: prefetch for all of them,
+    then run each in its own thread and context. Every event still fails,
+    retries and settles on its own.
+    """
+    memos = prefetch_batch(events[0]["object_type"], events)
+    with ThreadPoolExecutor(max_workers=len(events), thread_name_prefix="batch") as pool:
+        list(pool.map(run_event, events, memos))
+
+
+def work_once(shard):
+    event = queue.lease(shard)
+    events = [event]
+    if event["object_type"] in batch_prefetchers and EVENT_BATCH_SIZE > 1:
+        events += queue.lease_batch([shard], event["object_type"], EVENT_BATCH_SIZE - 1)
+    for leased in events:
+        event_age.observe(time.time() - leased["enqueued_at"], leased["object_type"])
+    events = [leased for leased in events if runnable(leased)]
+    if len(events) > 1:
+        run_batch(events)
+    elif events:
+        run_event(events[0])
+
+
+def worker(shard):
+    # Nothing restarts a worker thread, so a queue error must not end it. An
+    # event whose lease or settle failed is retried once its lease expires.
+    while True:
+        try:
+            work_once(shard)
+        except Exception:
+            logging.exception("Worker for shard %s failed, retrying in %ss", shard, WORKER_ERROR_BACKOFF)
+            time.sleep(WORKER_ERROR_BACKOFF)
+
+
+async def prefetch_async(events):
+    """
+    Memos for the leased events that share a type in ``batch_prefetchers``
+    with others, by queue id.
+    """
+    groups = {}
+    for event in events:
+        if event["object_type"] in batch_prefetchers:
+            groups.setdefault(event["object_type"], []).append(event)
+    memos = {}
+    for object_type, group in groups.items():
+        if len(group) > 1:
+            results = await asyncio.to_thread(prefetch_batch, object_type, group)
+            memos.update((event["id"], memo) for event, memo in zip(group, results))
+    return memos
+
+
+async def process_async(event, async_handlers, memo=None):
+    # Each task runs in its own copy of the context; the binding ends with it.
+    set_event_id(event["event_id"])
+    object_type = event["object_type"]
+    event_age.observe(time.time() - event["enqueued_at"], object_type)
+    # Both may ack, park or dead-letter the event in SQLite; off the loop.
+    if await asyncio.to_thread(skip_if_filtered, event) or await asyncio.to_thread(park_if_open, event):
+        return
+    handler = async_handlers.get(object_type)
+    if not handler:
+        # No asyncio version yet; run the blocking handler off-loop.
+        failure = await asyncio.to_thread(handle_event, object_type, event["data"], event, memo)
+        await asyncio.to_thread(settle, event, failure)
+        return
+
+    started = time.perf_counter()
+    with event_context(EVENT_DEADLINE) as context, trace_event(
+        context, event["event_id"], object_type, **trace_attributes(event)
+    ):
+        context.memo.update(memo or {})
+        try:
+            await handler(event["data"])
+        except Exception as e:
+            logging.error("Error processing webhook data: %s", e)
+            context.failures.append(("handler", f"{type(e).__name__}: {e}"))
+    handler_duration.observe(time.perf_counter() - started, object_type)
+    event["timed_out"] = context.timed_out
+    failure = None
+    if context.failures:
+        handler_errors.inc(object_type)
+        failure = failure_reason(context)
+    await asyncio.to_thread(settle, event, failure)
+
+
+async def async_worker(shards, concurrency=ASYNC_CONCURRENCY):
+    from app.handlers.aio import async_webhook_handlers
+
+    loop = asyncio.get_running_loop()
+    arrived = asyncio.Event()
+    queue.add_listener(lambda: loop.call_soon_threadsafe(arrived.set))
+    in_flight = set()
+
+    while True:
+        arrived.clear()
+        seen = queue.data_version()
+        tried_at = time.monotonic()
+        try:
+            events = await asyncio.to_thread(
+                queue.lease_ready, shards, concurrency - len(in_flight)
+            )
+        except Exception:
+            logging.exception("Leasing shards %s failed, retrying in %ss", shards, WORKER_ERROR_BACKOFF)
+            await asyncio.sleep(WORKER_ERROR_BACKOFF)
+            continue
+        memos = await prefetch_async(events) if EVENT_BATCH_SIZE > 1 else {}
+        for event in events:
+            task = asyncio.create_task(
+                process_async(event, async_handlers=async_webhook_handlers, memo=memos.get(event["id"]))
+            )
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if events:
+            continue
+
+        # Sleep until a local enqueue, a finished event (which may unblock the
+        # next event for that entity), a commit by another process or the
+        # retry interval for expired leases.
+        arrival = asyncio.create_task(arrived.wait())
+        while True:
+            done, _ = await asyncio.wait(
+                {arrival, *in_flight}, timeout=queue.poll_interval, return_when=asyncio.FIRST_COMPLETED
+            )
+            if (
+                done
+                or queue.data_version() != seen
+                or time.monotonic() - tried_at >= QUEUE_RETRY_INTERVAL
+            ):
+                break
+        arrival.cancel()
+
+
+def run_async_worker(shards):
+    asyncio.run(async_worker(shards))
+
+
+def recover_queue():
+    resumed = queue.recover(shard_for_key, lane_for)
+    if resumed:
+        logging.info("Resuming %s pending webhook events", resumed)
+    return resumed
+
+
+def start_shards(shards):
+    """
+    Start consumers for ``shards`` in this process and return their threads.
+    Each shard must be consumed by exactly one process.
+    """
+    if WORKER_MODE == "async":
+        thread = Thread(target=run_async_worker, args=(list(shards),), name="async-worker", daemon=True)
+        thread.start()
+        logging.info(
+            "Started asyncio webhook worker for shards %s with up to %s events in flight",
+            list(shards), ASYNC_CONCURRENCY,
+        )
+        return [thread]
+    threads = []
+    for shard in shards:
+        thread = Thread(target=worker, args=(shard,), name=f"worker-{shard}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    logging.info("Started %s webhook workers for shards %s", len(threads), list(shards))
+    return threads
 
 
 def start_worker():
-    Thread(target=worker, daemon=True).start()
+    recover_queue()
+    return start_shards(range(WORKER_COUNT))
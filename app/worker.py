@@ -0,0 +1,139 @@
+"""
+Run the webhook workers as separate processes, next to an ingest tier that
+only enqueues.
+
+    EMBEDDED_WORKER=false gunicorn -w 4 app.main:app
+    python -m app.worker --processes 4
+
+The ingest processes and the workers share the SQLite queue at
+``STATE_DB_PATH`` and must agree on ``WORKER_COUNT``. Shard ``s`` is consumed
+only by process ``s % processes``, so every job's events are still handled
+one at a time and in order. The supervisor recovers the queue once before
+any worker starts, and restarts a worker process that dies. Its in-flight
+event is picked up again once the lease expires.
+
+The supervisor makes no upstream calls itself. Each worker process gets an
+equal share of every upstream rate budget (``UPSTREAM_BUDGET_SHARES``) and
+a connection pool sized for its own shards.
+"""
+import os
+import time
+import signal
+import logging
+import argparse
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app.utility.logs import configure_logging
+
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0")) or os.cpu_count() or 1
+# When set, worker process i serves its own /metrics on this port + i.
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        from app.utility import metrics
+
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_metrics(port):
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info("Serving worker metrics on port %s", port)
+
+
+def run_process(index, processes):
+    configure_logging()
+    from app.utility.tracing import set_trace_process
+
+    set_trace_process(index)
+    from app.utility.clients import warm_up_clients
+    from app.utility.client_index import load_client_index_in_background
+    from app.utility.worker import WORKER_COUNT, start_shards
+
+    shards = [shard for shard in range(WORKER_COUNT) if shard % processes == index]
+    if not shards:
+        logging.warning("Worker process %s has no shards; WORKER_COUNT=%s < %s", index, WORKER_COUNT, processes)
+        return
+    if WORKER_METRICS_PORT:
+        serve_metrics(WORKER_METRICS_PORT + index)
+    threads = start_shards(shards)
+    warm_up_clients()
+    if index == 0:
+        # The index is kept in the shared state db; one process fills it.
+        load_client_index_in_background()
+    for thread in threads:
+        thread.join()
+
+
+def supervise(processes):
+    from app.utility.worker import EVENT_BATCH_SIZE, WORKER_COUNT, recover_queue
+
+    if processes > WORKER_COUNT:
+        logging.warning("Only %s shards; running %s worker processes", WORKER_COUNT, WORKER_COUNT)
+        processes = WORKER_COUNT
+    recover_queue()
+
+    # Read by the children when they import the clients.
+    os.environ["UPSTREAM_BUDGET_SHARES"] = str(processes)
+    if not os.getenv("HTTP_POOL_SIZE"):
+        shards_per_process = -(-WORKER_COUNT // processes)
+        os.environ["HTTP_POOL_SIZE"] = str(shards_per_process * max(1, EVENT_BATCH_SIZE))
+
+    # spawn, not fork: the parent already holds SQLite connections.
+    context = multiprocessing.get_context("spawn")
+    children = {}
+    stopping = []
+
+    def start(index):
+        process = context.Process(target=run_process, args=(index, processes), name=f"worker-process-{index}")
+        process.start()
+        children[index] = process
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(processes):
+        start(index)
+    logging.info("Started %s worker processes for %s shards", processes, WORKER_COUNT)
+
+    while not stopping:
+        for index, process in list(children.items()):
+            if not process.is_alive():
+                logging.error("Worker process %s exited with %s, restarting", index, process.exitcode)
+                start(index)
+        time.sleep(1.0)
+
+    for process in children.values():
+        process.terminate()
+    for process in children.values():
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run webhook workers as separate processes.")
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES, help="Worker processes to run.")
+    args = parser.parse_args()
+
+    configure_logging()
+    supervise(max(1, args.processes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Per-event latency of a CreateJob event with pooled keep-alive clients versus a
+fresh connection per call (the old bare ``requests.*`` behaviour), measured
+against the local stub server.
+
+    python -m benchmarks.client_pooling --events 200
+
+Each pass creates jobs for its own deal ids, so the second one is not
+answered from the CreateJob ledger the first one filled.
+"""
+import os
+import time
+import argparse
+import tempfile
+from benchmarks.stub_server import StubServer
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(events, handler, event_data, first_deal_id=1):
+    timings = []
+    for i in range(events):
+        started = time.perf_counter()
+        handler(dict(event_data, deal_record_id=str(first_deal_id + i)))
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubServer(latency=args.latency_ms / 1000.0).start()
+    os.environ["SERVICEM8_BASE_URL"] = f"{server.base_url}/api_1.0"
+    os.environ["HUBSPOT_BASE_URL"] = server.base_url
+    os.environ["STATE_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="client-pooling-"), "state.db")
+    # The stub has no budget to protect; keep the limiters out of the timings.
+    for name in ("SERVICEM8_RATE_LIMIT", "HUBSPOT_RATE_LIMIT", "HUBSPOT_SEARCH_RATE_LIMIT"):
+        os.environ.setdefault(name, "1000000")
+    # One event at a time never shares a batch; the window would only add
+    # its wait to every update and hide the connection cost.
+    os.environ.setdefault("HUBSPOT_BATCH_WINDOW_MS", "0")
+
+    import requests
+    from app.utility import clients
+    from app.handlers.create_job import handle_create_job
+
+    event_data = {"service_category": "Solar", "site_address": "1 Test St"}
+    pooled_clients = (clients.servicem8, clients.hubspot)
+
+    def fresh_connection_request(client):
+        def request(method, path, **kwargs):
+            headers = dict(client.session.headers, **kwargs.pop("headers", {}))
+            return requests.request(method, client.url(path), headers=headers, **kwargs)
+        return request
+
+    for client in pooled_clients:
+        client.request = fresh_connection_request(client)
+    server.connections = 0
+    bare = run(args.events, handle_create_job, event_data)
+    bare_connections = server.connections
+
+    for client in pooled_clients:
+        del client.request
+    server.connections = 0
+    pooled = run(args.events, handle_create_job, event_data, first_deal_id=args.events + 1)
+    pooled_connections = server.connections
+
+    server.shutdown()
+    for name, timings, connections in (
+        ("fresh", bare, bare_connections),
+        ("pooled", pooled, pooled_connections),
+    ):
+        print(
+            f"{name:<7} p50 {percentile(timings, 50) * 1000:7.2f} ms  "
+            f"p99 {percentile(timings, 99) * 1000:7.2f} ms  "
+            f"connections {connections}"
+        )
+    print("Plain HTTP on loopback; real upstreams also pay a TLS handshake per fresh connection.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Ingest latency of ``/webhook`` with the old logging setup against the queued,
+sampled one.
+
+    python -m benchmarks.ingest_logging --requests 2000 --concurrency 8
+
+"before" writes every record on the request thread in the text format and
+logs each payload in full, as ``logging.basicConfig`` with f-string messages
+did. "after" is the default pipeline: records go on a queue, are formatted as
+JSON by the listener thread, and payloads are sampled and truncated. Both
+log to a file and run in alternating rounds against the same queue.
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+
+WORK_DIR = tempfile.mkdtemp(prefix="ingest-logging-")
+os.environ["STATE_DB_PATH"] = os.path.join(WORK_DIR, "state.db")
+os.environ["EMBEDDED_WORKER"] = "false"
+os.environ.setdefault("QUEUE_HIGH_WATER", "0")
+
+from app.main import app  # noqa: E402
+from app.utility import logs  # noqa: E402
+
+MODES = {
+    "before": {"queued": False, "log_format": "text", "sample_rate": 1.0, "max_chars": 0},
+    "after": {"queued": True, "log_format": "json", "sample_rate": None, "max_chars": None},
+}
+DEFAULTS = {"sample_rate": logs.LOG_PAYLOAD_SAMPLE_RATE, "max_chars": logs.LOG_PAYLOAD_MAX_CHARS}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+def payload(i, fields):
+    return {
+        "object": "JobActivity",
+        "eventVersion": "1.0",
+        "entry": [{"uuid": f"activity-{i}", "changed_fields": ["activity_was_scheduled", "start_date"]}],
+        "resource_url": f"https://api.servicem8.com/api_1.0/jobactivity/activity-{i}.json",
+        "properties": {f"property_{field}": f"value {field} for event {i}" for field in range(fields)},
+    }
+
+
+def use_mode(name, stream):
+    mode = MODES[name]
+    logs.LOG_PAYLOAD_SAMPLE_RATE = DEFAULTS["sample_rate"] if mode["sample_rate"] is None else mode["sample_rate"]
+    logs.LOG_PAYLOAD_MAX_CHARS = DEFAULTS["max_chars"] if mode["max_chars"] is None else mode["max_chars"]
+    logs.configure_logging(stream=stream, queued=mode["queued"], log_format=mode["log_format"])
+
+
+def run(requests, concurrency, fields, offset):
+    latencies = []
+    lock = threading.Lock()
+    bodies = [payload(offset + i, fields) for i in range(requests)]
+
+    def post(start):
+        client = app.test_client()
+        local = []
+        for body in bodies[start::concurrency]:
+            started = time.perf_counter()
+            response = client.post("/webhook", json=body)
+            local.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.get_data(as_text=True)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=post, args=(start,)) for start in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per mode and round.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--fields", type=int, default=50, help="Extra properties in each payload.")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    results = {name: {"elapsed": 0.0, "latencies": []} for name in MODES}
+    offset = 0
+    with open(os.path.join(WORK_DIR, "app.log"), "w") as stream:
+        use_mode("after", stream)
+        run(min(200, args.requests), args.concurrency, args.fields, offset)  # warm up
+        offset += args.requests
+        for _ in range(args.rounds):
+            for name in MODES:
+                use_mode(name, stream)
+                elapsed, latencies = run(args.requests, args.concurrency, args.fields, offset)
+                offset += args.requests
+                results[name]["elapsed"] += elapsed
+                results[name]["latencies"].extend(latencies)
+        logs.stop_logging()
+        log_bytes = stream.tell()
+
+    print(f"{args.requests * args.rounds} requests per mode, concurrency {args.concurrency}, "
+          f"{args.fields} extra payload fields, {log_bytes / 1e6:.1f} MB logged")
+    for name, result in results.items():
+        latencies = result["latencies"]
+        print(
+            f"{name:<8} {len(latencies) / result['elapsed']:>9.1f} req/s  "
+            f"p50 {percentile(latencies, 50) * 1000:7.3f} ms  "
+            f"p99 {percentile(latencies, 99) * 1000:7.3f} ms  "
+            f"mean {sum(latencies) / len(latencies) * 1000:7.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+End-to-end load test of the ingest routes, queue, workers and handlers
+against the local ServiceM8/HubSpot stub server.
+
+    python -m benchmarks.loadgen --events 500 --concurrency 32 --latency-ms 20
+    python -m benchmarks.loadgen --save baseline.json
+    python -m benchmarks.loadgen --baseline baseline.json
+
+Each event type is run as its own phase: payloads are posted to ``/webhook``
+(or ``/job/create``) from concurrent clients and the phase ends once the
+queue has drained. Per type it reports the ingest rate, p50/p99 latency from
+enqueue to ack, and the outbound calls made per event. With ``--baseline``
+the run exits non-zero when it is slower or chattier than the saved one.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.stub_server import StubServer
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+def job_payload(i):
+    return "/webhook", {
+        "object": "Job",
+        "entry": [{"uuid": f"job-lg-{i}", "changed_fields": ["status", "quote_sent"]}],
+    }
+
+
+def job_activity_payload(i):
+    return "/webhook", {
+        "object": "JobActivity",
+        "entry": [{"uuid": f"activity-lg-{i}", "changed_fields": ["start_date"]}],
+    }
+
+
+def quote_accepted_payload(i):
+    # Imported late: the app reads the stub's URLs from the environment.
+    from app.utility.hubspot import DEPOSIT_PAID_STAGE_ID
+
+    # A deal that reached Deposit Paid asks for its job to become a Work Order.
+    return "/webhook", {
+        "object": "QuoteAccepted",
+        "deal_record_id": str(10000 + i),
+        "sm8_job_id": f"job-qa-{i}",
+        "dealstage": DEPOSIT_PAID_STAGE_ID,
+    }
+
+
+def ready_to_be_quoted_payload(i):
+    return "/webhook", {
+        "object": "ReadyToBeQuoted",
+        "deal_record_id": str(20000 + i),
+        "sm8_job_id": f"job-rq-{i}",
+    }
+
+
+def create_job_payload(i):
+    return "/job/create", {
+        "deal_record_id": str(30000 + i),
+        "service_category": "Solar; Battery",
+        "service_type": "Install",
+        "existing_system": "None",
+        "deal_customer_type": "Residential",
+        "site_address": f"{i} Test St",
+        "enquiry_notes": "Load test enquiry",
+    }
+
+
+PAYLOADS = {
+    "Job": job_payload,
+    "JobActivity": job_activity_payload,
+    "QuoteAccepted": quote_accepted_payload,
+    "ReadyToBeQuoted": ready_to_be_quoted_payload,
+    "CreateJob": create_job_payload,
+}
+
+
+def wait_for_drain(shard_depths, timeout):
+    deadline = time.time() + timeout
+    while sum(shard_depths()) and time.time() < deadline:
+        time.sleep(0.02)
+    return not sum(shard_depths())
+
+
+def run_phase(object_type, app_url, events, concurrency, stub, latencies, shard_depths, drain_timeout):
+    import requests
+
+    make_payload = PAYLOADS[object_type]
+    local = threading.local()
+
+    def post(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        path, payload = make_payload(i)
+        response = session.post(f"{app_url}{path}", json=payload)
+        response.raise_for_status()
+
+    calls_before = stub.snapshot()
+    del latencies[:]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(post, range(events)))
+    ingest_seconds = time.perf_counter() - started
+    drained = wait_for_drain(shard_depths, drain_timeout)
+
+    calls_after = stub.snapshot()
+    calls = {
+        key: round((count - calls_before.get(key, 0)) / events, 3)
+        for key, count in sorted(calls_after.items())
+        if count != calls_before.get(key, 0)
+    }
+    return {
+        "events": events,
+        "drained": drained,
+        "ingest_per_second": round(events / ingest_seconds, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "calls_per_event": calls,
+        "total_calls_per_event": round(sum(calls.values()), 3),
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for object_type, current in results.items():
+        previous = baseline.get(object_type)
+        if not previous:
+            continue
+        if current["ingest_per_second"] < previous["ingest_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{object_type}: ingest {current['ingest_per_second']}/s vs {previous['ingest_per_second']}/s"
+            )
+        for key in ("p50_ms", "p99_ms"):
+            if current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{object_type}: {key} {current[key]} vs {previous[key]}")
+        if current["total_calls_per_event"] > previous["total_calls_per_event"] + 0.01:
+            regressions.append(
+                f"{object_type}: {current['total_calls_per_event']} calls/event "
+                f"vs {previous['total_calls_per_event']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200, help="Events posted per event type.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent webhook senders.")
+    parser.add_argument("--types", default=",".join(PAYLOADS), help="Comma separated event types to run.")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Stub latency per upstream call.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream calls answered 500.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of upstream calls answered 429.")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Fail when results regress against this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's log output.")
+    args = parser.parse_args()
+
+    stub = StubServer(
+        latency=args.latency_ms / 1000.0,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+    ).start()
+    os.environ["SERVICEM8_BASE_URL"] = f"{stub.base_url}/api_1.0"
+    os.environ["HUBSPOT_BASE_URL"] = stub.base_url
+    os.environ["STATE_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="loadgen-"), "state.db")
+    for name in ("SERVICEM8_RATE_LIMIT", "HUBSPOT_RATE_LIMIT", "HUBSPOT_SEARCH_RATE_LIMIT"):
+        os.environ.setdefault(name, "1000000")
+
+    from werkzeug.serving import make_server
+    from app.main import app
+    from app.utility.worker import queue, shard_depths
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    # Measure enqueue-to-ack in the harness rather than in the worker.
+    latencies = []
+    ack = queue.ack
+
+    def timed_ack(event):
+        ack(event)
+        latencies.append(time.time() - event["enqueued_at"])
+
+    queue.ack = timed_ack
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = {}
+    for object_type in [name.strip() for name in args.types.split(",") if name.strip()]:
+        results[object_type] = run_phase(
+            object_type,
+            app_url,
+            args.events,
+            args.concurrency,
+            stub,
+            latencies,
+            shard_depths,
+            args.drain_timeout,
+        )
+    server.shutdown()
+    stub.shutdown()
+
+    for object_type, result in results.items():
+        print(
+            f"{object_type:<16} ingest {result['ingest_per_second']:8.1f}/s  "
+            f"p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+            f"calls/event {result['total_calls_per_event']:5.2f}"
+            + ("" if result["drained"] else "  (queue not drained)")
+        )
+        for key, calls in result["calls_per_event"].items():
+            print(f"{'':<18}{calls:6.2f}  {key}")
+    if stub.injected:
+        print(f"Injected upstream failures: {stub.injected}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Enqueue/dequeue throughput of the durable webhook queue against the old
+in-memory ``queue.Queue``.
+
+    python -m benchmarks.queue_throughput --events 20000 --producers 8
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+from queue import Queue
+from app.utility.persistent_queue import PersistentQueue
+
+
+def sample_event(i):
+    return {
+        "object": "Job",
+        "entry": [{"uuid": f"job-{i % 500}", "changed_fields": ["status"]}],
+    }
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_producers(put, events, producers):
+    latencies = []
+    lock = threading.Lock()
+
+    def produce(offset):
+        local = []
+        for i in range(offset, events, producers):
+            started = time.perf_counter()
+            put(i)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=produce, args=(p,)) for p in range(producers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies
+
+
+def bench_memory(events, producers):
+    queue = Queue()
+    elapsed, latencies = run_producers(
+        lambda i: queue.put(("Job", sample_event(i))), events, producers
+    )
+    started = time.perf_counter()
+    for _ in range(events):
+        queue.get()
+        queue.task_done()
+    return elapsed, latencies, time.perf_counter() - started
+
+
+def bench_persistent(events, producers, shards):
+    with tempfile.TemporaryDirectory() as directory:
+        queue = PersistentQueue(path=os.path.join(directory, "bench.db"))
+        elapsed, latencies = run_producers(
+            lambda i: queue.put("Job", sample_event(i), shard=i % shards, entity_key=f"job-{i % 500}"),
+            events,
+            producers,
+        )
+
+        def consume(shard, expected):
+            for _ in range(expected):
+                queue.ack(queue.lease(shard))
+
+        per_shard = [len(range(s, events, shards)) for s in range(shards)]
+        threads = [
+            threading.Thread(target=consume, args=(s, per_shard[s])) for s in range(shards)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return elapsed, latencies, time.perf_counter() - started
+
+
+def report(name, events, result):
+    enqueue_elapsed, latencies, dequeue_elapsed = result
+    print(
+        f"{name:<12} enqueue {events / enqueue_elapsed:>10.0f}/s "
+        f"(p50 {percentile(latencies, 50) * 1000:.3f} ms, p99 {percentile(latencies, 99) * 1000:.3f} ms)  "
+        f"lease+ack {events / dequeue_elapsed:>10.0f}/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--producers", type=int, default=8)
+    parser.add_argument("--shards", type=int, default=4)
+    args = parser.parse_args()
+
+    report("in-memory", args.events, bench_memory(args.events, args.producers))
+    report("sqlite-wal", args.events, bench_persistent(args.events, args.producers, args.shards))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Local stand-in for the ServiceM8 and HubSpot endpoints used by the handlers.
+ServiceM8 lives under ``/api_1.0`` and HubSpot under ``/crm``, so both base
+URLs can point at the same server. Latency, 5xx errors and 429s can be
+injected, and every call is counted per endpoint.
+
+    python -m benchmarks.stub_server --port 8081 --latency-ms 40 --throttle-rate 0.01
+
+then run the app with SERVICEM8_BASE_URL=http://127.0.0.1:8081/api_1.0 and
+HUBSPOT_BASE_URL=http://127.0.0.1:8081.
+"""
+import re
+import json
+import time
+import uuid
+import zlib
+import random
+import argparse
+import threading
+from urllib.parse import parse_qsl, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REQUIRED_DEAL_STAGE_ID = "1800543694"
+ID_SEGMENT = re.compile(r"^[^.]*[0-9-][^.]*")
+KEEP_SEGMENTS = {"api_1.0", "v3", "v4"}
+
+
+def endpoint(method, path):
+    """
+    Collapse record ids in a path so calls are counted per endpoint,
+    e.g. ``GET /api_1.0/job/{id}.json``.
+    """
+    segments = [
+        segment if segment in KEEP_SEGMENTS else ID_SEGMENT.sub("{id}", segment)
+        for segment in path.split("/")
+    ]
+    return f"{method} {'/'.join(segments)}"
+
+
+def job_status_for(job_uuid):
+    return ("Quote", "Work Order")[zlib.crc32(job_uuid.encode("utf-8")) % 2]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send(self, status=200, payload=None, headers=None):
+        body = json.dumps(payload if payload is not None else {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        body = self._body() if method in ("POST", "PATCH") else {}
+        path = self.path.split("?")[0]
+        server.count(method, path)
+
+        roll = random.random()
+        if roll < server.throttle_rate:
+            server.count_injected("429")
+            return self._send(429, {"message": "rate limited"}, {"Retry-After": str(server.retry_after)})
+        if roll < server.throttle_rate + server.error_rate:
+            server.count_injected("500")
+            return self._send(500, {"message": "injected error"})
+
+        if path.startswith("/api_1.0/"):
+            return self._servicem8(method, path[len("/api_1.0/"):], body)
+        return self._hubspot(method, path, body)
+
+    def _list_page(self, make_record):
+        query = dict(parse_qsl(urlsplit(self.path).query))
+        offset = max(0, int(query.get("cursor", "-1")))
+        end = min(offset + self.server.page_size, self.server.record_count)
+        records = [make_record(i) for i in range(offset, end)]
+        headers = {"x-next-cursor": str(end)} if end < self.server.record_count else {}
+        return self._send(200, records, headers)
+
+    def _servicem8(self, method, path, body):
+        if method == "POST" and path in ("company.json", "job.json", "jobcontact.json"):
+            return self._send(200, {}, {"x-record-uuid": str(uuid.uuid4())})
+        if method == "GET" and path == "job.json":
+            return self._list_page(lambda i: {
+                "uuid": f"job-{i}",
+                "status": ("Quote", "Work Order")[i % 2],
+                "quote_sent": True,
+                "quote_date": "2025-01-01 09:00:00",
+                "total_invoice_amount": "1200.00",
+                "edit_date": f"2025-01-01 10:{i // 60 % 60:02d}:{i % 60:02d}",
+            })
+        if method == "GET" and path == "company.json":
+            return self._list_page(lambda i: {"uuid": f"company-{i}", "name": f"Customer {i}", "active": 1})
+        if method == "GET" and path == "jobactivity.json":
+            return self._list_page(lambda i: {
+                "uuid": f"activity-{i}",
+                "job_uuid": f"job-{i}",
+                "activity_was_scheduled": "1",
+                "start_date": "2025-01-02 10:00:00",
+                "edit_date": f"2025-01-01 10:{i // 60 % 60:02d}:{i % 60:02d}",
+            })
+        if path.startswith("job/"):
+            job_uuid = path[len("job/"):-len(".json")]
+            return self._send(200, {
+                "uuid": job_uuid,
+                "status": "Work Order" if method == "POST" else job_status_for(job_uuid),
+                "quote_sent": True,
+                "quote_date": "2025-01-01 09:00:00",
+                "total_invoice_amount": "1200.00",
+            })
+        if path.startswith("jobactivity/"):
+            activity_uuid = path[len("jobactivity/"):-len(".json")]
+            return self._send(200, {
+                "uuid": activity_uuid,
+                "job_uuid": activity_uuid.replace("activity-", "job-"),
+                "activity_was_scheduled": "1",
+                "start_date": "2025-01-02 10:00:00",
+            })
+        return self._send(200, {})
+
+    def _hubspot(self, method, path, body):
+        if path.startswith("/crm/v4/associations/") and path.endswith("/batch/read"):
+            results = [
+                {"from": {"id": item["id"]}, "to": [{"toObjectId": 2001, "associationTypes": []}]}
+                for item in body.get("inputs", [])
+            ]
+            return self._send(200, {"status": "COMPLETE", "results": results})
+        if path.endswith("/batch/read"):
+            results = []
+            for item in body.get("inputs", []):
+                results.append({
+                    "id": item["id"],
+                    "properties": {
+                        "dealstage": REQUIRED_DEAL_STAGE_ID,
+                        "firstname": "Test",
+                        "lastname": "Customer",
+                        "email": "test@example.com",
+                        "phone": "0400000000",
+                    },
+                })
+            return self._send(200, {"results": results})
+        if path.endswith("/batch/update"):
+            results = [
+                {"id": item["id"], "properties": item.get("properties", {})}
+                for item in body.get("inputs", [])
+            ]
+            return self._send(200, {"status": "COMPLETE", "results": results})
+        if path.endswith("/contacts/search"):
+            filters = [item for group in body.get("filterGroups", []) for item in group.get("filters", [])]
+            after = max([int(item["value"]) for item in filters if item.get("propertyName") == "hs_object_id"] or [0])
+            end = min(after + body.get("limit", 100), self.server.record_count)
+            results = [
+                {"id": str(i), "properties": {"sm8_client_id": f"company-{i}"}}
+                for i in range(after + 1, end + 1)
+            ]
+            return self._send(200, {"total": self.server.record_count, "results": results})
+        if path.endswith("/search"):
+            job_uuids = []
+            for group in body.get("filterGroups", []):
+                for item in group.get("filters", []):
+                    job_uuids.extend(item.get("values") or [item.get("value")])
+            results = [
+                {"id": str(1000 + index), "properties": {"sm8_job_id": job_uuid, "dealstage": "1735909846"}}
+                for index, job_uuid in enumerate(job_uuids)
+            ]
+            return self._send(200, {"total": len(results), "results": results})
+        if "/associations/" in path:
+            return self._send(200, {"results": [{"toObjectId": 2001}]})
+        return self._send(200, {"id": path.rsplit("/", 1)[-1], "properties": body.get("properties", {})})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_HEAD(self):
+        self.server.count("HEAD", self.path.split("?")[0])
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PATCH(self):
+        self._route("PATCH")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after=1,
+        record_count=0,
+        page_size=100,
+    ):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.record_count = record_count
+        self.page_size = page_size
+        self.calls = {}
+        self.injected = {}
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def get_request(self):
+        conn = super().get_request()
+        with self._lock:
+            self.connections += 1
+        return conn
+
+    def count(self, method, path):
+        key = endpoint(method, path)
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def count_injected(self, status):
+        with self._lock:
+            self.injected[status] = self.injected.get(status, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.calls)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local ServiceM8/HubSpot stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--records", type=int, default=0, help="Jobs/activities served by the list endpoints.")
+    args = parser.parse_args()
+
+    server = StubServer(
+        (args.host, args.port),
+        latency=args.latency_ms / 1000.0,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        record_count=args.records,
+    )
+    print(f"Serving ServiceM8 at {server.base_url}/api_1.0 and HubSpot at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for key, count in sorted(server.snapshot().items()):
+            print(f"{count:>8}  {key}")
+
+
+if __name__ == "__main__":
+    main()
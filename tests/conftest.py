@@ -0,0 +1,39 @@
+"""
+The app reads its configuration from the environment at import time, so the
+state database and both upstreams are pointed at a temporary directory and
+a local stub server here, before any test imports ``app``.
+"""
+import os
+import tempfile
+import pytest
+from benchmarks.stub_server import StubServer
+
+STATE_DIR = tempfile.mkdtemp(prefix="sm8-tests-")
+stub = StubServer().start()
+
+os.environ.update({
+    "STATE_DB_PATH": os.path.join(STATE_DIR, "state.db"),
+    "TRACE_PATH": os.path.join(STATE_DIR, "traces.jsonl"),
+    "SERVICEM8_BASE_URL": f"{stub.base_url}/api_1.0",
+    "HUBSPOT_BASE_URL": stub.base_url,
+    "SERVICEM8_API_KEY": "test",
+    "HUBSPOT_API_TOKEN": "test",
+    "EMBEDDED_WORKER": "false",
+    "LOG_QUEUE": "false",
+    "WORKER_COUNT": "1",
+    "HUBSPOT_BATCH_WINDOW_MS": "0",
+})
+
+
+@pytest.fixture
+def upstream():
+    return stub
+
+
+@pytest.fixture
+def queue():
+    """The workers' queue, emptied so each test sees only its own events."""
+    from app.utility.worker import queue
+
+    queue._conn().execute("DELETE FROM events")
+    return queue
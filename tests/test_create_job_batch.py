@@ -0,0 +1,140 @@
+import time
+from app.handlers import create_job as create_job_handler
+from app.handlers.create_job import prefetch_create_jobs
+from app.utility import worker
+from app.utility.context import memo_key
+from app.utility.ledger import create_job_ledger
+
+_deal_ids = iter(range(int(time.time() * 1000), 10 ** 15))
+
+
+def new_deal_id():
+    return str(next(_deal_ids))
+
+
+def create_job_event(deal_id, **data):
+    return {"deal_record_id": deal_id, "service_category": "Solar", "enquiry_notes": "", **data}
+
+
+def queued(queue):
+    return {
+        row[0]: {"attempts": row[1], "leased": row[2] is not None, "visible_at": row[3]}
+        for row in queue._conn().execute("SELECT id, attempts, lease_token, visible_at FROM events")
+    }
+
+
+def hubspot_reads(calls):
+    return sum(
+        count for key, count in calls.items()
+        if key.startswith("GET /crm") or key.endswith("/batch/read")
+    )
+
+
+def test_lease_batch_takes_ready_events_of_one_type(queue):
+    first, second, third = new_deal_id(), new_deal_id(), new_deal_id()
+    queue.put("CreateJob", create_job_event(first), entity_key=first, lane="interactive")
+    queue.put("Job", {"object": "Job", "entry": []}, entity_key="job-1", lane="bulk")
+    queue.put("CreateJob", create_job_event(second), entity_key=second, lane="interactive")
+    # A later event for a deal already in the batch waits for the first one.
+    queue.put("CreateJob", create_job_event(second), entity_key=second, lane="interactive")
+    queue.put("CreateJob", create_job_event(third), entity_key=third, lane="interactive")
+
+    leased = queue.lease(0, timeout=1)
+    assert leased["data"]["deal_record_id"] == first
+
+    batch = queue.lease_batch([0], "CreateJob", 10)
+    assert [event["data"]["deal_record_id"] for event in batch] == [second, third]
+    assert queue.lease_batch([0], "CreateJob", 10) == []
+
+
+def test_prefetch_seeds_memos_with_batch_reads(upstream):
+    done, first, second = new_deal_id(), new_deal_id(), new_deal_id()
+    entry = create_job_ledger.claim(done)
+    create_job_ledger.complete(entry, "job-done")
+
+    before = upstream.snapshot()
+    memos = prefetch_create_jobs([create_job_event(done), create_job_event(first), {}, create_job_event(second)])
+    calls = {key: count - before.get(key, 0) for key, count in upstream.snapshot().items()}
+
+    assert calls.get("POST /crm/v3/objects/deals/batch/read") == 1
+    assert calls.get("POST /crm/v4/associations/deals/contacts/batch/read") == 1
+    assert calls.get("POST /crm/v3/objects/contacts/batch/read") == 1
+    # A deal whose job is done is not read; a body without a deal gets no memo.
+    assert memos[0] == {} and memos[2] == {}
+    for memo, deal_id in ((memos[1], first), (memos[3], second)):
+        assert set(memo) == {memo_key("job_deal", deal_id), memo_key("deal_contact", deal_id)}
+        assert memo[memo_key("job_deal", deal_id)]["id"] == deal_id
+
+
+def test_seeded_event_makes_no_reads_of_its_own(upstream):
+    deal_id = new_deal_id()
+    data = create_job_event(deal_id)
+    [memo] = prefetch_create_jobs([data])
+
+    before = upstream.snapshot()
+    assert worker.handle_event("CreateJob", data, memo=memo) is None
+    calls = {key: count - before.get(key, 0) for key, count in upstream.snapshot().items()}
+
+    assert hubspot_reads(calls) == 0
+    assert calls.get("POST /api_1.0/job.json") == 1
+    assert create_job_ledger.get(deal_id)["status"] == "done"
+
+
+def test_partial_failure_in_a_batch_settles_each_event(queue, upstream, monkeypatch):
+    create_servicem8_job = create_job_handler.create_servicem8_job
+
+    def failing_create_servicem8_job(job_data):
+        if "fail" in job_data["job_description"]:
+            raise RuntimeError("ServiceM8 rejected the job")
+        return create_servicem8_job(job_data)
+
+    monkeypatch.setattr(create_job_handler, "create_servicem8_job", failing_create_servicem8_job)
+    monkeypatch.setattr(worker, "EVENT_BATCH_SIZE", 3)
+    deal_ids = [new_deal_id() for _ in range(3)]
+    failing = deal_ids[1]
+    ids = [
+        queue.put(
+            "CreateJob",
+            create_job_event(deal_id, enquiry_notes="fail" if deal_id == failing else ""),
+            entity_key=deal_id,
+            lane="interactive",
+        )
+        for deal_id in deal_ids
+    ]
+
+    before = upstream.snapshot()
+    worker.work_once(0)
+    calls = {key: count - before.get(key, 0) for key, count in upstream.snapshot().items()}
+
+    # All three were leased and prefetched together.
+    assert calls.get("POST /crm/v3/objects/deals/batch/read") == 1
+    assert hubspot_reads(calls) == 3
+    # The other two went through and were acked.
+    for deal_id in deal_ids:
+        if deal_id != failing:
+            assert create_job_ledger.get(deal_id)["status"] == "done"
+    remaining = queued(queue)
+    assert list(remaining) == [ids[1]]
+    # The failing one is released for a retry, with its progress kept.
+    retry = remaining[ids[1]]
+    assert retry["attempts"] == 1 and not retry["leased"]
+    assert retry["visible_at"] > time.time()
+    entry = create_job_ledger.get(failing)
+    assert entry["status"] == "in_progress" and entry["owner"] is None
+    assert entry["client_uuid"] and not entry["job_uuid"]
+
+
+def test_batch_runs_each_event_when_prefetch_fails(queue, monkeypatch):
+    def broken_prefetch(events_data):
+        raise RuntimeError("HubSpot batch read failed")
+
+    monkeypatch.setitem(worker.batch_prefetchers, "CreateJob", broken_prefetch)
+    deal_ids = [new_deal_id() for _ in range(2)]
+    for deal_id in deal_ids:
+        queue.put("CreateJob", create_job_event(deal_id), entity_key=deal_id, lane="interactive")
+
+    worker.work_once(0)
+
+    assert queued(queue) == {}
+    for deal_id in deal_ids:
+        assert create_job_ledger.get(deal_id)["status"] == "done"
@@ -0,0 +1,50 @@
+from collections import Counter
+from app.utility import worker
+from app.utility.persistent_queue import PersistentQueue, WeightedLanes
+
+
+def test_pick_shares_turns_by_weight():
+    lanes = WeightedLanes({"interactive": 3, "bulk": 1})
+    picks = [lanes.pick(["interactive", "bulk"]) for _ in range(8)]
+    assert Counter(picks) == {"interactive": 6, "bulk": 2}
+    # Interleaved: bulk never waits more than one round.
+    assert picks[:4].count("bulk") == 1 and picks[4:].count("bulk") == 1
+
+
+def test_pick_skips_lanes_without_work():
+    lanes = WeightedLanes({"interactive": 8, "bulk": 1})
+    assert [lanes.pick(["bulk"]) for _ in range(3)] == ["bulk"] * 3
+    assert lanes.pick(["interactive", "bulk"]) == "interactive"
+
+
+def test_lease_ready_takes_turns_between_lanes(tmp_path):
+    queue = PersistentQueue(str(tmp_path / "queue.db"), lane_weights={"interactive": 3, "bulk": 1})
+    for i in range(8):
+        queue.put("Job", {"i": i}, entity_key=f"job-{i}", lane="bulk")
+    for i in range(8):
+        queue.put("CreateJob", {"i": i}, entity_key=f"deal-{i}", lane="interactive")
+
+    leased = queue.lease_ready([0], 8)
+    assert Counter(event["object_type"] for event in leased) == {"CreateJob": 6, "Job": 2}
+    # Each lane is still served oldest first.
+    assert [event["data"]["i"] for event in leased if event["object_type"] == "Job"] == [0, 1]
+
+
+def test_entity_order_holds_across_lanes(tmp_path):
+    queue = PersistentQueue(str(tmp_path / "queue.db"), lane_weights={"interactive": 8, "bulk": 1})
+    queue.put("Job", {"step": 1}, entity_key="job-1", lane="bulk")
+    queue.put("CreateJob", {"step": 2}, entity_key="job-1", lane="interactive")
+    queue.put("CreateJob", {"step": 1}, entity_key="deal-1", lane="interactive")
+
+    first = queue.lease(0, timeout=1)
+    second = queue.lease(0, timeout=1)
+    assert {first["data"]["step"], second["data"]["step"]} == {1}
+    assert queue.lease(0, timeout=0.1) is None
+
+    queue.ack(next(event for event in (first, second) if event["object_type"] == "Job"))
+    assert queue.lease(0, timeout=1)["data"] == {"step": 2}
+
+
+def test_every_routed_lane_has_a_weight():
+    assert set(worker.EVENT_LANES.values()) <= set(worker.QUEUE_LANE_WEIGHTS)
+    assert worker.queue.lane_weights == worker.QUEUE_LANE_WEIGHTS
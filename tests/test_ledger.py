@@ -0,0 +1,135 @@
+import time
+import threading
+import pytest
+from app.utility import worker
+from app.utility.ledger import CreateJobLedger, create_job_ledger
+
+_deal_ids = iter(range(int(time.time() * 1000) + 10 ** 13, 10 ** 15))
+
+
+def new_deal_id():
+    return str(next(_deal_ids))
+
+
+def calls_since(upstream, before):
+    calls = {key: count - before.get(key, 0) for key, count in upstream.snapshot().items()}
+    return {key: count for key, count in calls.items() if count}
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return CreateJobLedger(str(tmp_path / "ledger.db"))
+
+
+@pytest.fixture
+def client():
+    from app.main import app
+
+    return app.test_client()
+
+
+def test_claim_is_held_until_released(ledger):
+    entry = ledger.claim("1")
+    assert entry["owner"] and entry["status"] == "in_progress"
+    assert ledger.claim("1") is None
+
+    ledger.record(entry, client_uuid="client-1")
+    ledger.release(entry)
+    retry = ledger.claim("1")
+    assert retry["owner"] != entry["owner"]
+    assert retry["client_uuid"] == "client-1"
+
+
+def test_concurrent_claims_have_one_winner(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    ledgers = [CreateJobLedger(path) for _ in range(8)]
+    start = threading.Barrier(len(ledgers))
+    claims = []
+
+    def claim(ledger):
+        start.wait()
+        claims.append(ledger.claim("1"))
+
+    threads = [threading.Thread(target=claim, args=(ledger,)) for ledger in ledgers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len([entry for entry in claims if entry]) == 1
+
+
+def test_expired_claim_is_taken_over(tmp_path):
+    ledger = CreateJobLedger(str(tmp_path / "ledger.db"), claim_ttl=0)
+    stale = ledger.claim("1")
+    time.sleep(0.01)
+    current = ledger.claim("1")
+    assert current
+
+    # The run that lost its claim can no longer write to the row.
+    ledger.record(stale, job_uuid="job-stale")
+    ledger.complete(stale)
+    assert ledger.get("1")["job_uuid"] is None
+    assert ledger.get("1")["owner"] == current["owner"]
+
+
+def test_completed_deal_is_not_claimed_again(ledger):
+    entry = ledger.claim("1")
+    ledger.complete(entry, "job-1")
+    assert ledger.claim("1") is None
+    done = ledger.get("1")
+    assert (done["status"], done["job_uuid"], done["owner"]) == ("done", "job-1", None)
+    assert ledger.stats() == {"done": 1}
+
+
+def test_record_rejects_unknown_steps(ledger):
+    entry = ledger.claim("1")
+    with pytest.raises(ValueError):
+        ledger.record(entry, job_status="Quote")
+
+
+def test_retry_resumes_after_the_last_recorded_step(upstream):
+    deal_id = new_deal_id()
+    entry = create_job_ledger.claim(deal_id)
+    create_job_ledger.record(entry, client_uuid="client-1", contact_id="2001", contact_linked=1)
+    create_job_ledger.release(entry)
+
+    before = upstream.snapshot()
+    assert worker.handle_event("CreateJob", {"deal_record_id": deal_id}) is None
+    calls = calls_since(upstream, before)
+
+    assert "POST /api_1.0/company.json" not in calls
+    assert calls.get("POST /api_1.0/job.json") == 1
+    done = create_job_ledger.get(deal_id)
+    assert done["status"] == "done" and done["client_uuid"] == "client-1"
+
+
+def test_duplicate_create_job_waits_for_the_claim(queue, upstream, client):
+    deal_id = new_deal_id()
+    response = client.post("/job/create", json={"deal_record_id": deal_id})
+    assert response.get_json()["status"] == "job queued"
+
+    # Another run (e.g. an earlier /job/create for the deal) holds the claim.
+    held = create_job_ledger.claim(deal_id)
+    before = upstream.snapshot()
+    worker.work_once(0)
+    assert "POST /api_1.0/job.json" not in calls_since(upstream, before)
+    [(event_id, attempts, lease_token)] = queue._conn().execute(
+        "SELECT id, attempts, lease_token FROM events"
+    ).fetchall()
+    assert attempts == 1 and lease_token is None
+    assert create_job_ledger.get(deal_id)["owner"] == held["owner"]
+
+    # Once it lets go, the retry creates the job.
+    create_job_ledger.release(held)
+    queue._conn().execute("UPDATE events SET visible_at = 0 WHERE id = ?", (event_id,))
+    worker.work_once(0)
+    done = create_job_ledger.get(deal_id)
+    assert done["status"] == "done" and done["job_uuid"]
+    assert queue._conn().execute("SELECT COUNT(*) FROM events").fetchone()[0] == 0
+
+    # A repeat request is answered from the ledger and queues nothing.
+    before = upstream.snapshot()
+    response = client.post("/job/create", json={"deal_record_id": deal_id})
+    assert response.get_json() == {"status": "job exists", "sm8_job_id": done["job_uuid"]}
+    assert queue._conn().execute("SELECT COUNT(*) FROM events").fetchone()[0] == 0
+    assert calls_since(upstream, before) == {}